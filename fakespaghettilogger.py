@@ -28,42 +28,116 @@ import datetime
 import json
 import logging
 import os
+import signal
 import sys
 
 import time
 import tornado.gen
+import tornado.httpclient
+import tornado.locks
 import tornado.websocket
 import tornado.ioloop
+import tornado.util
 
 from spaghettilogger import LineWriter, RECONNECT_MIN_INTERVAL, \
-    RECONNECT_SUCCESS_THRESHOLD, RECONNECT_MAX_INTERVAL
+    RECONNECT_SUCCESS_THRESHOLD, RECONNECT_MAX_INTERVAL, default_clock, \
+    Compactor, zstandard, ChannelsFileWatcher, diff_channels, \
+    DURABILITY_POLICIES, DURABILITY_NONE, DURABILITY_PERIODIC, \
+    DURABILITY_GROUP, SYNC_INTERVAL, sync_writers
 
 _logger = logging.getLogger(__name__)
 
-__version__ = '1.0.1'
+__version__ = '1.1.0'
 
 
 class Client(object):
-    def __init__(self, url, channel_id, log_dir):
+    def __init__(self, url, channel_id, log_dir, flush_size=None,
+                 flush_interval=None, compression=None, compact=None,
+                 compactor=None, durability=DURABILITY_NONE,
+                 sync_interval=SYNC_INTERVAL, segment_size=None,
+                 segment_interval=None):
+        if compact and not compactor:
+            self._compactor = compactor = Compactor(compact)
+        else:
+            self._compactor = None
+
         self._writer = LineWriter(log_dir, str(channel_id), encoding='utf-8',
-                                  encoding_errors='replace')
+                                  encoding_errors='replace',
+                                  flush_size=flush_size,
+                                  flush_interval=flush_interval,
+                                  compression=compression,
+                                  compactor=compactor,
+                                  durability=durability,
+                                  sync_interval=sync_interval,
+                                  segment_size=segment_size,
+                                  segment_interval=segment_interval)
         self._url = url
         self._channel_id = channel_id
+        self._flush_interval = flush_interval
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._running = True
+        self._stop_event = tornado.locks.Event()
+        self._conn = None
 
     def run(self):
-        tornado.ioloop.IOLoop.current().run_sync(self._run)
+        if self._flush_interval:
+            flush_callback = tornado.ioloop.PeriodicCallback(
+                self.flush_due, self._flush_interval * 1000)
+            flush_callback.start()
+
+        if self._durability in (DURABILITY_PERIODIC, DURABILITY_GROUP):
+            sync_callback = tornado.ioloop.PeriodicCallback(
+                self.sync, self._sync_interval * 1000)
+            sync_callback.start()
+
+        try:
+            tornado.ioloop.IOLoop.current().run_sync(self._run)
+        finally:
+            self.close()
+
+    def start(self):
+        '''Run the client on the current IOLoop and return its future.'''
+        return self._run()
+
+    def stop(self):
+        self._running = False
+        self._stop_event.set()
+
+        if self._conn:
+            self._conn.close()
+
+    def flush_due(self):
+        self._writer.flush_due()
+
+    @property
+    def writer(self):
+        return self._writer
+
+    def sync(self):
+        sync_writers((self._writer,), self._durability)
+
+    def close(self):
+        self._writer.close()
+
+        if self._compactor:
+            self._compactor.stop()
 
     @tornado.gen.coroutine
     def _run(self):
         sleep_time = RECONNECT_MIN_INTERVAL
 
-        while True:
+        while self._running:
             start_time = time.time()
             try:
                 yield self._run_session()
-            except tornado.websocket.WebSocketError:
+            except (tornado.websocket.WebSocketError,
+                    tornado.httpclient.HTTPClientError, OSError):
                 _logger.exception('Websocket error')
 
+            if not self._running:
+                break
+
             end_time = time.time()
 
             if end_time - start_time < RECONNECT_SUCCESS_THRESHOLD:
@@ -74,12 +148,25 @@ class Client(object):
 
             _logger.info("Sleeping for %s seconds", sleep_time)
 
-            yield tornado.gen.sleep(sleep_time)
+            try:
+                yield self._stop_event.wait(
+                    datetime.timedelta(seconds=sleep_time))
+            except tornado.util.TimeoutError:
+                pass
+
+        self._write_line('logend {}'.format(self._channel_id), internal=True)
+        self._writer.flush()
 
     @tornado.gen.coroutine
     def _run_session(self):
         conn = yield tornado.websocket.websocket_connect(self._url)
 
+        if not self._running:
+            conn.close()
+            return
+
+        self._conn = conn
+
         _logger.info("Join channel %s", self._channel_id)
 
         self._write_line('logstart {}'.format(self._channel_id),
@@ -92,13 +179,18 @@ class Client(object):
             "id": 1
         }))
 
-        while True:
-            msg = yield conn.read_message()
+        try:
+            while True:
+                msg = yield conn.read_message()
 
-            if msg is None:
-                break
+                if msg is None:
+                    break
+
+                self._write_line(msg)
+        finally:
+            self._conn = None
 
-            self._write_line(msg)
+        self._writer.flush()
 
     def _write_line(self, msg, internal=False):
         if internal:
@@ -107,32 +199,227 @@ class Client(object):
             prefix = ''
 
         writer = self._writer
+        timestamp = default_clock.now()
         line = '{prefix}{date} {text}'.format(
             prefix=prefix,
-            date=datetime.datetime.utcnow().isoformat(),
+            date=default_clock.format(timestamp),
             text=msg
         )
-        writer.write_line(line)
+        writer.write_line(line, timestamp)
+
+
+def read_channel_ids(path):
+    channel_ids = []
+
+    with open(path, 'r') as file:
+        for line in file:
+            line = line.strip()
+
+            if line:
+                channel_ids.append(int(line))
+
+    return channel_ids
+
+
+class MultiClient(object):
+    '''Logs every channel listed in a channels file from one IOLoop.
+
+    Each channel has its own websocket session, reconnect backoff and log
+    writer. Channels added to or removed from the file are started or
+    stopped.
+    '''
+    def __init__(self, url, channels_file, log_dir, flush_size=None,
+                 flush_interval=None, compression=None, compact=None,
+                 durability=DURABILITY_NONE, sync_interval=SYNC_INTERVAL,
+                 segment_size=None, segment_interval=None):
+        self._url = url
+        self._channels_file = channels_file
+        self._channels_watcher = ChannelsFileWatcher(channels_file)
+        self._log_dir = log_dir
+        self._client_kwargs = dict(
+            flush_size=flush_size,
+            flush_interval=flush_interval,
+            compression=compression,
+            durability=durability,
+            sync_interval=sync_interval,
+            segment_size=segment_size,
+            segment_interval=segment_interval
+        )
+        self._flush_interval = flush_interval
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._compactor = Compactor(compact) if compact else None
+        self._clients = {}
+        self._futures = {}
+        self._stop_event = tornado.locks.Event()
+
+    def run(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        callbacks = [tornado.ioloop.PeriodicCallback(
+            self._load_channels,
+            self._channels_watcher.poll_interval * 1000)]
+
+        if self._flush_interval:
+            callbacks.append(tornado.ioloop.PeriodicCallback(
+                self._flush_due, self._flush_interval * 1000))
+
+        if self._durability in (DURABILITY_PERIODIC, DURABILITY_GROUP):
+            callbacks.append(tornado.ioloop.PeriodicCallback(
+                self._sync, self._sync_interval * 1000))
+
+        for callback in callbacks:
+            callback.start()
+
+        try:
+            io_loop.run_sync(self._run)
+        finally:
+            for callback in callbacks:
+                callback.stop()
+
+            self._channels_watcher.close()
+
+            if self._compactor:
+                self._compactor.stop()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @tornado.gen.coroutine
+    def _run(self):
+        self._load_channels()
+
+        yield self._stop_event.wait()
+
+        for channel_id in tuple(self._clients):
+            self._stop_client(channel_id)
+
+        yield list(self._futures.values())
+
+    def _load_channels(self):
+        if not self._channels_watcher.changed():
+            return
+
+        channel_ids = read_channel_ids(self._channels_file)
+        added, removed = diff_channels(frozenset(self._clients), channel_ids)
+
+        for channel_id in removed:
+            self._stop_client(channel_id)
+
+        for channel_id in added:
+            self._start_client(channel_id)
+
+    def _start_client(self, channel_id):
+        _logger.info('Starting channel %s.', channel_id)
+
+        client = Client(self._url, channel_id, self._log_dir,
+                        compactor=self._compactor, **self._client_kwargs)
+        future = client.start()
+        self._clients[channel_id] = client
+        self._futures[channel_id] = future
+
+        tornado.ioloop.IOLoop.current().add_future(
+            future, lambda future: self._on_client_done(channel_id, client))
+
+    def _stop_client(self, channel_id):
+        _logger.info('Stopping channel %s.', channel_id)
+        self._clients.pop(channel_id).stop()
+
+    def _on_client_done(self, channel_id, client):
+        client.close()
+
+        if self._futures.get(channel_id) and \
+                self._futures[channel_id].done():
+            del self._futures[channel_id]
+
+    def _flush_due(self):
+        for client in self._clients.values():
+            client.flush_due()
+
+    def _sync(self):
+        sync_writers([client.writer for client in self._clients.values()],
+                     self._durability)
 
 
 def main():
     arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('channel_id', type=int)
+    arg_parser.add_argument('channel_id', type=int, nargs='?')
     arg_parser.add_argument('log_dir')
+    arg_parser.add_argument('--channels-file', metavar='PATH',
+                            help='log the channel IDs listed in PATH, one '
+                                 'per line, instead of CHANNEL_ID')
     arg_parser.add_argument('--url', default='wss://chat2-dal07.beam.pro:443')
+    arg_parser.add_argument('--flush-size', type=int, metavar='BYTES',
+                            help='buffer log lines and flush after BYTES')
+    arg_parser.add_argument('--flush-interval', type=float, metavar='SECONDS',
+                            help='buffer log lines and flush after SECONDS')
+    arg_parser.add_argument('--compression', choices=('gzip', 'zstd'),
+                            help='write compressed log files')
+    arg_parser.add_argument('--compact', choices=('gzip', 'zstd'),
+                            help='compress log files of previous days')
+    arg_parser.add_argument('--durability', choices=DURABILITY_POLICIES,
+                            default=DURABILITY_NONE,
+                            help='when to fsync log files')
+    arg_parser.add_argument('--sync-interval', type=float,
+                            default=SYNC_INTERVAL, metavar='SECONDS',
+                            help='fsync every SECONDS with the periodic and '
+                                 'group policies')
+    arg_parser.add_argument('--segment-size', type=int, metavar='BYTES',
+                            help='start a new log file segment after BYTES '
+                                 '(uncompressed)')
+    arg_parser.add_argument('--segment-interval', type=float,
+                            metavar='SECONDS',
+                            help='start a new log file segment every SECONDS')
 
     args = arg_parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
 
+    if (args.channel_id is None) == (args.channels_file is None):
+        sys.exit('provide either a channel ID or a channels file.')
+
     if not os.path.isdir(args.log_dir):
         sys.exit('log dir provided is not a directory.')
 
+    if args.channels_file and not os.path.isfile(args.channels_file):
+        sys.exit('channels file provided is not a file.')
+
+    if args.compression and args.compact:
+        sys.exit('--compression and --compact cannot be combined.')
+
+    if 'zstd' in (args.compression, args.compact) and not zstandard:
+        sys.exit('zstd requires the zstandard library.')
+
     _logger.info('Starting websocket client.')
 
-    channel_ids = []
+    if args.channels_file:
+        client = MultiClient(args.url, args.channels_file, args.log_dir,
+                             flush_size=args.flush_size,
+                             flush_interval=args.flush_interval,
+                             compression=args.compression,
+                             compact=args.compact,
+                             durability=args.durability,
+                             sync_interval=args.sync_interval,
+                             segment_size=args.segment_size,
+                             segment_interval=args.segment_interval)
+    else:
+        client = Client(args.url, args.channel_id, args.log_dir,
+                        flush_size=args.flush_size,
+                        flush_interval=args.flush_interval,
+                        compression=args.compression,
+                        compact=args.compact,
+                        durability=args.durability,
+                        sync_interval=args.sync_interval,
+                        segment_size=args.segment_size,
+                        segment_interval=args.segment_interval)
+
+    io_loop = tornado.ioloop.IOLoop.current()
+
+    def stop(dummy1, dummy2):
+        io_loop.add_callback_from_signal(client.stop)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
 
-    client = Client(args.url, args.channel_id, args.log_dir)
     client.run()
 
     _logger.info('Stopped websocket client.')
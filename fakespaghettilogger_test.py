@@ -0,0 +1,84 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+import tornado.websocket
+
+from fakespaghettilogger import MultiClient
+from spaghettilogreader import parse_timestamp
+
+
+class TestMultiClient(unittest.TestCase):
+    def test_multi_client(self):
+        auths = []
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channels_file_path = os.path.join(temp_dir, 'channels.txt')
+            log_dir = os.path.join(temp_dir, 'logs')
+
+            os.mkdir(log_dir)
+
+            with open(channels_file_path, 'w') as file:
+                file.write('1\n2\n')
+
+            class Handler(tornado.websocket.WebSocketHandler):
+                def on_message(self, message):
+                    channel_id = json.loads(message)['arguments'][0]
+                    auths.append(channel_id)
+
+                    for index in range(3):
+                        self.write_message(json.dumps(
+                            {'channel': channel_id, 'index': index}))
+
+                    if len(auths) == 2:
+                        self._remove_channel()
+
+                def _remove_channel(self):
+                    with open(channels_file_path + '.tmp', 'w') as file:
+                        file.write('2\n')
+
+                    os.replace(channels_file_path + '.tmp',
+                               channels_file_path)
+
+                    tornado.ioloop.IOLoop.current().call_later(
+                        2, client.stop)
+
+            sock, port = tornado.testing.bind_unused_port()
+            server = tornado.httpserver.HTTPServer(
+                tornado.web.Application([('/', Handler)]))
+            server.add_sockets([sock])
+
+            client = MultiClient('ws://127.0.0.1:{}/'.format(port),
+                                 channels_file_path, log_dir)
+
+            try:
+                client.run()
+            finally:
+                server.stop()
+
+            self.assertEqual([1, 2], sorted(auths))
+            logend_times = []
+
+            for channel_id in (1, 2):
+                paths = glob.glob(os.path.join(log_dir, str(channel_id),
+                                               '*.log'))
+
+                with open(paths[0]) as file:
+                    lines = file.read().splitlines()
+
+                self.assertEqual(5, len(lines))
+                self.assertRegex(lines[0], '# .* logstart {}'.format(
+                    channel_id))
+                self.assertIn('"index": 2', lines[3])
+                self.assertRegex(lines[4], '# .* logend {}'.format(
+                    channel_id))
+                logend_times.append(parse_timestamp(lines[4].split()[1]))
+
+            # Removing channel 1 from the file stopped it before the rest
+            self.assertGreater(logend_times[1] - logend_times[0], 0.5)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+'''Benchmark the Twitch.tv chat logger against a local fake TMI server'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import argparse
+import array
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socketserver
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+import spaghettilogger
+from spaghettilogger import ChatLogger, Client, BACKPRESSURE_POLICIES, \
+    BACKPRESSURE_BLOCK, DURABILITY_POLICIES, DURABILITY_NONE, SYNC_INTERVAL, \
+    NAME_CACHE_SIZE
+
+_logger = logging.getLogger(__name__)
+
+END_MARKER = 'bench-end'
+SEND_BATCH_SIZE = 100
+PERCENTILES = (50, 90, 99, 99.9)
+NICKNAME = 'justinfan1234'
+
+_BADGES = ('', 'subscriber/12', 'moderator/1', 'premium/1',
+           'subscriber/3,premium/1', 'vip/1', 'broadcaster/1')
+_COLORS = ('', '#FF0000', '#0000FF', '#008000', '#B22222', '#FF7F50')
+_WORDS = ('Kappa', 'PogChamp', 'LUL', 'hello', 'gg', 'wp', 'what', 'is',
+          'this', 'stream', 'KEKW', 'monkaS', 'lol', 'nice', 'play', 'ResidentSleeper')
+
+
+def generate_traffic(channel_count, message_count, seed=0):
+    '''Return channel names and synthetic raw IRC lines with Twitch tags.'''
+    rand = random.Random(seed)
+    channels = ['#bench_channel{}'.format(index)
+                for index in range(channel_count)]
+    room_ids = [str(100000 + index) for index in range(channel_count)]
+    users = [('user{}'.format(index), str(5000000 + index))
+             for index in range(max(100, message_count // 20))]
+    lines = []
+    timestamp = 1500000000000
+
+    for dummy in range(message_count):
+        # Roughly Zipf distributed like real channel popularity
+        channel_index = min(channel_count - 1,
+                            int(rand.paretovariate(1.2)) - 1)
+        channel = channels[channel_index]
+        room_id = room_ids[channel_index]
+        nick, user_id = rand.choice(users)
+        timestamp += rand.randint(0, 50)
+        kind = rand.random()
+
+        if kind < 0.95:
+            message = ' '.join(rand.choice(_WORDS)
+                               for dummy in range(rand.randint(1, 12)))
+            line = (
+                '@badge-info=;badges={badges};color={color};'
+                'display-name={display_name};emotes=;flags=;id={id};mod=0;'
+                'room-id={room_id};subscriber=0;tmi-sent-ts={timestamp};'
+                'turbo=0;user-id={user_id};user-type= '
+                ':{nick}!{nick}@{nick}.tmi.twitch.tv PRIVMSG {channel} '
+                ':{message}'
+            ).format(
+                badges=rand.choice(_BADGES), color=rand.choice(_COLORS),
+                display_name=nick.capitalize(), id=uuid.UUID(int=rand.getrandbits(128)),
+                room_id=room_id, timestamp=timestamp, user_id=user_id,
+                nick=nick, channel=channel, message=message
+            )
+        elif kind < 0.97:
+            line = (
+                '@badge-info=subscriber/6;badges=subscriber/6;color=;'
+                'display-name={display_name};emotes=;flags=;id={id};'
+                'login={nick};mod=0;msg-id=resub;msg-param-cumulative-months=6;'
+                'room-id={room_id};subscriber=1;'
+                'system-msg={display_name}\\ssubscribed\\sfor\\s6\\smonths!;'
+                'tmi-sent-ts={timestamp};user-id={user_id};user-type= '
+                ':tmi.twitch.tv USERNOTICE {channel} :Great stream'
+            ).format(
+                display_name=nick.capitalize(), id=uuid.UUID(int=rand.getrandbits(128)),
+                nick=nick, room_id=room_id, timestamp=timestamp,
+                user_id=user_id, channel=channel
+            )
+        elif kind < 0.98:
+            line = (
+                '@ban-duration=600;room-id={room_id};target-user-id={user_id};'
+                'tmi-sent-ts={timestamp} :tmi.twitch.tv CLEARCHAT {channel} '
+                ':{nick}'
+            ).format(room_id=room_id, user_id=user_id, timestamp=timestamp,
+                     channel=channel, nick=nick)
+        elif kind < 0.99:
+            line = ':{0}!{0}@{0}.tmi.twitch.tv JOIN {1}'.format(nick, channel)
+        else:
+            line = ':{0}!{0}@{0}.tmi.twitch.tv PART {1}'.format(nick, channel)
+
+        lines.append(line)
+
+    return channels, lines
+
+
+def read_traffic(path):
+    '''Return channel names and raw IRC lines recorded in a file.'''
+    channels = []
+    seen_channels = set()
+    lines = []
+
+    with open(path, 'r', encoding='latin-1') as file:
+        for line in file:
+            line = line.rstrip('\r\n')
+
+            if not line:
+                continue
+
+            dummy, dummy, command, arguments = spaghettilogger.parse_line(line)
+
+            if command in ('PRIVMSG', 'NOTICE', 'USERNOTICE', 'CLEARCHAT',
+                           'CLEARMSG', 'JOIN', 'PART') and arguments:
+                channel = arguments[0].lower()
+
+                if channel not in seen_channels:
+                    seen_channels.add(channel)
+                    channels.append(channel)
+
+            lines.append(line)
+
+    return channels, lines
+
+
+def _run_server(port_queue, channels, lines, rate):
+    # Runs in its own process so it doesn't compete with the client for
+    # the GIL
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.rfile.readline()
+            self.rfile.readline()
+
+            self.wfile.write(
+                ':tmi.twitch.tv 001 {0} :Welcome, GLHF!\r\n'.format(NICKNAME)
+                .encode())
+
+            pending_channels = set(channels)
+
+            while pending_channels:
+                line = self.rfile.readline()
+
+                if not line:
+                    return
+
+                if line.startswith(b'JOIN '):
+                    for channel in line.decode().split()[1].split(','):
+                        pending_channels.discard(channel)
+                        self.wfile.write(
+                            ':{0}!{0}@{0}.tmi.twitch.tv JOIN {1}\r\n'
+                            .format(NICKNAME, channel).encode())
+
+            start_time = time.perf_counter()
+
+            for index in range(0, len(lines), SEND_BATCH_SIZE):
+                self.wfile.write(b''.join(
+                    line.encode('latin-1') + b'\r\n'
+                    for line in lines[index:index + SEND_BATCH_SIZE]
+                ))
+
+                if rate:
+                    delay = start_time + (index + SEND_BATCH_SIZE) / rate - \
+                        time.perf_counter()
+
+                    if delay > 0:
+                        time.sleep(delay)
+
+            self.wfile.write('PING :{}\r\n'.format(END_MARKER).encode())
+
+            while True:
+                line = self.rfile.readline()
+
+                if not line or END_MARKER.encode() in line:
+                    return
+
+    server = socketserver.TCPServer(('localhost', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.handle_request()
+    server.server_close()
+
+
+class BenchChatLogger(ChatLogger):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.line_count = 0
+        self.first_line_time = None
+        self.latencies = array.array('d')
+
+    def _write_line(self, channel, text, internal=False, source=None):
+        start_time = time.perf_counter()
+
+        super()._write_line(channel, text, internal=internal, source=source)
+
+        if not internal:
+            end_time = time.perf_counter()
+
+            if not self.line_count:
+                self.first_line_time = start_time
+
+            self.line_count += 1
+            self.latencies.append(end_time - start_time)
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1,
+                int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def _current_rss_kb():
+    try:
+        with open('/proc/self/statm') as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def run_benchmark(channels, lines, rate=0, timeout=600, chat_logger_kwargs=None,
+                  fast_path=False):
+    '''Run the client against a fake server and return the measurements.'''
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=_run_server, args=(port_queue, channels, lines, rate))
+    server_process.start()
+    port = port_queue.get()
+
+    done = False
+
+    def on_ping(connection, event):
+        nonlocal done
+
+        if event.target == END_MARKER:
+            done = True
+
+    # The benchmark measures the write path so don't wait on the join rate
+    original_rate_limit = spaghettilogger.IRC_RATE_LIMIT
+    spaghettilogger.IRC_RATE_LIMIT = float('+inf')
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channels_file_path = os.path.join(temp_dir, 'channels.txt')
+            log_dir = os.path.join(temp_dir, 'logs')
+
+            os.mkdir(log_dir)
+
+            with open(channels_file_path, 'w') as file:
+                file.write('\n'.join(channels))
+
+            chat_logger = BenchChatLogger(log_dir, **(chat_logger_kwargs or {}))
+            client = Client(chat_logger, channels_file_path,
+                            fast_path=fast_path, join_rate=float('+inf'))
+            client.reactor.add_global_handler('ping', on_ping)
+
+            usage_start = resource.getrusage(resource.RUSAGE_SELF)
+            start_time = time.perf_counter()
+
+            client.autoconnect('localhost', port, NICKNAME)
+
+            while not done and time.perf_counter() - start_time < timeout:
+                client.reactor.process_once(0.2)
+
+            rss_kb = _current_rss_kb()
+            client.stop()
+
+            end_time = time.perf_counter()
+            usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        spaghettilogger.IRC_RATE_LIMIT = original_rate_limit
+        server_process.join(10)
+
+        if server_process.is_alive():
+            server_process.terminate()
+
+    if not done:
+        _logger.warning('Benchmark timed out.')
+
+    cpu_seconds = (usage_end.ru_utime - usage_start.ru_utime +
+                   usage_end.ru_stime - usage_start.ru_stime)
+    wall_seconds = end_time - start_time
+
+    if chat_logger.first_line_time:
+        duration = end_time - chat_logger.first_line_time
+    else:
+        duration = wall_seconds
+
+    latencies = sorted(chat_logger.latencies)
+
+    return {
+        'channels': len(channels),
+        'lines_sent': len(lines),
+        'lines_logged': chat_logger.line_count,
+        'completed': done,
+        'duration': duration,
+        'lines_per_second': chat_logger.line_count / duration if duration else None,
+        'write_latency_us': dict(
+            [('p{}'.format(percent), percentile(latencies, percent) * 1e6
+              if latencies else None) for percent in PERCENTILES] +
+            [('max', latencies[-1] * 1e6 if latencies else None)]
+        ),
+        'cpu_seconds': cpu_seconds,
+        'cpu_percent': cpu_seconds / wall_seconds * 100 if wall_seconds else None,
+        'rss_kb': rss_kb,
+        'max_rss_kb': usage_end.ru_maxrss,
+    }
+
+
+class RecordingChatLogger(ChatLogger):
+    '''Keeps the arguments of every logged event instead of writing them.'''
+    def __init__(self):
+        super().__init__(None)
+        self.events = []
+
+    def _record(self, *args, **kwargs):
+        self.events.append(args)
+
+    log_message = log_mode = log_notice = log_usernotice = log_clearchat = \
+        log_clearmsg = log_join = log_part = _record
+
+
+def measure_allocations(lines, name_cache_size=NAME_CACHE_SIZE):
+    '''Return the memory blocks allocated and kept per handled line.
+
+    Lines go through the client's raw line handlers and the logged event
+    arguments are kept, so a lowercased name that is built again for every
+    line shows up as a block per line.
+    '''
+    client = Client(RecordingChatLogger(), fast_path=True,
+                    name_cache_size=name_cache_size)
+    process_line = client._process_fast_line
+
+    tracemalloc.start()
+
+    try:
+        for line in lines:
+            process_line(line)
+
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    start_time = time.perf_counter()
+
+    for line in lines:
+        process_line(line)
+
+    duration = time.perf_counter() - start_time
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+
+    return {
+        'lines': len(lines),
+        'blocks_per_line': blocks / len(lines),
+        'handler_us': duration / len(lines) * 1e6,
+    }
+
+
+def compare_results(old_results, new_results):
+    '''Yield a line comparing each run with the same channel count.'''
+    old_runs = {run['channels']: run for run in old_results['runs']}
+
+    for run in new_results['runs']:
+        old_run = old_runs.get(run['channels'])
+
+        if not old_run:
+            continue
+
+        def change(old_value, new_value):
+            if not old_value or new_value is None:
+                return 'n/a'
+
+            return '{:+.1f}%'.format((new_value - old_value) / old_value * 100)
+
+        yield '{} channels: {} lines/s, {} p99 write latency'.format(
+            run['channels'],
+            change(old_run['lines_per_second'], run['lines_per_second']),
+            change(old_run['write_latency_us']['p99'],
+                   run['write_latency_us']['p99'])
+        )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--channels', default='1,100,1000,10000',
+                            help='comma separated channel counts to run')
+    arg_parser.add_argument('--messages', type=int, default=100000,
+                            help='number of synthetic lines per run')
+    arg_parser.add_argument('--replay', metavar='FILE',
+                            help='replay raw IRC lines recorded in FILE '
+                                 'instead of synthetic traffic')
+    arg_parser.add_argument('--rate', type=float, default=0,
+                            help='lines per second to send (0 for unlimited)')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--timeout', type=float, default=600)
+    arg_parser.add_argument('--output', metavar='FILE',
+                            help='write results as JSON to FILE')
+    arg_parser.add_argument('--compare', metavar='FILE',
+                            help='compare against results from a previous run')
+    arg_parser.add_argument('--fast-path', action='store_true')
+    arg_parser.add_argument('--flush-size', type=int)
+    arg_parser.add_argument('--flush-interval', type=float)
+    arg_parser.add_argument('--writer-queue', type=int)
+    arg_parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES,
+                            default=BACKPRESSURE_BLOCK)
+    arg_parser.add_argument('--max-open-files', type=int)
+    arg_parser.add_argument('--compression', choices=('gzip', 'zstd'))
+    arg_parser.add_argument('--durability', choices=DURABILITY_POLICIES,
+                            default=DURABILITY_NONE)
+    arg_parser.add_argument('--sync-interval', type=float,
+                            default=SYNC_INTERVAL)
+    arg_parser.add_argument('--allocations', action='store_true',
+                            help='measure memory allocations per line of '
+                                 'the handlers with and without the name '
+                                 'cache instead')
+
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    chat_logger_kwargs = {
+        'flush_size': args.flush_size,
+        'flush_interval': args.flush_interval,
+        'queue_size': args.writer_queue,
+        'backpressure': args.backpressure,
+        'max_open_files': args.max_open_files,
+        'compression': args.compression,
+        'durability': args.durability,
+        'sync_interval': args.sync_interval,
+    }
+
+    if args.replay:
+        traffic = [read_traffic(args.replay)]
+    else:
+        traffic = (
+            generate_traffic(int(count), args.messages, seed=args.seed)
+            for count in args.channels.split(',')
+        )
+
+    if args.allocations:
+        for channels, lines in traffic:
+            for label, size in (('uncached', 0), ('cached', NAME_CACHE_SIZE)):
+                result = measure_allocations(lines, size)
+                print('{channels} channels, {label}: {blocks_per_line:.2f} '
+                      'blocks/line, {handler_us:.2f} us/line'.format(
+                          channels=len(channels), label=label, **result))
+
+        return
+
+    runs = []
+
+    for channels, lines in traffic:
+        result = run_benchmark(channels, lines, rate=args.rate,
+                               timeout=args.timeout,
+                               chat_logger_kwargs=chat_logger_kwargs,
+                               fast_path=args.fast_path)
+        runs.append(result)
+
+        print('{channels} channels: {lines_per_second:.0f} lines/s, '
+              'p50 {p50:.1f} us, p99 {p99:.1f} us, CPU {cpu_percent:.0f}%, '
+              'RSS {rss_kb} KiB'.format(
+                  p50=result['write_latency_us']['p50'] or 0,
+                  p99=result['write_latency_us']['p99'] or 0,
+                  **result))
+
+    results = {
+        'version': spaghettilogger.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'config': dict(vars(args)),
+        'runs': runs,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            old_results = json.load(file)
+
+        for line in compare_results(old_results, results):
+            print(line)
+
+    if not all(run['completed'] for run in runs):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+import unittest
+
+from spaghettibench import generate_traffic, run_benchmark, \
+    measure_allocations
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        channels, lines = generate_traffic(5, 500)
+
+        self.assertEqual(5, len(channels))
+        self.assertEqual(500, len(lines))
+
+        result = run_benchmark(channels, lines, timeout=30)
+
+        self.assertTrue(result['completed'])
+        # Our own JOIN for each channel is logged as well
+        self.assertEqual(505, result['lines_logged'])
+        self.assertGreater(result['lines_per_second'], 0)
+        self.assertIsNotNone(result['write_latency_us']['p99'])
+
+    def test_allocations(self):
+        channels, lines = generate_traffic(5, 2000)
+        uncached = measure_allocations(lines, name_cache_size=0)
+        cached = measure_allocations(lines)
+
+        self.assertEqual(2000, cached['lines'])
+        self.assertLess(cached['blocks_per_line'],
+                        uncached['blocks_per_line'] - 1)
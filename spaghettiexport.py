@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+'''Export Spaghetti Logger log directories to columnar files'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+
+from spaghettilogreader import iter_lines, parse_timestamp
+from spaghettisearch import Query, find_log_files, parse_log_line, \
+    unescape_tag_value
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+_logger = logging.getLogger(__name__)
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_SQLITE = 'sqlite'
+SQLITE_FILENAME = 'export.sqlite'
+MANIFEST_FILENAME = 'manifest.json'
+# Rows read and written at a time, which bounds memory use on busy days
+BATCH_SIZE = 65536
+# Tags that are parsed for their own columns (and the nick of some events).
+# Every tag stays in the tags column.
+PARSED_TAGS = ('id', 'user-id', 'room-id', 'badges', 'emotes', 'msg-id',
+               'login')
+TAG_PATTERN = re.compile(
+    r'(?:^|;)({})=([^;]*)'.format('|'.join(map(re.escape, PARSED_TAGS))))
+# Name, SQLite type and Arrow type name of each column
+COLUMNS = (
+    ('channel', 'TEXT', 'string'),
+    ('date', 'TEXT', 'string'),
+    ('timestamp', 'REAL', 'timestamp'),
+    ('event_type', 'TEXT', 'string'),
+    ('nick', 'TEXT', 'string'),
+    ('message', 'TEXT', 'string'),
+    ('id', 'TEXT', 'string'),
+    ('user_id', 'INTEGER', 'int64'),
+    ('room_id', 'INTEGER', 'int64'),
+    ('badges', 'TEXT', 'string'),
+    ('emotes', 'TEXT', 'string'),
+    ('msg_id', 'TEXT', 'string'),
+    ('tags', 'TEXT', 'string'),
+)
+COLUMN_NAMES = tuple(column[0] for column in COLUMNS)
+
+
+class ExportError(ValueError):
+    pass
+
+
+class TimestampParser(object):
+    '''Parses log line timestamps, reusing the last parsed second.'''
+    def __init__(self):
+        self._second_text = None
+        self._second = None
+
+    def parse(self, text):
+        second_text, dummy, fraction = text.partition('.')
+
+        if second_text != self._second_text:
+            self._second = parse_timestamp(second_text)
+            self._second_text = second_text
+
+        if fraction:
+            return self._second + float('0.' + fraction)
+
+        return self._second
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def iter_rows(path, channel, date_string, encoding='utf-8'):
+    '''Yield a tuple of column values for each chat line of a log file.
+
+    Internal lines such as logstart and logend are skipped.
+    '''
+    timestamp_parser = TimestampParser()
+
+    for line in iter_lines(path, encoding, 'replace'):
+        if not line or line.startswith('# '):
+            continue
+
+        timestamp, event_type, raw_tags, nick, message = parse_log_line(line)
+
+        try:
+            timestamp = timestamp_parser.parse(timestamp)
+        except ValueError:
+            _logger.warning('Skipped malformed line in %s: %r', path, line)
+            continue
+
+        # Only the tags with columns are parsed
+        if raw_tags:
+            tags = dict(TAG_PATTERN.findall(raw_tags))
+
+            if '\\' in raw_tags:
+                tags = dict((key, unescape_tag_value(value))
+                            for key, value in tags.items())
+        else:
+            tags = {}
+
+        if not nick and event_type in ('usernotice', 'clearmsg'):
+            nick = tags.get('login')
+
+        get_tag = tags.get
+
+        yield (
+            channel, date_string, timestamp, event_type, nick, message,
+            get_tag('id') or None, _to_int(get_tag('user-id')),
+            _to_int(get_tag('room-id')), get_tag('badges') or None,
+            get_tag('emotes') or None, get_tag('msg-id') or None,
+            raw_tags or None
+        )
+
+
+def iter_batches(files, encoding='utf-8', batch_size=BATCH_SIZE):
+    '''Yield the rows of log files as lists of columns of up to batch_size
+    rows each.'''
+    columns = tuple([] for dummy in COLUMNS)
+    appends = tuple(column.append for column in columns)
+
+    for date_string, channel, path in files:
+        for row in iter_rows(path, channel, date_string, encoding):
+            for append, value in zip(appends, row):
+                append(value)
+
+            if len(columns[0]) >= batch_size:
+                yield columns
+                columns = tuple([] for dummy in COLUMNS)
+                appends = tuple(column.append for column in columns)
+
+    if columns[0]:
+        yield columns
+
+
+def _parquet_schema():
+    fields = []
+
+    for name, sql_type, arrow_type in COLUMNS:
+        if arrow_type == 'timestamp':
+            fields.append((name, pyarrow.timestamp('us', tz='UTC')))
+        else:
+            fields.append((name, getattr(pyarrow, arrow_type)()))
+
+    return pyarrow.schema(fields)
+
+
+def _to_table(columns, schema):
+    arrays = []
+
+    for (name, sql_type, arrow_type), values in zip(COLUMNS, columns):
+        if arrow_type == 'timestamp':
+            array = pyarrow.array(
+                [int(round(value * 1000000)) for value in values],
+                pyarrow.int64()
+            ).cast(pyarrow.timestamp('us', tz='UTC'))
+        else:
+            array = pyarrow.array(values, getattr(pyarrow, arrow_type)())
+
+        arrays.append(array)
+
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def write_parquet(path, batches):
+    '''Write batches of columns to a Parquet file and return the number of
+    rows.'''
+    if not pyarrow:
+        raise ValueError('pyarrow library is not installed')
+
+    schema = _parquet_schema()
+    temp_path = path + '.tmp'
+    row_count = 0
+
+    with pyarrow.parquet.ParquetWriter(temp_path, schema,
+                                       compression='zstd') as writer:
+        for columns in batches:
+            writer.write_table(_to_table(columns, schema))
+            row_count += len(columns[0])
+
+    os.replace(temp_path, path)
+
+    return row_count
+
+
+def write_sqlite(path, batches):
+    '''Write batches of columns to a SQLite file and return the number of
+    rows.'''
+    if os.path.exists(path):
+        os.remove(path)
+
+    connection = sqlite3.connect(path)
+    row_count = 0
+
+    try:
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        _create_table(connection)
+
+        for columns in batches:
+            connection.executemany(
+                'INSERT INTO lines VALUES ({})'.format(
+                    ', '.join('?' * len(COLUMNS))),
+                zip(*columns)
+            )
+            row_count += len(columns[0])
+
+        connection.commit()
+    finally:
+        connection.close()
+
+    return row_count
+
+
+def _create_table(connection, schema='main'):
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS {}.lines ({})'.format(
+            schema,
+            ', '.join('{} {}'.format(name, sql_type)
+                      for name, sql_type, arrow_type in COLUMNS)
+        )
+    )
+
+
+def export_files(files, output_path, output_format, encoding='utf-8'):
+    '''Export log files to a file and return the number of rows.'''
+    batches = iter_batches(files, encoding)
+
+    if output_format == FORMAT_PARQUET:
+        return write_parquet(output_path, batches)
+    else:
+        return write_sqlite(output_path, batches)
+
+
+def day_signature(files):
+    '''Return a value that changes when any of a day's log files change.'''
+    signature = []
+
+    for date_string, channel, path in files:
+        stat_result = os.stat(path)
+        signature.append([path, stat_result.st_size, stat_result.st_mtime_ns])
+
+    return signature
+
+
+def _check_channels(exported_channels, channels):
+    # A day's output holds every exported channel, so exporting it again
+    # with other channels would delete the rows of the missing ones
+    if exported_channels != channels:
+        raise ExportError(
+            'output directory holds {} but {} were requested; use another '
+            'output directory.'.format(
+                ', '.join(exported_channels or ['all channels']),
+                ', '.join(channels or ['all channels'])))
+
+
+class ParquetOutput(object):
+    '''Writes a Parquet file for each day and a manifest of what they hold.'''
+    def __init__(self, output_dir, channels=None):
+        self._output_dir = output_dir
+        self._manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self._channels = channels
+
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path) as file:
+                manifest = json.load(file)
+
+            _check_channels(manifest['channels'], channels)
+            self._manifest = manifest['days']
+        else:
+            self._manifest = {}
+
+    def is_exported(self, date_string, signature):
+        return self._manifest.get(date_string) == signature and \
+            os.path.exists(self.day_path(date_string))
+
+    def day_path(self, date_string):
+        return os.path.join(self._output_dir, date_string + '.parquet')
+
+    def part_path(self, date_string, index):
+        return os.path.join(self._output_dir,
+                            '{}.{:04d}.part.parquet'.format(date_string, index))
+
+    def add_day(self, date_string, signature, part_paths):
+        if len(part_paths) == 1:
+            os.replace(part_paths[0], self.day_path(date_string))
+        else:
+            temp_path = self.day_path(date_string) + '.tmp'
+
+            with pyarrow.parquet.ParquetWriter(
+                    temp_path, _parquet_schema(),
+                    compression='zstd') as writer:
+                for path in part_paths:
+                    for batch in pyarrow.parquet.ParquetFile(path) \
+                            .iter_batches(BATCH_SIZE):
+                        writer.write_batch(batch)
+
+            os.replace(temp_path, self.day_path(date_string))
+
+            for path in part_paths:
+                os.remove(path)
+
+        self._manifest[date_string] = signature
+        temp_path = self._manifest_path + '.tmp'
+
+        with open(temp_path, 'w') as file:
+            json.dump({'channels': self._channels, 'days': self._manifest},
+                      file)
+
+        os.replace(temp_path, self._manifest_path)
+
+    def close(self):
+        pass
+
+
+class SQLiteOutput(object):
+    '''Bulk loads the SQLite file of each day into one database.'''
+    def __init__(self, output_dir, channels=None):
+        self._output_dir = output_dir
+        self._connection = sqlite3.connect(
+            os.path.join(output_dir, SQLITE_FILENAME), isolation_level=None)
+        _create_table(self._connection)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS exported_days '
+            '(date TEXT PRIMARY KEY, signature TEXT)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS export_settings '
+            '(name TEXT PRIMARY KEY, value TEXT)')
+        row = self._connection.execute(
+            "SELECT value FROM export_settings WHERE name = 'channels'"
+        ).fetchone()
+
+        try:
+            if row:
+                _check_channels(json.loads(row[0]), channels)
+            else:
+                self._connection.execute(
+                    "INSERT INTO export_settings VALUES ('channels', ?)",
+                    (json.dumps(channels),))
+        except ExportError:
+            self._connection.close()
+            raise
+
+        self._manifest = dict(
+            (date_string, json.loads(signature)) for date_string, signature
+            in self._connection.execute('SELECT * FROM exported_days'))
+
+    def is_exported(self, date_string, signature):
+        return self._manifest.get(date_string) == signature
+
+    def part_path(self, date_string, index):
+        return os.path.join(self._output_dir,
+                            '{}.{:04d}.sqlite.tmp'.format(date_string, index))
+
+    def add_day(self, date_string, signature, part_paths):
+        # A day is only marked exported once all of its parts are loaded, so
+        # an interrupted export is redone on the next run
+        self._transaction(
+            ('DELETE FROM exported_days WHERE date = ?', (date_string,)),
+            ('DELETE FROM lines WHERE date = ?', (date_string,)),
+        )
+
+        for path in part_paths:
+            self._connection.execute('ATTACH DATABASE ? AS part', (path,))
+
+            try:
+                self._transaction(
+                    ('INSERT INTO lines SELECT * FROM part.lines', ()))
+            finally:
+                self._connection.execute('DETACH DATABASE part')
+
+            os.remove(path)
+
+        self._transaction(
+            ('INSERT INTO exported_days VALUES (?, ?)',
+             (date_string, json.dumps(signature))))
+        self._manifest[date_string] = signature
+
+    def _transaction(self, *statements):
+        connection = self._connection
+        connection.execute('BEGIN')
+
+        try:
+            for statement, parameters in statements:
+                connection.execute(statement, parameters)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+        connection.execute('COMMIT')
+
+    def close(self):
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS lines_channel_timestamp '
+            'ON lines (channel, timestamp)')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS lines_date ON lines (date)')
+        self._connection.close()
+
+
+def export(log_dir, output_dir, query=None, output_format=None,
+           processes=None, encoding='utf-8'):
+    '''Export the log files of days that changed since the last export.
+
+    Each log file, whether a channel's day or a segment of it, is exported
+    in parallel by a process pool, and the parts of each day are then
+    combined. Returns a list of (date, row count) tuples of the exported
+    days. Raises ExportError if the output directory was exported with
+    other channels.
+    '''
+    if output_format is None:
+        output_format = FORMAT_PARQUET if pyarrow else FORMAT_SQLITE
+
+    query = query or Query()
+    channels = sorted(query.channels) if query.channels else None
+
+    if output_format == FORMAT_PARQUET:
+        output = ParquetOutput(output_dir, channels)
+    else:
+        output = SQLiteOutput(output_dir, channels)
+
+    days = {}
+
+    for item in find_log_files(log_dir, query):
+        days.setdefault(item[0], []).append(item)
+
+    results = []
+
+    try:
+        with multiprocessing.Pool(processes) as pool:
+            tasks = []
+
+            for date_string, files in sorted(days.items()):
+                signature = day_signature(files)
+
+                if output.is_exported(date_string, signature):
+                    _logger.debug('Skipped %s, already exported.',
+                                  date_string)
+                    continue
+
+                parts = [
+                    (output.part_path(date_string, index), pool.apply_async(
+                        export_files,
+                        ([item], output.part_path(date_string, index),
+                         output_format, encoding)
+                    ))
+                    for index, item in enumerate(files)
+                ]
+                tasks.append((date_string, signature, parts))
+
+            for date_string, signature, parts in tasks:
+                row_count = sum(result.get() for path, result in parts)
+                output.add_day(date_string, signature,
+                               [path for path, result in parts])
+                results.append((date_string, row_count))
+                _logger.info('Exported %s, %s rows.', date_string, row_count)
+    finally:
+        output.close()
+
+    return results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Export log files to a Parquet file per day, or to a '
+                    'SQLite database, skipping days already exported.')
+    arg_parser.add_argument('log_dir')
+    arg_parser.add_argument('output_dir')
+    arg_parser.add_argument('--format', choices=(FORMAT_PARQUET, FORMAT_SQLITE),
+                            help='output format (default parquet if pyarrow '
+                                 'is installed, otherwise sqlite)')
+    arg_parser.add_argument('--channel', action='append', metavar='GLOB',
+                            help='export only channels matching GLOB')
+    arg_parser.add_argument('--processes', type=int,
+                            help='number of export processes')
+    arg_parser.add_argument('--encoding', default='utf-8')
+
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.isdir(args.log_dir):
+        sys.exit('log dir provided is not a directory.')
+
+    if args.format == FORMAT_PARQUET and not pyarrow:
+        sys.exit('parquet requires the pyarrow library.')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    try:
+        export(args.log_dir, args.output_dir, Query(channels=args.channel),
+               args.format, args.processes, args.encoding)
+    except ExportError as error:
+        sys.exit(str(error))
+
+if __name__ == '__main__':
+    main()
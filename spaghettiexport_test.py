@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from spaghettilogger import Clock, LineWriter
+from spaghettiexport import export, iter_batches, pyarrow, ExportError, \
+    FORMAT_PARQUET, FORMAT_SQLITE, SQLITE_FILENAME
+from spaghettisearch import Query, find_log_files
+
+
+START_TIME = 1500000000
+
+
+class TestExport(unittest.TestCase):
+    def _write_logs(self, log_dir, day, count):
+        clock = Clock()
+
+        for channel in ('#alpha', '#beta'):
+            writer = LineWriter(log_dir, channel, encoding='utf-8')
+
+            for index in range(count):
+                timestamp = START_TIME + day * 86400 + index + 0.5
+                writer.write_line(
+                    '{} privmsg badges=subscriber/12;id=msg{};room-id=1;'
+                    'user-id={} :user{} :hello ☺ {}'.format(
+                        clock.format(timestamp), index, index, index, index),
+                    timestamp
+                )
+
+            writer.write_line(
+                '{} join user0'.format(clock.format(timestamp)), timestamp)
+            writer.write_line(
+                '# {} logend {}'.format(clock.format(timestamp), channel),
+                timestamp)
+            writer.close()
+
+    def _query(self, output_dir, sql):
+        connection = sqlite3.connect(os.path.join(output_dir, SQLITE_FILENAME))
+
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                tempfile.TemporaryDirectory() as output_dir:
+            self._write_logs(log_dir, 0, 10)
+            self._write_logs(log_dir, 1, 20)
+
+            results = export(log_dir, output_dir, output_format=FORMAT_SQLITE,
+                             processes=2)
+
+            self.assertEqual([('2017-07-14', 22), ('2017-07-15', 42)],
+                             results)
+            self.assertEqual(
+                [('#alpha', '2017-07-14', START_TIME + 3.5, 'privmsg',
+                  'user3', 'hello ☺ 3', 'msg3', 3, 1, 'subscriber/12', None)],
+                self._query(
+                    output_dir,
+                    "SELECT channel, date, timestamp, event_type, nick, "
+                    "message, id, user_id, room_id, badges, emotes FROM lines "
+                    "WHERE channel = '#alpha' AND id = 'msg3' "
+                    "AND date = '2017-07-14'"))
+            self.assertEqual(
+                [('join', 'user0', None)],
+                self._query(output_dir,
+                            "SELECT event_type, nick, tags FROM lines "
+                            "WHERE event_type = 'join' LIMIT 1"))
+
+            # Only the changed day is exported again
+            self.assertEqual([], export(log_dir, output_dir,
+                                        output_format=FORMAT_SQLITE))
+
+            self._write_logs(log_dir, 1, 5)
+
+            self.assertEqual(
+                [('2017-07-15', 54)],
+                export(log_dir, output_dir, output_format=FORMAT_SQLITE))
+            self.assertEqual(
+                [(22 + 54,)],
+                self._query(output_dir, 'SELECT COUNT(*) FROM lines'))
+            self.assertFalse(
+                [name for name in os.listdir(output_dir)
+                 if name.endswith('.tmp')])
+
+    def test_batches(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            self._write_logs(log_dir, 0, 10)
+
+            files = list(find_log_files(log_dir, Query()))
+            batches = list(iter_batches(files, batch_size=7))
+
+            self.assertEqual([7, 7, 7, 1],
+                             [len(columns[0]) for columns in batches])
+            self.assertEqual(['user{}'.format(index) for index in range(7)],
+                             batches[0][4])
+
+    def test_channel_mismatch(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                tempfile.TemporaryDirectory() as output_dir:
+            self._write_logs(log_dir, 0, 10)
+
+            self.assertEqual(
+                [('2017-07-14', 11)],
+                export(log_dir, output_dir, Query(channels=['#alpha']),
+                       output_format=FORMAT_SQLITE))
+
+            with self.assertRaises(ExportError):
+                export(log_dir, output_dir, output_format=FORMAT_SQLITE)
+
+            self.assertEqual(
+                [(11,)], self._query(output_dir, 'SELECT COUNT(*) FROM lines'))
+
+    @unittest.skipUnless(pyarrow, 'requires pyarrow')
+    def test_parquet(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                tempfile.TemporaryDirectory() as output_dir:
+            self._write_logs(log_dir, 0, 10)
+            self._write_logs(log_dir, 1, 20)
+
+            results = export(log_dir, output_dir, output_format=FORMAT_PARQUET,
+                             processes=2)
+
+            self.assertEqual([('2017-07-14', 22), ('2017-07-15', 42)],
+                             results)
+
+            table = pyarrow.parquet.read_table(
+                os.path.join(output_dir, '2017-07-14.parquet'))
+            rows = table.to_pylist()
+
+            self.assertEqual(22, len(rows))
+            self.assertEqual(
+                ('#alpha', 'privmsg', 'user3', 'hello ☺ 3', 'msg3', 3, 1,
+                 'subscriber/12'),
+                tuple(rows[3][name] for name in (
+                    'channel', 'event_type', 'nick', 'message', 'id',
+                    'user_id', 'room_id', 'badges')))
+            self.assertEqual(START_TIME + 3.5,
+                             rows[3]['timestamp'].timestamp())
+            self.assertEqual('#beta', rows[-1]['channel'])
+
+            self.assertEqual([], export(log_dir, output_dir,
+                                        output_format=FORMAT_PARQUET))
+
+            self._write_logs(log_dir, 1, 5)
+
+            self.assertEqual(
+                [('2017-07-15', 54)],
+                export(log_dir, output_dir, output_format=FORMAT_PARQUET))
+
+            with self.assertRaises(ExportError):
+                export(log_dir, output_dir, Query(channels=['#beta']),
+                       output_format=FORMAT_PARQUET)
+
+            self.assertEqual(
+                ['2017-07-14.parquet', '2017-07-15.parquet',
+                 'manifest.json'],
+                sorted(os.listdir(output_dir)))
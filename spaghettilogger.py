@@ -2,16 +2,33 @@
 '''Twitch.tv Chat Logger'''
 # Copyright 2015-2018 Christopher Foo. License: GPLv3
 
+import abc
 import argparse
-import datetime
+import asyncio
+import bisect
+import codecs
+import ctypes
+import ctypes.util
+import hashlib
+import http.server
+import json
 import logging
+import multiprocessing
 import os.path
 import random
+import re
+import shutil
 import sys
 import signal
+import struct
+import tempfile
 import time
+import threading
 
-import functools
+import collections
+import gzip
+import io
+import queue
 from itertools import zip_longest
 
 import irc.client
@@ -19,139 +36,1665 @@ import irc.ctcp
 import irc.strings
 import irc.message
 
+import spaghettirecord
+from spaghettilogreader import read_manifest, MANIFEST_SUFFIX, iter_chunks, \
+    is_finished
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 _logger = logging.getLogger(__name__)
 
 __version__ = '1.2'
 
 
+FLUSH_BUFFER_SIZE = 65536
+SECONDS_PER_DAY = 86400
+COMPRESSION_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+INDEX_SUFFIX = '.idx'
+DURABILITY_NONE = 'none'
+DURABILITY_PERIODIC = 'periodic'
+DURABILITY_ROLLOVER = 'rollover'
+DURABILITY_GROUP = 'group'
+DURABILITY_POLICIES = (DURABILITY_NONE, DURABILITY_PERIODIC,
+                       DURABILITY_ROLLOVER, DURABILITY_GROUP)
+SYNC_INTERVAL = 1
+
+
+class Clock(object):
+    '''Provides timestamps for log lines.
+
+    The formatted date and time up to the second is cached so only the
+    microseconds are formatted for each line.
+    '''
+    def __init__(self):
+        self._cache = (None, None)
+
+    def now(self):
+        return time.time()
+
+    def format(self, timestamp):
+        second = int(timestamp)
+        microsecond = int((timestamp - second) * 1000000 + 0.5)
+
+        # A fraction that rounds up to a whole second carries into it
+        if microsecond >= 1000000:
+            second += 1
+            microsecond = 0
+
+        cached_second, prefix = self._cache
+
+        if second != cached_second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._cache = (second, prefix)
+
+        # Like datetime.isoformat(), omit the fraction when it is zero
+        if microsecond:
+            return '{}.{:06d}'.format(prefix, microsecond)
+        else:
+            return prefix
+
+    @staticmethod
+    def date_string(timestamp):
+        return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+    @staticmethod
+    def next_midnight(timestamp):
+        return (int(timestamp) // SECONDS_PER_DAY + 1) * SECONDS_PER_DAY
+
+
+default_clock = Clock()
+
+
+class Histogram(object):
+    '''Distribution of durations in power of two microsecond buckets.'''
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.buckets[min(31, int(value * 1000000).bit_length())] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        '''Return the upper bound of the bucket holding the percentile.'''
+        target = self.count * fraction
+        seen = 0
+
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+
+            if count and seen >= target:
+                return (1 << bucket) / 1000000
+
+        return 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Metrics(object):
+    '''Counters, gauges and histograms of the running logger.
+
+    Updates are not locked so they stay cheap on the hot path; under the
+    GIL a rare concurrent update may be lost. The stats file and HTTP
+    endpoint report the snapshot that is taken periodically.
+    '''
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.channel_lines = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self._gauges = collections.defaultdict(list)
+        self._previous = (time.time(), {})
+        self.last_snapshot = {}
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def add_gauge(self, name, func):
+        '''Report the sum of the values returned by the added functions.'''
+        self._gauges[name].append(func)
+
+    def snapshot(self):
+        now = time.time()
+        previous_time, previous_lines = self._previous
+        elapsed = max(now - previous_time, 0.001)
+        channel_lines = dict(self.channel_lines)
+        self._previous = (now, channel_lines)
+
+        self.last_snapshot = {
+            'time': now,
+            'counters': dict(self.counters),
+            'gauges': dict(
+                (name, sum(func() for func in funcs))
+                for name, funcs in self._gauges.items()
+            ),
+            'histograms': dict(
+                (name, histogram.summary())
+                for name, histogram in list(self.histograms.items())
+            ),
+            'channel_lines': channel_lines,
+            'channel_rates': dict(
+                (channel, (count - previous_lines.get(channel, 0)) / elapsed)
+                for channel, count in channel_lines.items()
+            ),
+        }
+
+        return self.last_snapshot
+
+
+class MetricsReporter(object):
+    '''Publishes metrics snapshots to a file and/or a local HTTP server.'''
+    def __init__(self, metrics, stats_file=None, port=None):
+        self._metrics = metrics
+        self._stats_file = stats_file
+        self._server = None
+
+        if port is not None:
+            reporter = self
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = json.dumps(reporter._metrics.last_snapshot)\
+                        .encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self._server = http.server.HTTPServer(('127.0.0.1', port),
+                                                  Handler)
+            thread = threading.Thread(target=self._server.serve_forever,
+                                      name='metrics-server', daemon=True)
+            thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1] if self._server else None
+
+    def update(self):
+        snapshot = self._metrics.snapshot()
+
+        if self._stats_file:
+            temp_path = self._stats_file + '.tmp'
+
+            with open(temp_path, 'w') as file:
+                json.dump(snapshot, file, indent=1, sort_keys=True)
+
+            os.replace(temp_path, self._stats_file)
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+PROFILE_INTERVAL = 0.005
+PROFILE_FILENAME = 'spaghettilogger-{}.folded'
+
+
+class SamplingProfiler(object):
+    '''Samples the stacks of all threads from a separate thread.
+
+    Samples are counted by stack in the collapsed format read by flame
+    graph tools and written to `path` when the profiler stops. Runs after
+    the first add their number before the extension of `path` so they don't
+    overwrite it. Nothing runs while it is stopped.
+    '''
+    def __init__(self, path, interval=PROFILE_INTERVAL):
+        self._path = path
+        self._interval = interval
+        self._thread = None
+        self._stopping = threading.Event()
+        self._stacks = collections.Counter()
+        self._labels = {}
+        self._run_count = 0
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def path(self):
+        '''Return the path of the current or last run.'''
+        if self._run_count <= 1:
+            return self._path
+
+        root, extension = os.path.splitext(self._path)
+
+        return '{}.{}{}'.format(root, self._run_count, extension)
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.running:
+            return
+
+        _logger.info('Started profiling.')
+        self._stacks.clear()
+        self.samples = 0
+        self._run_count += 1
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SamplingProfiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
+        _logger.info('Stopped profiling, wrote %s samples to %s.',
+                     self.samples, self.path)
+
+    def write(self):
+        path = self.path
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'w') as file:
+            for stack, count in sorted(self._stacks.items()):
+                file.write('{} {}\n'.format(stack, count))
+
+        os.replace(temp_path, path)
+
+    def _run(self):
+        own_id = threading.get_ident()
+
+        while not self._stopping.wait(self._interval):
+            names = dict((thread.ident, thread.name.replace(' ', '_'))
+                         for thread in threading.enumerate())
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stack = self._collapse(names.get(thread_id, 'thread'),
+                                           frame)
+                    self._stacks[stack] += 1
+
+            self.samples += 1
+
+    def _collapse(self, thread_name, frame):
+        labels = []
+
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+
+            if label is None:
+                label = self._labels[code] = self._label(frame)
+
+            labels.append(label)
+            frame = frame.f_back
+
+        labels.append(thread_name)
+        labels.reverse()
+
+        return ';'.join(labels)
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '?')
+
+        if module == '__main__':
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+
+        return '{}:{}'.format(
+            module, getattr(code, 'co_qualname', code.co_name))
+
+
+class FilePool(object):
+    '''Bounded set of open files shared by line writers.
+
+    When the limit is reached, the least recently used file is closed and
+    the `closed` callback it was opened with is called. It is reopened by
+    the next write.
+    '''
+    def __init__(self, max_open):
+        self._max_open = max_open
+        self._files = collections.OrderedDict()
+        self._closed_callbacks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def get(self, path):
+        return self._files.get(path)
+
+    def open(self, path, opener, closed=None):
+        file = self._files.get(path)
+
+        if file:
+            self.hits += 1
+            self._files.move_to_end(path)
+            return file
+
+        self.misses += 1
+
+        while len(self._files) >= self._max_open:
+            old_path, old_file = self._files.popitem(last=False)
+            callback = self._closed_callbacks.pop(old_path, None)
+            old_file.close()
+            self.evictions += 1
+
+            if callback:
+                callback()
+
+        file = opener(path)
+        self._files[path] = file
+
+        if closed:
+            self._closed_callbacks[path] = closed
+
+        return file
+
+    def close(self, path):
+        self._closed_callbacks.pop(path, None)
+        file = self._files.pop(path, None)
+
+        if file:
+            file.close()
+
+    def stats(self):
+        return {
+            'open': len(self._files),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def open_compressed(path, compression):
+    '''Open a binary file for appending a compressed stream.
+
+    Each flush ends a compressed block so that everything written before
+    the last flush can be read back if the process crashes.
+    '''
+    if compression == 'gzip':
+        return gzip.open(path, 'ab')
+    elif compression == 'zstd':
+        if not zstandard:
+            raise ValueError('zstandard library is not installed')
+
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'ab'))
+    else:
+        raise ValueError('unknown compression {}'.format(compression))
+
+
+# Paths this process has checked for damage from a crash
+_checked_paths = set()
+
+
+def repair_compressed(path, compression):
+    '''Rewrite a compressed log file left unfinished by a crash.
+
+    Appending to it would otherwise leave everything after the crash
+    unreadable by the gzip and zstd tools. Lines after the last flush are
+    lost. Returns whether the file was rewritten.
+    '''
+    if not os.path.exists(path) or is_finished(path):
+        return False
+
+    temp_path = path + '.tmp'
+
+    with open_compressed(temp_path, compression) as file:
+        for chunk in iter_chunks(path):
+            file.write(chunk)
+
+    os.replace(temp_path, path)
+    _logger.warning('Repaired %s, which was not closed cleanly.', path)
+
+    return True
+
+
+def repair_records(path, compression=None):
+    '''Remove a partial binary record left at the end of a file by a crash.
+
+    Returns whether the file was changed.
+    '''
+    if not os.path.exists(path):
+        return False
+
+    complete_length, length = spaghettirecord.scan_records(iter_chunks(path))
+
+    if complete_length == length:
+        return False
+
+    if not compression:
+        os.truncate(path, complete_length)
+    else:
+        temp_path = path + '.tmp'
+        remaining = complete_length
+
+        with open_compressed(temp_path, compression) as file:
+            for chunk in iter_chunks(path):
+                if remaining <= 0:
+                    break
+
+                file.write(chunk[:remaining])
+                remaining -= len(chunk)
+
+        os.replace(temp_path, path)
+
+    _logger.warning('Removed a partial record of %d bytes from the end of '
+                    '%s.', length - complete_length, path)
+
+    return True
+
+
+COMPACT_FILENAME_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})(?:\.(\d{4}))?\.(?:log|bin)$')
+
+
+class Compactor(object):
+    '''Compresses closed log files on a separate thread.'''
+    def __init__(self, compression):
+        self._compression = compression
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def submit(self, path):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run,
+                                            name='Compactor')
+            self._thread.daemon = True
+            self._thread.start()
+
+        self._queue.put(path)
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+
+            if path is None:
+                return
+
+            try:
+                self.compact(path)
+            except Exception:
+                _logger.exception('Failed to compact %s.', path)
+
+    def submit_previous(self, channel_dir, date_string, segment=None):
+        '''Compact the plain files of a channel older than a day or segment.
+
+        This catches files of days that ended while the channel was not
+        logged or the logger was not running.
+        '''
+        current = (date_string, segment or 0)
+
+        for filename in sorted(os.listdir(channel_dir)):
+            match = COMPACT_FILENAME_PATTERN.match(filename)
+
+            if not match:
+                continue
+
+            file_date, file_segment = match.groups()
+
+            if file_date < date_string or file_segment and segment and \
+                    (file_date, int(file_segment)) < current:
+                self.submit(os.path.join(channel_dir, filename))
+
+    def compact(self, path):
+        target_path = path + COMPRESSION_SUFFIXES[self._compression]
+        temp_path = target_path + '.tmp'
+
+        if not os.path.exists(path):
+            # Already compacted
+            return
+
+        if os.path.exists(target_path):
+            _logger.warning('Not compacting %s as %s exists.',
+                            path, target_path)
+            return
+
+        with open(path, 'rb') as in_file, \
+                open_compressed(temp_path, self._compression) as out_file:
+            shutil.copyfileobj(in_file, out_file, FLUSH_BUFFER_SIZE)
+
+        os.replace(temp_path, target_path)
+        os.remove(path)
+        _logger.info('Compacted %s.', path)
+
+    def stop(self):
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+def event_type(line):
+    '''Return the event type, such as privmsg or logstart, of a log line.'''
+    start = line.find(' ', 2 if line.startswith('# ') else 0) + 1
+    end = line.find(' ', start)
+
+    return line[start:end] if end >= 0 else line[start:]
+
+
+class IndexWriter(object):
+    '''Appends entries to the sidecar index of a log file.
+
+    An entry is written for the first line logged after each interval
+    boundary. It holds the timestamp and byte offset of that line and the
+    number of lines of each event type since the previous entry. A last
+    entry with the end offset is written when the log file is closed.
+    '''
+    def __init__(self, log_path, interval, encoding):
+        self._path = log_path + INDEX_SUFFIX
+        self._interval = interval
+        self._single_byte = codecs.lookup(encoding).name in \
+            ('iso8859-1', 'ascii')
+        self._encoding = encoding
+        self._counts = {}
+        self._next_entry_time = 0
+        self._last_timestamp = None
+
+        if os.path.exists(log_path):
+            self._offset = os.path.getsize(log_path)
+        else:
+            self._offset = 0
+
+    def add_line(self, line, timestamp, encoding_errors=None):
+        if timestamp >= self._next_entry_time:
+            self._write_entry(timestamp)
+            self._next_entry_time = \
+                (timestamp // self._interval + 1) * self._interval
+
+        kind = event_type(line)
+        self._counts[kind] = self._counts.get(kind, 0) + 1
+        self._last_timestamp = timestamp
+
+        if self._single_byte:
+            self._offset += len(line) + 1
+        else:
+            self._offset += len(line.encode(self._encoding,
+                                            encoding_errors or 'strict')) + 1
+
+    def _write_entry(self, timestamp):
+        with open(self._path, 'a') as file:
+            file.write('{:.6f} {} {}\n'.format(
+                timestamp, self._offset,
+                ','.join('{}:{}'.format(kind, count)
+                         for kind, count in sorted(self._counts.items()))
+            ))
+
+        self._counts = {}
+
+    def close(self):
+        if self._counts:
+            self._write_entry(self._last_timestamp)
+
+
 class LineWriter(object):
+    SUFFIX = '.log'
+
     def __init__(self, log_dir, channel_name, encoding='latin-1',
-                 encoding_errors=None):
+                 encoding_errors=None, flush_size=None, flush_interval=None,
+                 clock=None, file_pool=None, compression=None,
+                 compactor=None, index_interval=None, metrics=None,
+                 durability=DURABILITY_NONE, sync_interval=SYNC_INTERVAL,
+                 segment_size=None, segment_interval=None,
+                 retain_lines=False):
+        if compression and index_interval:
+            raise ValueError('compressed log files cannot be indexed')
+
         self._log_dir = log_dir
         self._channel_name = channel_name
         self._file = None
-        self._previous_date = None
+        self._file_pool = file_pool
+        self._path = None
+        self._clock = clock or default_clock
+        self._rollover_time = 0
         self._encoding = encoding
         self._encoding_errors = encoding_errors
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._pending_size = 0
+        self._pending_time = None
+        self._compression = compression
+        self._compactor = compactor
+        self._suffix = self.SUFFIX + COMPRESSION_SUFFIXES.get(compression, '')
+        self._index_interval = index_interval
+        self._index_writer = None
+        self._metrics = metrics
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+        self._segment_size = segment_size
+        self._segment_interval = segment_interval
+        self._date_string = None
+        self._segment = None
+        self._segment_bytes = 0
+        self._segment_start = None
+        self._retain_lines = retain_lines
+        self._retained = []
+        self._flushed_size = None
 
         channel_dir = os.path.join(log_dir, channel_name)
 
         if not os.path.exists(channel_dir):
             os.mkdir(channel_dir)
 
-    def write_line(self, line):
-        current_date = datetime.datetime.utcnow().date()
+    @property
+    def buffered(self):
+        return self._flush_size is not None or \
+            self._flush_interval is not None
 
-        if self._previous_date != current_date:
-            if self._file:
-                self._file.close()
+    def write_line(self, line, timestamp=None):
+        if timestamp is None:
+            timestamp = self._clock.now()
 
-            path = os.path.join(
-                self._log_dir,
-                self._channel_name,
-                current_date.isoformat() + '.log'
-            )
+        try:
+            if timestamp >= self._rollover_time:
+                self._rollover(timestamp, self._clock.date_string(timestamp))
 
-            self._file = open(path, 'a', encoding=self._encoding,
-                              errors=self._encoding_errors)
+            if self._segment_due(timestamp):
+                self._rollover(timestamp, self._date_string,
+                               self._segment + 1)
+        finally:
+            if self._retain_lines:
+                self._retained.append((line, timestamp))
 
         assert '\n' not in line, line
         assert '\r' not in line, line
-        self._file.write(line)
-        self._file.write('\n')
-        self._file.flush()
+
+        if self._index_writer:
+            self._index_writer.add_line(line, timestamp,
+                                        self._encoding_errors)
+
+        file = self._open_file()
+        size = self._write_record(file, line, timestamp)
+        self._unsynced = True
+
+        if not self.buffered:
+            file.flush()
+
+            if self._retain_lines:
+                self._flushed(file)
+        else:
+            if not self._pending_size:
+                self._pending_time = time.monotonic()
+
+            self._pending_size += size
+
+            if self._flush_size is not None and \
+                    self._pending_size >= self._flush_size:
+                self.flush()
+            else:
+                self.flush_due()
+
+        if self._durability == DURABILITY_PERIODIC:
+            self.sync_due()
+
+        if self._segment is not None:
+            self._segment_bytes += size
+
+    @property
+    def segmented(self):
+        return self._segment_size is not None or \
+            self._segment_interval is not None
+
+    def _rollover(self, timestamp, date_string, segment=None):
+        # Start the file of a new day or segment. Without a segment number,
+        # writing resumes in the day's last segment.
+        previous_path = self._path
+        rollover_time = self._clock.next_midnight(timestamp)
+        self.close()
+
+        self._date_string = date_string
+        channel_dir = os.path.join(self._log_dir, self._channel_name)
+
+        if self.segmented:
+            self._start_segment(channel_dir, timestamp, segment)
+        else:
+            self._path = os.path.join(channel_dir, date_string + self._suffix)
+
+        if previous_path != self._path:
+            if self._compactor:
+                self._compactor.submit_previous(channel_dir, date_string,
+                                                self._segment)
+
+            if previous_path and self._metrics is not None:
+                self._metrics.increment('rollovers')
+
+        self._repair_file()
+
+        if self._index_interval:
+            self._index_writer = IndexWriter(
+                self._path, self._index_interval, self._encoding)
+
+        if self._retain_lines and not self._compression:
+            if os.path.exists(self._path):
+                self._flushed_size = os.path.getsize(self._path)
+            else:
+                self._flushed_size = 0
+
+        self._start_file()
+        self._rollover_time = rollover_time
+
+    def _start_segment(self, channel_dir, timestamp, segment):
+        manifest_path = os.path.join(channel_dir,
+                                     self._date_string + MANIFEST_SUFFIX)
+        segments = read_manifest(manifest_path)
+
+        if segment is None:
+            segment = max(1, len(segments))
+
+        filename = '{}.{:04d}{}'.format(self._date_string, segment,
+                                        self.SUFFIX)
+
+        if segment > len(segments):
+            self._segment_start = timestamp
+
+            with open(manifest_path, 'a') as file:
+                file.write('{} {:.6f}\n'.format(filename, timestamp))
+        else:
+            self._segment_start = segments[segment - 1][1]
+
+        self._segment = segment
+        self._path = os.path.join(
+            channel_dir,
+            filename + COMPRESSION_SUFFIXES.get(self._compression, ''))
+
+        if os.path.exists(self._path):
+            self._segment_bytes = os.path.getsize(self._path)
+        else:
+            self._segment_bytes = 0
+
+    def _segment_due(self, timestamp):
+        return self._segment is not None and (
+            self._segment_size is not None and
+            self._segment_bytes >= self._segment_size or
+            self._segment_interval is not None and
+            timestamp - self._segment_start >= self._segment_interval
+        )
+
+    def _repair_file(self):
+        # Only a crash leaves a file damaged, so a path is checked on its
+        # first open by this process (or after abort()), not on every reopen
+        if self._path in _checked_paths:
+            return
+
+        _checked_paths.add(self._path)
+        self._repair_path(self._path)
+
+    def _repair_path(self, path):
+        if self._compression:
+            repair_compressed(path, self._compression)
+
+    def _start_file(self):
+        pass
+
+    def _write_record(self, file, line, timestamp):
+        file.write(line + '\n')
+
+        return len(line) + 1
+
+    def _open_file(self):
+        if self._file_pool is not None:
+            return self._file_pool.open(self._path, self._open_path,
+                                        self._evicted)
+
+        if not self._file:
+            self._file = self._open_path(self._path)
+
+        return self._file
+
+    def _open_path(self, path):
+        if self._compression:
+            return io.TextIOWrapper(open_compressed(path, self._compression),
+                                    encoding=self._encoding,
+                                    errors=self._encoding_errors)
+
+        if self.buffered:
+            buffering = max(self._flush_size or 0, FLUSH_BUFFER_SIZE)
+        else:
+            buffering = -1
+
+        return open(path, 'a', encoding=self._encoding,
+                    errors=self._encoding_errors, buffering=buffering)
+
+    def _get_open_file(self):
+        if self._file_pool is not None:
+            return self._file_pool.get(self._path)
+        else:
+            return self._file
+
+    def flush_due(self):
+        if self._pending_size and self._flush_interval is not None and \
+                time.monotonic() - self._pending_time >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending_size:
+            file = self._get_open_file()
+
+            if file:
+                file.flush()
+
+                if self._retain_lines:
+                    self._flushed(file)
+
+        self._pending_size = 0
+        self._pending_time = None
+
+    @property
+    def retained(self):
+        '''Lines accepted since the last flush, with retain_lines.'''
+        return self._retained
+
+    def _evicted(self):
+        # Closing the file wrote out everything pending, so the retained
+        # lines must not be replayed by abort()
+        self._pending_size = 0
+        self._pending_time = None
+
+        if self._retain_lines:
+            self._retained = []
+
+            if not self._compression:
+                self._flushed_size = os.path.getsize(self._path)
+
+    def _flushed(self, file):
+        # The retained lines are now written to the file
+        self._retained = []
+
+        if not self._compression:
+            self._flushed_size = os.fstat(file.fileno()).st_size
+
+    @property
+    def unsynced(self):
+        return self._unsynced
+
+    def sync(self):
+        '''Flush and fsync the log file to disk.'''
+        if not self._unsynced:
+            return
+
+        self.flush()
+        file = self._get_open_file()
+
+        if file:
+            file.flush()
+            os.fsync(file.fileno())
+        else:
+            # Closed by the file pool
+            fd = os.open(self._path, os.O_RDONLY)
+
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        self._unsynced = False
+        self._last_sync = time.monotonic()
+
+    def sync_due(self):
+        if self._unsynced and \
+                time.monotonic() - self._last_sync >= self._sync_interval:
+            self.sync()
 
     def close(self):
-        if self._file:
-            self._file.close()
-            self._file = None
+        if self._durability != DURABILITY_NONE:
+            self.sync()
+
+        self._close_file()
+
+    def abort(self):
+        '''Close the log file after a write error.
+
+        Data not yet written to the file is discarded, and a plain file is
+        truncated to its size at the last flush, so the lines can be
+        written again. With retain_lines, returns the (line, timestamp) of
+        the discarded lines. The file is reopened by the next write.
+        '''
+        lines = self._retained
+        path = self._path
+        flushed_size = self._flushed_size
+        file = self._get_open_file()
+        self._retained = []
+        self._flushed_size = None
+        _checked_paths.discard(path)
+
+        if file:
+            _discard_unwritten(file)
+
+        try:
+            self._close_file()
+        except OSError:
+            pass
+
+        if path and flushed_size is not None:
+            try:
+                os.truncate(path, flushed_size)
+            except OSError:
+                pass
+
+        return lines
+
+    def _close_file(self):
+        path = self._path
+        file = self._file
+        index_writer = self._index_writer
+
+        self._file = None
+        self._index_writer = None
+        self._path = None
+        self._rollover_time = 0
+        self._pending_size = 0
+        self._pending_time = None
+        self._unsynced = False
+        self._segment = None
+
+        try:
+            if self._file_pool is not None:
+                if path:
+                    self._file_pool.close(path)
+            elif file:
+                file.close()
+        finally:
+            if index_writer:
+                index_writer.close()
+
+        self._retained = []
+        self._flushed_size = None
+
+
+def _discard_unwritten(file):
+    # Point the file at /dev/null so that closing it drops its buffer
+    try:
+        fd = file.fileno()
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return
+
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+
+    try:
+        os.dup2(null_fd, fd)
+    finally:
+        os.close(null_fd)
+
+
+def sync_writers(writers, durability):
+    '''Fsync line writers as the durability policy requires.
+
+    The group policy flushes every file before any is synced so the kernel
+    can write them out together.
+    '''
+    writers = [writer for writer in writers if writer.unsynced]
+
+    if durability == DURABILITY_GROUP:
+        for writer in writers:
+            writer.flush()
+
+        for writer in writers:
+            writer.sync()
+    elif durability == DURABILITY_PERIODIC:
+        for writer in writers:
+            writer.sync_due()
+
+
+class BinaryLineWriter(LineWriter):
+    '''Writes log lines as binary records (see spaghettirecord).'''
+    SUFFIX = '.bin'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if self._index_interval:
+            raise ValueError('binary log files cannot be indexed')
+
+        self._encoder = None
+
+    def _repair_path(self, path):
+        super()._repair_path(path)
+        repair_records(path, self._compression)
+
+    def _start_file(self):
+        # A session appended to an existing file starts with a reset record
+        header = not os.path.exists(self._path) or \
+            not os.path.getsize(self._path)
+        self._encoder = spaghettirecord.RecordEncoder(
+            self._encoding, self._encoding_errors, header=header)
+
+    def _write_record(self, file, line, timestamp):
+        data = self._encoder.encode(line, timestamp)
+        file.write(data)
+
+        return len(data)
+
+    def _open_path(self, path):
+        if self._compression:
+            return open_compressed(path, self._compression)
+
+        if self.buffered:
+            buffering = max(self._flush_size or 0, FLUSH_BUFFER_SIZE)
+        else:
+            buffering = -1
+
+        return open(path, 'ab', buffering=buffering)
+
+
+LOG_FORMATS = {
+    'text': LineWriter,
+    'binary': BinaryLineWriter,
+}
+
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_DROP = 'drop'
+BACKPRESSURE_POLICIES = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP)
+
+
+class BackgroundWriter(object):
+    '''Runs writer calls in order on a separate thread.
+
+    Calls submitted as droppable are subject to the backpressure policy
+    once the queue holds `max_size` items: ``block`` waits for room and
+    ``drop`` discards the call and counts it. Other calls, such as closing
+    a file, are always queued.
+    '''
+    def __init__(self, max_size, backpressure=BACKPRESSURE_BLOCK):
+        assert backpressure in BACKPRESSURE_POLICIES, backpressure
+        self._max_size = max_size
+        self._backpressure = backpressure
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._thread = None
+        self._running = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, func, *args, droppable=False):
+        with self._lock:
+            if not self._running:
+                self._start()
+
+            if droppable and len(self._queue) >= self._max_size:
+                if self._backpressure == BACKPRESSURE_BLOCK:
+                    while len(self._queue) >= self._max_size:
+                        self._not_full.wait()
+                else:
+                    self.dropped += 1
+                    return
+
+            self._queue.append((func, args))
+            self._not_empty.notify()
+
+    def _start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='BackgroundWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while self._running and not self._queue:
+                    self._not_empty.wait()
+
+                if not self._queue:
+                    return
+
+                items = tuple(self._queue)
+                self._queue.clear()
+                self._not_full.notify_all()
+
+            for func, args in items:
+                try:
+                    func(*args)
+                except Exception:
+                    _logger.exception('Background writer call failed.')
+
+    def stop(self):
+        with self._lock:
+            if not self._running:
+                return
+
+            self._running = False
+            self._not_empty.notify()
+            thread = self._thread
+
+        thread.join()
+        self._thread = None
+
+        if self.dropped:
+            _logger.warning('Background writer dropped %s lines.',
+                            self.dropped)
+
+
+STALL_RETRY_INTERVAL = 1
+SPILL_FILENAME = 'stall.spill'
+
+
+class StallBuffer(object):
+    '''Holds log lines in order while writing to the log directory fails.
+
+    Up to `max_size` characters of lines are kept in memory. When that is
+    full, the lines in memory are moved to a spill file in `spill_dir`, or
+    without a spill directory, new lines are dropped. Spilled lines are
+    replayed before the lines in memory. A spill file left by a previous
+    run is replayed too.
+    '''
+    def __init__(self, max_size, spill_dir=None):
+        self._max_size = max_size
+        self._lines = collections.deque()
+        self._size = 0
+        self._spill_offset = 0
+        self.stall_start = None
+        self.channels = set()
+        self.stalls = 0
+        self.spilled = 0
+        self.dropped = 0
+
+        if spill_dir:
+            self._spill_path = os.path.join(spill_dir, SPILL_FILENAME)
+
+            if os.path.exists(self._spill_path) and \
+                    os.path.getsize(self._spill_path):
+                with open(self._spill_path, 'rb') as file:
+                    self.start(float(file.readline().split(b' ', 2)[1]))
+        else:
+            self._spill_path = None
+
+    def __len__(self):
+        return len(self._lines)
+
+    @property
+    def stalled(self):
+        return self.stall_start is not None
+
+    def start(self, timestamp):
+        if self.stall_start is None:
+            self.stall_start = timestamp
+            self.stalls += 1
+
+    def finish(self):
+        '''End the stall and return its start and the channels it held.'''
+        stall_start = self.stall_start
+        channels = self.channels
+        self.stall_start = None
+        self.channels = set()
+
+        return stall_start, channels
+
+    def append(self, channel, line, timestamp):
+        if self._lines and self._size + len(line) > self._max_size and \
+                not self.spill():
+            self.dropped += 1
+            return
+
+        self.channels.add(channel)
+        self._lines.append((channel, line, timestamp))
+        self._size += len(line)
+
+    def spill(self):
+        '''Move the lines in memory to the spill file.
+
+        Returns whether the lines were moved.
+        '''
+        if not self._spill_path:
+            return False
+
+        try:
+            with open(self._spill_path, 'ab') as file:
+                size = file.tell()
+
+                try:
+                    for channel, line, timestamp in self._lines:
+                        file.write('{} {:.6f} {}\n'.format(
+                            channel, timestamp, line
+                        ).encode('utf-8', 'surrogatepass'))
+
+                    file.flush()
+                except OSError:
+                    file.truncate(size)
+                    raise
+        except OSError:
+            _logger.exception('Could not spill lines to %s.',
+                              self._spill_path)
+            return False
+
+        self.spilled += len(self._lines)
+        self._lines.clear()
+        self._size = 0
+
+        return True
+
+    def replay(self, write):
+        '''Write the held lines in order with write(channel, line, timestamp).
+
+        An OSError from write stops the replay and is raised. The line that
+        failed and the lines after it are kept.
+        '''
+        if self._spill_path and os.path.exists(self._spill_path):
+            with open(self._spill_path, 'rb') as file:
+                file.seek(self._spill_offset)
+
+                for record in file:
+                    if not record.endswith(b'\n'):
+                        # Partially written when the process stopped
+                        break
+
+                    channel, timestamp, line = record[:-1].decode(
+                        'utf-8', 'surrogatepass').split(' ', 2)
+                    self.channels.add(channel)
+                    write(channel, line, float(timestamp))
+                    self._spill_offset += len(record)
+
+            os.remove(self._spill_path)
+            self._spill_offset = 0
+
+        while self._lines:
+            channel, line, timestamp = self._lines[0]
+            write(channel, line, timestamp)
+            self._lines.popleft()
+            self._size -= len(line)
+
+
+DEDUP_WINDOW = 30
+DEDUP_MAX_SIZE = 1000000
+
+
+def message_key(channel, text):
+    '''Return the key that identifies a logged chat line across connections.
+
+    Lines with an ``id`` tag are keyed on it. Other lines are keyed on their
+    channel and text, which includes the ``tmi-sent-ts`` tag if they have
+    tags.
+    '''
+    tags = text.partition(' ')[2].partition(' ')[0]
+
+    if tags.startswith('id='):
+        start = 3
+    else:
+        start = tags.find(';id=')
+
+        if start >= 0:
+            start += 4
+
+    if start >= 0:
+        end = tags.find(';', start)
+        return tags[start:end] if end >= 0 else tags[start:]
+
+    return channel, text
+
+
+class Deduplicator(object):
+    '''Remembers recently seen keys in a time-windowed set.
+
+    Keys are kept in two generations that rotate every window or when the
+    current one is full, so each key is remembered for at least the window
+    (unless more than half of max_size keys arrive in it) and memory is
+    bounded by max_size.
+    '''
+    def __init__(self, window=DEDUP_WINDOW, max_size=DEDUP_MAX_SIZE):
+        self._window = window
+        self._max_generation_size = max(1, max_size // 2)
+        self._current = {}
+        self._previous = {}
+        self._rotate_time = time.monotonic() + window
+        self.seen_once = 0
+        self.seen_multiple = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def _rotate_due(self):
+        if len(self._current) >= self._max_generation_size or \
+                time.monotonic() >= self._rotate_time:
+            self._previous = self._current
+            self._current = {}
+            self._rotate_time = time.monotonic() + self._window
+
+    def add(self, key):
+        '''Record a key and return whether it was not seen recently.'''
+        self._rotate_due()
+        count = self._current.get(key)
+
+        if count is None:
+            count = self._previous.pop(key, None)
+
+            if count is None:
+                self._current[key] = 1
+                self.seen_once += 1
+                return True
+
+        if count == 1:
+            self.seen_once -= 1
+            self.seen_multiple += 1
+
+        self._current[key] = count + 1
+        self.duplicates += 1
+
+        return False
+
+    def add_from(self, source, key):
+        '''Record a key sent by a source, such as a connection, and return
+        whether it is new.
+
+        The key may legitimately repeat, so the nth time a source sends it
+        is only a duplicate if another source has already sent it n times.
+        '''
+        self._rotate_due()
+        counts = self._current.get(key)
+
+        if counts is None:
+            counts = self._previous.pop(key, None)
+
+            if counts is None:
+                self._current[key] = {source: 1}
+                self.seen_once += 1
+                return True
+
+            self._current[key] = counts
+
+        count = counts.get(source, 0) + 1
+        counts[source] = count
+
+        other_count = max((other_count for other_source, other_count
+                           in counts.items() if other_source != source),
+                          default=0)
+
+        if count > other_count:
+            return True
+
+        if sum(counts.values()) - max(counts.values()) == 1:
+            self.seen_once -= 1
+            self.seen_multiple += 1
+
+        self.duplicates += 1
+
+        return False
+
+    def stats(self):
+        '''Return counts of keys seen once, keys seen several times and
+        discarded duplicates.'''
+        return {
+            'seen_once': self.seen_once,
+            'seen_multiple': self.seen_multiple,
+            'duplicates': self.duplicates,
+        }
 
 
 class ChatLogger(object):
-    def __init__(self, log_directory):
+    '''Writes chat lines to a log file per channel.
+
+    Channels are reference counted so that several connections can log the
+    same channel. With a dedup window, a line received by more than one
+    connection is written only once. With a stall buffer size, lines are
+    held in a StallBuffer while writing fails and written once it works
+    again, followed by a ``stall START END`` line in each channel.
+    '''
+    def __init__(self, log_directory, flush_size=None, flush_interval=None,
+                 queue_size=None, backpressure=BACKPRESSURE_BLOCK, clock=None,
+                 max_open_files=None, compression=None, compact=None,
+                 index_interval=None, metrics=None, log_format='text',
+                 durability=DURABILITY_NONE, sync_interval=SYNC_INTERVAL,
+                 dedup_window=None, dedup_max_size=DEDUP_MAX_SIZE,
+                 segment_size=None, segment_interval=None,
+                 stall_buffer_size=None, spill_dir=None):
         self._log_directory = log_directory
+        self._clock = clock or default_clock
+        self._compression = compression
+        self._index_interval = index_interval
+        self._writer_class = LOG_FORMATS[log_format]
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._segment_size = segment_size
+        self._segment_interval = segment_interval
         self._channels = []
         self._writers = {}
+        self._channel_refs = collections.Counter()
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._metrics = metrics
+        self._activity = collections.Counter()
+
+        if dedup_window:
+            self._deduplicator = Deduplicator(dedup_window, dedup_max_size)
+
+            if metrics is not None:
+                metrics.add_gauge('dedup_keys', lambda: len(self._deduplicator))
+
+                for name in ('seen_once', 'seen_multiple', 'duplicates'):
+                    metrics.add_gauge(
+                        'dedup_' + name,
+                        lambda name=name: getattr(self._deduplicator, name))
+        else:
+            self._deduplicator = None
+
+        if stall_buffer_size:
+            self._stall_buffer = StallBuffer(stall_buffer_size, spill_dir)
+            # Channels whose stall line was written before their logend
+            self._stall_marked = set()
+
+            if metrics is not None:
+                metrics.add_gauge('stalled',
+                                  lambda: int(self._stall_buffer.stalled))
+                metrics.add_gauge('stall_lines',
+                                  lambda: len(self._stall_buffer))
+
+                for name in ('stalls', 'spilled', 'dropped'):
+                    metrics.add_gauge(
+                        'stall_' + name,
+                        lambda name=name: getattr(self._stall_buffer, name))
+        else:
+            self._stall_buffer = None
+
+        if queue_size:
+            self._background_writer = BackgroundWriter(queue_size,
+                                                       backpressure)
+
+            if metrics is not None:
+                metrics.add_gauge('writer_queue',
+                                  lambda: len(self._background_writer))
+        else:
+            self._background_writer = None
+
+        if max_open_files:
+            self._file_pool = FilePool(max_open_files)
+        else:
+            self._file_pool = None
+
+        if compact:
+            self._compactor = Compactor(compact)
+        else:
+            self._compactor = None
+
+    @property
+    def flush_interval(self):
+        '''How often flush_due() should be called, or None if not needed.'''
+        if self._stall_buffer is not None:
+            return min(self._flush_interval or STALL_RETRY_INTERVAL,
+                       STALL_RETRY_INTERVAL)
+
+        return self._flush_interval
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def sync_interval(self):
+        '''How often sync() should be called, or None if not needed.'''
+        if self._durability in (DURABILITY_PERIODIC, DURABILITY_GROUP):
+            return self._sync_interval
+
+    @property
+    def activity(self):
+        '''Number of chat lines logged for each channel since starting.'''
+        return self._activity
+
+    @property
+    def deduplicator(self):
+        return self._deduplicator
+
+    @property
+    def stall_buffer(self):
+        return self._stall_buffer
 
     def add_channel(self, channel):
+        self._channel_refs[channel] += 1
+
         if channel not in self._writers:
-            self._writers[channel] = LineWriter(self._log_directory, channel)
+            self._writers[channel] = self._new_writer(channel)
             self._write_line(channel, 'logstart {}'.format(channel),
                              internal=True)
 
+    def _new_writer(self, channel):
+        return self._writer_class(
+            self._log_directory, channel,
+            flush_size=self._flush_size,
+            flush_interval=self._flush_interval,
+            clock=self._clock,
+            file_pool=self._file_pool,
+            compression=self._compression,
+            compactor=self._compactor,
+            index_interval=self._index_interval,
+            metrics=self._metrics,
+            durability=self._durability,
+            sync_interval=self._sync_interval,
+            segment_size=self._segment_size,
+            segment_interval=self._segment_interval,
+            retain_lines=self._stall_buffer is not None
+        )
+
     def remove_channel(self, channel):
+        if self._channel_refs[channel] > 1:
+            self._channel_refs[channel] -= 1
+            return
+
+        del self._channel_refs[channel]
+        self._close_channel(channel)
+
+    def _close_channel(self, channel):
         if channel in self._writers:
             self._write_line(channel, 'logend {}'.format(channel),
                              internal=True)
-            self._writers[channel].close()
+            if self._stall_buffer is None:
+                self._dispatch(self._writers[channel].close)
+            else:
+                self._dispatch(self._close_stalled, channel,
+                               self._writers[channel])
+
             del self._writers[channel]
 
-    def log_message(self, nick, channel, message, tags=None):
+    def log_message(self, nick, channel, message, tags=None, source=None):
         self._write_line(
             channel,
             'privmsg {tags} :{nick} :{message}'.format(
                 tags=tags if tags else '',
                 nick=nick,
                 message=message
-            )
+            ),
+            source=source
         )
 
-    def log_mode(self, nick, channel, args):
+    def log_mode(self, nick, channel, args, source=None):
         self._write_line(
             channel,
-            'mode {} {}'.format(nick, ' '.join(args))
+            'mode {} {}'.format(nick, ' '.join(args)),
+            source=source
         )
 
-    def log_notice(self, channel, msg, tags=None):
+    def log_notice(self, channel, msg, tags=None, source=None):
         self._write_line(
             channel,
             'notice {tags} :{msg}'.format(
                 msg=msg,
                 tags=tags if tags else ''
-            )
+            ),
+            source=source
         )
 
-    def log_usernotice(self, channel, msg=None, tags=None):
+    def log_usernotice(self, channel, msg=None, tags=None, source=None):
         self._write_line(
             channel,
             'usernotice {tags} :{msg}'.format(
                 msg=msg if msg else '',
                 tags=tags if tags else ''
-            )
+            ),
+            source=source
         )
 
-    def log_clearchat(self, channel, nick=None, tags=None):
+    def log_clearchat(self, channel, nick=None, tags=None, source=None):
         self._write_line(
             channel,
             'clearchat {tags} :{nick}'.format(
                 nick=nick if nick else '',
                 tags=tags if tags else ''
-            )
+            ),
+            source=source
         )
 
-    def log_clearmsg(self, channel, message=None, tags=None):
+    def log_clearmsg(self, channel, message=None, tags=None, source=None):
         self._write_line(
             channel,
             'clearmsg {tags} :{message}'.format(
                 message=message if message else '',
                 tags=tags if tags else ''
-            )
+            ),
+            source=source
         )
 
-    def log_join(self, channel, nick):
+    def log_join(self, channel, nick, source=None):
         self._write_line(
             channel,
-            'join {}'.format(nick)
+            'join {}'.format(nick),
+            source=source
         )
 
-    def log_part(self, channel, nick):
+    def log_part(self, channel, nick, source=None):
         self._write_line(
             channel,
-            'part {}'.format(nick)
+            'part {}'.format(nick),
+            source=source
         )
 
-    def _write_line(self, channel, text, internal=False):
+    def _write_line(self, channel, text, internal=False, source=None):
         if channel not in self._writers:
             _logger.warning('Discarded message to channel %s when not joined.',
                             channel)
@@ -160,19 +1703,267 @@ class ChatLogger(object):
         if internal:
             prefix = '# '
         else:
+            if self._deduplicator is not None:
+                key = message_key(channel, text)
+
+                # Lines without an id, such as joins, can legitimately
+                # repeat on one connection
+                if isinstance(key, tuple):
+                    is_new = self._deduplicator.add_from(source, key)
+                else:
+                    is_new = self._deduplicator.add(key)
+
+                if not is_new:
+                    return
+
             prefix = ''
+            self._activity[channel] += 1
 
         writer = self._writers[channel]
+        timestamp = self._clock.now()
         line = '{prefix}{date} {text}'.format(
             prefix=prefix,
-            date=datetime.datetime.utcnow().isoformat(),
+            date=self._clock.format(timestamp),
             text=text
         )
-        writer.write_line(line)
+
+        if self._stall_buffer is not None:
+            if self._metrics is not None:
+                self._metrics.channel_lines[channel] += 1
+
+            self._dispatch(self._write_stalled, channel, writer, line,
+                           timestamp, droppable=not internal)
+        elif self._metrics is None:
+            self._dispatch(writer.write_line, line, timestamp,
+                           droppable=not internal)
+        else:
+            self._metrics.channel_lines[channel] += 1
+            self._dispatch(self._write_timed, writer, line, timestamp,
+                           droppable=not internal)
+
+    def _write_timed(self, writer, line, timestamp):
+        start_time = time.perf_counter()
+        writer.write_line(line, timestamp)
+        self._metrics.observe('write_line', time.perf_counter() - start_time)
+
+    def _write_stalled(self, channel, writer, line, timestamp):
+        # Write a line, or hold it if writing fails or already failed
+        stall_buffer = self._stall_buffer
+
+        if not stall_buffer.stalled:
+            try:
+                if self._metrics is None:
+                    writer.write_line(line, timestamp)
+                else:
+                    self._write_timed(writer, line, timestamp)
+
+                return
+            except OSError as error:
+                # The writer retained this line with the ones it had not
+                # flushed yet
+                self._start_stall(error, channel, writer)
+                return
+
+        if writer.retained:
+            self._hold_retained(channel, writer)
+
+        stall_buffer.append(channel, line, timestamp)
+
+    def _start_stall(self, error, channel, writer):
+        if not self._stall_buffer.stalled:
+            _logger.warning('Writing log files failed, holding lines until '
+                            'it works again: %s', error)
+
+        self._stall_buffer.start(self._clock.now())
+        self._hold_retained(channel, writer)
+
+    def _hold_retained(self, channel, writer):
+        # Lines accepted by the writer but not written to its file go
+        # before any later line of the channel
+        for line, timestamp in writer.abort():
+            self._stall_buffer.append(channel, line, timestamp)
+
+    def _close_stalled(self, channel, writer):
+        try:
+            writer.close()
+        except OSError as error:
+            self._start_stall(error, channel, writer)
+
+    def _flush_stalled(self, writers, due):
+        for channel, writer in writers:
+            try:
+                if due and not self._stall_buffer.stalled:
+                    writer.flush_due()
+                else:
+                    writer.flush()
+            except OSError as error:
+                self._start_stall(error, channel, writer)
+
+        self._retry_stalled()
+
+    def _sync_stalled(self, writers):
+        if self._stall_buffer.stalled:
+            return
+
+        try:
+            sync_writers([writer for channel, writer in writers],
+                         self._durability)
+        except OSError:
+            # Find the writers that fail
+            for channel, writer in writers:
+                try:
+                    writer.sync()
+                except OSError as error:
+                    self._start_stall(error, channel, writer)
+
+    def _retry_stalled(self):
+        # Replay the held lines through the channels' writers. Channels
+        # closed during the stall are written with temporary writers, with
+        # the stall line before their logend.
+        stall_buffer = self._stall_buffer
+
+        if not stall_buffer.stalled:
+            return
+
+        stall_end = self._clock.now()
+        temporary_writers = {}
+
+        def get_writer(channel):
+            writer = self._writers.get(channel) or \
+                temporary_writers.get(channel)
+
+            if not writer:
+                writer = temporary_writers[channel] = \
+                    self._new_writer(channel)
+
+            return writer
+
+        def stall_line(timestamp, stall_end):
+            return '# {} stall {} {}'.format(
+                self._clock.format(timestamp),
+                self._clock.format(stall_buffer.stall_start),
+                self._clock.format(stall_end))
+
+        def write(channel, line, timestamp):
+            # Each replayed line is flushed before it leaves the buffer
+            writer = get_writer(channel)
+            marked = channel not in self._stall_marked and \
+                line.startswith('# ') and \
+                line.endswith(' logend {}'.format(channel))
+
+            try:
+                if marked:
+                    writer.write_line(stall_line(timestamp, stall_end),
+                                      timestamp)
+
+                writer.write_line(line, timestamp)
+                writer.flush()
+            except OSError:
+                writer.abort()
+                raise
+
+            if marked:
+                self._stall_marked.add(channel)
+
+        try:
+            try:
+                stall_buffer.replay(write)
+            except OSError as error:
+                _logger.debug('Replaying held lines failed: %s', error)
+                return
+
+            timestamp = self._clock.now()
+            line = stall_line(timestamp, timestamp)
+            stall_start, channels = stall_buffer.finish()
+
+            _logger.info('Writing log files works again after %.1f seconds.',
+                         timestamp - stall_start)
+
+            for channel in sorted(channels - self._stall_marked):
+                self._write_stalled(channel, get_writer(channel), line,
+                                    timestamp)
+
+            self._stall_marked.clear()
+        finally:
+            for channel, writer in temporary_writers.items():
+                self._close_stalled(channel, writer)
+
+    def _stop_stalled(self):
+        self._retry_stalled()
+
+        if self._stall_buffer.stalled and len(self._stall_buffer):
+            if self._stall_buffer.spill():
+                _logger.warning('Log files are still failing, spilled the '
+                                'held lines to be written on the next start.')
+            else:
+                _logger.error('Log files are still failing, lost %s lines.',
+                              len(self._stall_buffer))
+
+    def _dispatch(self, func, *args, droppable=False):
+        if self._background_writer is not None:
+            self._background_writer.submit(func, *args, droppable=droppable)
+        else:
+            func(*args)
+
+    def flush(self):
+        if self._stall_buffer is not None:
+            self._dispatch(self._flush_stalled, tuple(self._writers.items()),
+                           False)
+            return
+
+        for writer in self._writers.values():
+            self._dispatch(writer.flush)
+
+    def flush_due(self):
+        if self._stall_buffer is not None:
+            self._dispatch(self._flush_stalled, tuple(self._writers.items()),
+                           True)
+            return
+
+        for writer in self._writers.values():
+            self._dispatch(writer.flush_due)
+
+    def sync(self):
+        if self._stall_buffer is not None:
+            self._dispatch(self._sync_stalled, tuple(self._writers.items()))
+        else:
+            self._dispatch(sync_writers, tuple(self._writers.values()),
+                           self._durability)
+
+    def log_stats(self):
+        if self._file_pool is not None:
+            _logger.info('Open files: %s', self._file_pool.stats())
+
+        if self._background_writer is not None:
+            _logger.info('Writer queue: %s queued, %s dropped.',
+                         len(self._background_writer),
+                         self._background_writer.dropped)
+
+        if self._deduplicator is not None:
+            _logger.info('Dedup: %(seen_once)s seen once, %(seen_multiple)s '
+                         'seen several times, %(duplicates)s duplicates '
+                         'discarded.', self._deduplicator.stats())
+
+        if self._stall_buffer is not None and (
+                self._stall_buffer.stalled or self._stall_buffer.dropped):
+            _logger.info('Stall buffer: %s held, %s spilled, %s dropped.',
+                         len(self._stall_buffer), self._stall_buffer.spilled,
+                         self._stall_buffer.dropped)
 
     def stop(self):
+        self._channel_refs.clear()
+
         for channel in tuple(self._writers.keys()):
-            self.remove_channel(channel)
+            self._close_channel(channel)
+
+        if self._stall_buffer is not None:
+            self._dispatch(self._stop_stalled)
+
+        if self._background_writer is not None:
+            self._background_writer.stop()
+
+        if self._compactor:
+            self._compactor.stop()
 
 RECONNECT_SUCCESS_THRESHOLD = 60
 RECONNECT_MIN_INTERVAL = 2
@@ -180,45 +1971,600 @@ RECONNECT_MAX_INTERVAL = 300
 KEEP_ALIVE = 60
 IRC_RATE_LIMIT = (20 - 0.1) / 30
 FILE_POLL_INTERVAL = 30
+CHANNELS_WATCH_INTERVAL = 1
+JOIN_RATE = 20 / 10
+JOIN_WINDOW = 10
+JOIN_TICK_INTERVAL = 0.5
+JOIN_BATCH_SIZE = 25
+ACTIVITY_INTERVAL = 60
+# IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x80 | 0x100
+INOTIFY_EVENT = struct.Struct('iIII')
+STATS_LOG_INTERVAL = 300
+METRICS_INTERVAL = 10
+
+
+class ListWrapper(list):
+    __slots__ = ('raw', )
+
+
+_irc_patched = False
+
+
+def _patch_irc():
+    global _irc_patched
+
+    if _irc_patched:
+        return
+
+    _irc_patched = True
+
+    irc.client.ServerConnection.buffer_class.encoding = 'latin-1'
+
+    # Monkey patch to include raw tags so we don't have to serialize it
+    # again
+    original_from_group = irc.message.Tag.from_group
+
+    def new_from_group(text):
+        result = original_from_group(text)
+        if result:
+            result = ListWrapper(result)
+            result.raw = text
+        return result
+
+    irc.message.Tag.from_group = new_from_group
+
+    # Monkey patch to preserve messages such as /me
+    # Fortunately, Twitch does not require CTCP replies
+    irc.ctcp.dequote = lambda msg: [msg]
+
+
+def _split_arguments(text):
+    # Same as irc.message.Arguments.from_group()
+    if text.startswith(':'):
+        return [text[1:]]
+
+    main, sep, ext = text.partition(' :')
+    arguments = main.split()
+
+    if sep:
+        arguments.append(ext)
+
+    return arguments
+
+
+class FastServerConnection(irc.client.ServerConnection):
+    '''Server connection that offers each raw line to a handler first.
+
+    If the handler returns true, the line is not parsed into events.
+    '''
+    fast_handler = None
+
+    def _process_line(self, line):
+        if self.fast_handler and self.fast_handler(line):
+            return
+
+        super()._process_line(line)
+
+
+class FastReactor(irc.client.Reactor):
+    connection_class = FastServerConnection
+
+
+def parse_line(line):
+    '''Split a raw IRC line into tags, source, command and arguments.'''
+    tags = None
+
+    if line.startswith('@'):
+        tags, sep, line = line[1:].partition(' ')
+
+    if line.startswith(':'):
+        source, sep, line = line[1:].partition(' ')
+        line = line.lstrip(' ')
+    else:
+        source = None
+
+    command, sep, arguments = line.partition(' ')
+
+    return tags or None, source, command, \
+        _split_arguments(arguments.lstrip(' '))
+
+
+NAME_CACHE_SIZE = 10000
+
+
+class NameCache(object):
+    '''Bounded cache of lowercased IRC channel names and nicks.
+
+    A name seen recently returns the same interned lowercased string instead
+    of a new one. Names are kept in two generations like Deduplicator, so
+    frequent names stay cached and memory is bounded by max_size.
+    '''
+    def __init__(self, max_size=NAME_CACHE_SIZE):
+        self._max_generation_size = max(1, max_size // 2)
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def lower(self, name):
+        try:
+            return self._current[name]
+        except KeyError:
+            pass
+
+        lowered = self._previous.pop(name, None)
+
+        if lowered is None:
+            lowered = sys.intern(irc.strings.lower(name))
+
+        if len(self._current) >= self._max_generation_size:
+            self._previous = self._current
+            self._current = {}
+
+        self._current[name] = lowered
+
+        return lowered
+
+
+class RawLineLogger(object, metaclass=abc.ABCMeta):
+    '''Logs chat traffic from parsed raw lines.
+
+    Handlers return false for lines that need the client's attention, such
+    as our own JOIN/PART. Subclasses provide the client's nickname.
+    '''
+    def _setup_name_cache(self, max_size):
+        # A size of 0 lowercases every name without caching
+        if max_size:
+            self._lower = NameCache(max_size).lower
+        else:
+            self._lower = irc.strings.lower
+
+    def _setup_fast_handlers(self):
+        self._fast_handlers = {
+            'PRIVMSG': self._fast_privmsg,
+            'NOTICE': self._fast_notice,
+            'USERNOTICE': self._fast_usernotice,
+            'CLEARCHAT': self._fast_clearchat,
+            'CLEARMSG': self._fast_clearmsg,
+            'MODE': self._fast_mode,
+            'JOIN': self._fast_join,
+            'PART': self._fast_part,
+        }
+
+    @abc.abstractmethod
+    def _get_nickname(self):
+        pass
+
+    def _log_parsed_line(self, tags, source, command, arguments):
+        handler = self._fast_handlers.get(command)
+
+        if not handler:
+            return False
+
+        return handler(source, arguments, tags)
+
+    def _fast_privmsg(self, source, arguments, tags):
+        if not source or len(arguments) < 2 or \
+                not irc.client.is_channel(arguments[0]):
+            return False
+
+        self._chat_logger.log_message(
+            self._lower(source.partition('!')[0]),
+            self._lower(arguments[0]),
+            arguments[1],
+            tags,
+            source=self
+        )
+        return True
+
+    def _fast_notice(self, source, arguments, tags):
+        if len(arguments) < 2 or not irc.client.is_channel(arguments[0]):
+            return False
+
+        self._chat_logger.log_notice(
+            self._lower(arguments[0]), arguments[1], tags, source=self)
+        return True
+
+    def _fast_usernotice(self, source, arguments, tags):
+        if not arguments:
+            return False
+
+        self._chat_logger.log_usernotice(
+            self._lower(arguments[0]),
+            arguments[1] if len(arguments) > 1 else None,
+            tags,
+            source=self
+        )
+        return True
+
+    def _fast_clearchat(self, source, arguments, tags):
+        if not arguments:
+            return False
+
+        self._chat_logger.log_clearchat(
+            self._lower(arguments[0]),
+            arguments[1] if len(arguments) > 1 else None,
+            tags=tags,
+            source=self
+        )
+        return True
+
+    def _fast_clearmsg(self, source, arguments, tags):
+        if not arguments:
+            return False
+
+        self._chat_logger.log_clearmsg(
+            self._lower(arguments[0]),
+            arguments[1] if len(arguments) > 1 else None,
+            tags=tags,
+            source=self
+        )
+        return True
+
+    def _fast_mode(self, source, arguments, tags):
+        if not source or not arguments or \
+                not irc.client.is_channel(arguments[0]):
+            return False
+
+        self._chat_logger.log_mode(
+            self._lower(source.partition('!')[0]),
+            self._lower(arguments[0]),
+            arguments[1:],
+            source=self
+        )
+        return True
+
+    def _fast_join(self, source, arguments, tags):
+        if not source or not arguments:
+            return False
+
+        nick = self._lower(source.partition('!')[0])
+
+        if nick == self._get_nickname():
+            return False
+
+        self._chat_logger.log_join(self._lower(arguments[0]), nick,
+                                   source=self)
+        return True
+
+    def _fast_part(self, source, arguments, tags):
+        if not source or not arguments:
+            return False
+
+        nick = self._lower(source.partition('!')[0])
+
+        if nick == self._get_nickname():
+            return False
+
+        self._chat_logger.log_part(self._lower(arguments[0]), nick,
+                                   source=self)
+        return True
+
+
+def next_reconnect_interval(interval, last_connect):
+    time_now = time.time()
+
+    if not last_connect or time_now - last_connect < RECONNECT_SUCCESS_THRESHOLD:
+        return min(RECONNECT_MAX_INTERVAL, interval * 2)
+    else:
+        return RECONNECT_MIN_INTERVAL
+
+
+def _inotify_watch(path, mask):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+class ChannelsFileWatcher(object):
+    '''Tells whether the channels file has changed.
+
+    On Linux, inotify events for the file are checked so changes can be
+    picked up every second at almost no cost. Otherwise, the file's
+    modification time and size are polled less often.
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._name = os.fsencode(os.path.basename(path))
+        self._stat = None
+
+        # Watch the directory since editors often replace the file
+        self._fd = _inotify_watch(os.path.dirname(os.path.abspath(path)),
+                                  INOTIFY_MASK)
+
+        if self._fd is not None:
+            self.poll_interval = CHANNELS_WATCH_INTERVAL
+        else:
+            self.poll_interval = FILE_POLL_INTERVAL
+
+    def changed(self):
+        if self._fd is not None and self._stat is not None and \
+                not self._read_events():
+            return False
+
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            # Keep the current channels while the file is being replaced
+            return False
+
+        new_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        if new_stat == self._stat:
+            return False
+
+        self._stat = new_stat
+
+        return True
+
+    def _read_events(self):
+        found = False
+
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return found
+
+            offset = 0
+
+            while offset < len(data):
+                dummy, dummy, dummy, name_length = \
+                    INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + name_length].rstrip(b'\0')
+                offset += name_length
+
+                if name == self._name:
+                    found = True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def diff_channels(old_channels, new_channels):
+    '''Return the added channels, in order, and the set of removed ones.'''
+    new_channel_set = frozenset(new_channels)
+    added = [channel for channel in new_channels
+             if channel not in old_channels]
+
+    return added, old_channels - new_channel_set
+
+
+def read_channels_file(path):
+    channels = []
+
+    with open(path, 'r') as file:
+        for channel in file:
+            channel = channel.strip()
+
+            if not channel:
+                continue
+
+            channel = irc.strings.lower(channel)
+            channels.append(channel)
+
+    return channels
+
+
+class JoinScheduler(object):
+    '''Queues JOINs and PARTs and releases them within the join rate budget.
+
+    At most `burst` JOINs are released in any `burst / rate` seconds,
+    which is Twitch's limit of 20 per 10 seconds by default. A queued JOIN
+    and PART of the same channel cancel out. Queued JOINs are released
+    busiest channel first, by the message rate recently seen in
+    `activity`, a mapping of channel to the number of lines logged so far.
+    '''
+    def __init__(self, rate=JOIN_RATE, burst=None, activity=None):
+        if burst is None:
+            # An infinite rate joins everything at once
+            burst = max(1, int(min(rate * JOIN_WINDOW, sys.maxsize)))
+
+        self._burst = burst
+        self._window = burst / rate
+        self._join_times = collections.deque()
+        self._activity = activity if activity is not None else {}
+        self._previous_activity = {}
+        self._rates = {}
+        self._last_activity_update = time.monotonic()
+        self._pending = {}
+        self._join_order = []
+        self._join_order_dirty = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def join(self, channel):
+        if self._pending.get(channel) == 'PART':
+            del self._pending[channel]
+        else:
+            self._pending[channel] = 'JOIN'
+            self._join_order.append(channel)
+            self._join_order_dirty = True
+
+    def part(self, channel):
+        if self._pending.get(channel) == 'JOIN':
+            del self._pending[channel]
+        else:
+            self._pending[channel] = 'PART'
+
+    def clear(self):
+        self._pending.clear()
+        self._join_order = []
+
+    def eta(self):
+        '''Return the seconds until every queued JOIN is released.'''
+        join_count = sum(1 for command in self._pending.values()
+                         if command == 'JOIN')
+
+        if not join_count:
+            return 0
+
+        time_now = time.monotonic()
+        self._expire_join_times(time_now)
+
+        # The nth JOIN overall goes one window after the (n - burst)th
+        index = len(self._join_times) + join_count - 1
+        windows, base_index = divmod(index, self._burst)
+
+        if base_index < len(self._join_times):
+            base_time = self._join_times[base_index]
+        else:
+            base_time = time_now
+
+        return max(0, base_time + windows * self._window - time_now)
+
+    def update_rates(self):
+        '''Update the channel message rates if they are due.'''
+        time_now = time.monotonic()
+
+        if time_now - self._last_activity_update >= ACTIVITY_INTERVAL:
+            self._update_rates(time_now)
+
+    def take(self):
+        '''Return the channels to join and to part now.'''
+        time_now = time.monotonic()
+        self._expire_join_times(time_now)
+        self.update_rates()
+
+        parts = [channel for channel, command in self._pending.items()
+                 if command == 'PART']
+
+        for channel in parts:
+            del self._pending[channel]
+
+        if self._join_order_dirty:
+            # Busiest last so they can be popped
+            self._join_order = sorted(
+                set(self._join_order),
+                key=lambda channel: self._rates.get(channel, 0))
+            self._join_order_dirty = False
+
+        joins = []
+
+        while self._join_order and len(self._join_times) < self._burst:
+            channel = self._join_order.pop()
+
+            if self._pending.get(channel) == 'JOIN':
+                del self._pending[channel]
+                joins.append(channel)
+                self._join_times.append(time_now)
+
+        return joins, parts
 
+    def _expire_join_times(self, time_now):
+        while self._join_times and \
+                self._join_times[0] <= time_now - self._window:
+            self._join_times.popleft()
 
-class ListWrapper(list):
-    __slots__ = ('raw', )
+    def _update_rates(self, time_now):
+        elapsed = time_now - self._last_activity_update
+        activity = dict(self._activity)
+
+        for channel, count in activity.items():
+            rate = (count - self._previous_activity.get(channel, 0)) / elapsed
+            self._rates[channel] = (self._rates.get(channel, rate) + rate) / 2
+
+        self._previous_activity = activity
+        self._last_activity_update = time_now
+        self._join_order_dirty = True
 
 
-class Client(irc.client.SimpleIRCClient):
-    def __init__(self, chat_logger: ChatLogger, channels_file):
-        super().__init__()
+class Client(irc.client.SimpleIRCClient, RawLineLogger):
+    def __init__(self, chat_logger: ChatLogger, channels_file=None,
+                 reactor=None, fast_path=False, join_rate=JOIN_RATE,
+                 name_cache_size=NAME_CACHE_SIZE):
+        if reactor:
+            # Share the reactor (and its select loop) with other clients
+            # rather than creating one of our own
+            self.reactor = reactor
+            self.connection = reactor.server()
+            self.dcc_connections = []
+            reactor.add_global_handler('all_events', self._dispatcher, -10)
+        else:
+            if fast_path:
+                self.reactor_class = FastReactor
+
+            super().__init__()
+
         self._chat_logger = chat_logger
         self._channels_file = channels_file
-        self._channels_file_timestamp = 0
+        self._channels_watcher = None
         self._channels = []
+        self._channel_set = frozenset()
         self._joined_channels = set()
+        self._logged_channels = set()
         self._running = True
         self._reconnect_time = RECONNECT_MIN_INTERVAL
         self._last_connect = 0
+        self._join_scheduler = JoinScheduler(join_rate,
+                                             activity=chat_logger.activity)
+        self._metrics = chat_logger.metrics
+        self._nickname = None
+        self._setup_name_cache(name_cache_size)
+
+        if self._metrics is not None:
+            self._metrics.add_gauge('join_queue',
+                                    lambda: len(self._join_scheduler))
+            self._metrics.add_gauge('join_eta', self._join_scheduler.eta)
+
+        if not reactor:
+            if chat_logger.flush_interval:
+                self.reactor.scheduler.execute_every(
+                    chat_logger.flush_interval, chat_logger.flush_due)
+
+            if chat_logger.sync_interval:
+                self.reactor.scheduler.execute_every(
+                    chat_logger.sync_interval, chat_logger.sync)
+
+        if channels_file:
+            self._channels_watcher = ChannelsFileWatcher(channels_file)
+            self.reactor.scheduler.execute_every(
+                self._channels_watcher.poll_interval, self._load_channels)
 
-        irc.client.ServerConnection.buffer_class.encoding = 'latin-1'
-
-        self.reactor.scheduler.execute_every(FILE_POLL_INTERVAL, self._load_channels)
         self.reactor.scheduler.execute_every(KEEP_ALIVE, self._keep_alive)
+        self.reactor.scheduler.execute_every(JOIN_TICK_INTERVAL,
+                                             self._send_joins)
 
-        # Monkey patch to include raw tags so we don't have to serialize it
-        # again
-        original_from_group = irc.message.Tag.from_group
+        if fast_path:
+            assert isinstance(self.connection, FastServerConnection)
+            self.connection.fast_handler = self._process_fast_line
+            self._setup_fast_handlers()
 
-        def new_from_group(text):
-            result = original_from_group(text)
-            if result:
-                result = ListWrapper(result)
-                result.raw = text
-            return result
+        _patch_irc()
 
-        irc.message.Tag.from_group = new_from_group
+    def _dispatcher(self, connection, event):
+        if connection is not self.connection:
+            return
+
+        if self._metrics is None:
+            super()._dispatcher(connection, event)
+            return
+
+        # Time only the events that have an on_* handler
+        method = getattr(self, 'on_' + event.type, None)
 
-        # Monkey patch to preserve messages such as /me
-        # Fortunately, Twitch does not require CTCP replies
-        irc.ctcp.dequote = lambda msg: [msg]
+        if method:
+            start_time = time.perf_counter()
+            method(connection, event)
+            self._metrics.observe('handler.' + event.type,
+                                  time.perf_counter() - start_time)
 
     def autoconnect(self, *args, **kwargs):
         self.connection.set_rate_limit(float('+inf'))
@@ -232,176 +2578,797 @@ class Client(irc.client.SimpleIRCClient):
             self._schedule_reconnect()
 
     def _schedule_reconnect(self):
-        time_now = time.time()
-
-        if not self._last_connect or time_now - self._last_connect < RECONNECT_SUCCESS_THRESHOLD:
-            self._reconnect_time *= 2
-            self._reconnect_time = min(RECONNECT_MAX_INTERVAL,
-                                       self._reconnect_time)
-        else:
-            self._reconnect_time = RECONNECT_MIN_INTERVAL
+        self._reconnect_time = next_reconnect_interval(self._reconnect_time,
+                                                       self._last_connect)
 
         _logger.info('Reconnecting in %s seconds.', self._reconnect_time)
+
+        if self._metrics is not None:
+            self._metrics.increment('reconnects')
+            self._metrics.observe('reconnect_interval', self._reconnect_time)
+
         self.reactor.scheduler.execute_after(self._reconnect_time,
                                              self.autoconnect)
 
     def stop(self):
         self._running = False
-        self.reactor.disconnect_all()
+        self.connection.disconnect()
         self._chat_logger.stop()
 
+        if self._channels_watcher:
+            self._channels_watcher.close()
+
     def on_welcome(self, connection, event):
         _logger.info('Logged in to server.')
         self.connection.cap('REQ', 'twitch.tv/membership')
         self.connection.cap('REQ', 'twitch.tv/commands')
         self.connection.cap('REQ', 'twitch.tv/tags')
         self.connection.set_rate_limit(IRC_RATE_LIMIT)
-        self._load_channels(force_reload=True)
+        self._nickname = self._lower(self.connection.get_nickname())
+
+        if self._channels_file:
+            self._load_channels(force_reload=True)
+
+        self._join_channels(self._channels)
         self._last_connect = time.time()
 
     def on_disconnect(self, connection, event):
         _logger.info('Disconnected!')
-        self._chat_logger.stop()
+
+        for channel in self._logged_channels:
+            self._chat_logger.remove_channel(channel)
+
+        self._logged_channels.clear()
+        self._join_scheduler.clear()
 
         if self._running:
             self._joined_channels.clear()
-            self._last_connect = 0
             self._schedule_reconnect()
+            self._last_connect = 0
 
     def on_join(self, connection, event):
-        client_nick = self.connection.get_nickname()
-        nick = irc.strings.lower(event.source.nick)
-        channel = irc.strings.lower(event.target)
+        nick = self._lower(event.source.nick)
+        channel = self._lower(event.target)
 
-        if nick == client_nick:
+        if nick == self._nickname:
             _logger.info('Joined %s', channel)
             self._joined_channels.add(event.target)
 
-        self._chat_logger.log_join(channel, nick)
+        self._chat_logger.log_join(channel, nick, source=self)
 
     def on_part(self, connection, event):
-        client_nick = self.connection.get_nickname()
-        nick = irc.strings.lower(event.source.nick)
-        channel = irc.strings.lower(event.target)
+        nick = self._lower(event.source.nick)
+        channel = self._lower(event.target)
 
-        if nick == client_nick and channel in self._joined_channels:
+        if nick == self._nickname and channel in self._joined_channels:
             _logger.info('Parted %s', channel)
             self._joined_channels.remove(channel)
 
-        self._chat_logger.log_part(channel, nick)
+        self._chat_logger.log_part(channel, nick, source=self)
 
     def on_pubmsg(self, connection, event):
-        channel = irc.strings.lower(event.target)
+        channel = self._lower(event.target)
 
         if hasattr(event.source, 'nick'):
-            nick = irc.strings.lower(event.source.nick)
+            nick = self._lower(event.source.nick)
 
             self._chat_logger.log_message(
                 nick,
                 channel,
                 event.arguments[0],
-                event.tags.raw if event.tags else None)
+                event.tags.raw if event.tags else None,
+                source=self)
 
     def on_mode(self, connection, event):
-        nick = irc.strings.lower(event.source.nick)
-        channel = irc.strings.lower(event.target)
+        nick = self._lower(event.source.nick)
+        channel = self._lower(event.target)
 
-        self._chat_logger.log_mode(nick, channel, event.arguments)
+        self._chat_logger.log_mode(nick, channel, event.arguments,
+                                   source=self)
 
     def on_pubnotice(self, connection, event):
-        channel = irc.strings.lower(event.target)
+        channel = self._lower(event.target)
 
         self._chat_logger.log_notice(
             channel,
             event.arguments[0],
-            event.tags.raw if event.tags else None
+            event.tags.raw if event.tags else None,
+            source=self
         )
 
     def on_clearchat(self, connection, event):
-        channel = irc.strings.lower(event.target)
+        channel = self._lower(event.target)
         nick = event.arguments[0] if event.arguments else None
         tags = event.tags.raw if event.tags else None
 
-        self._chat_logger.log_clearchat(channel, nick, tags=tags)
+        self._chat_logger.log_clearchat(channel, nick, tags=tags, source=self)
 
     def on_clearmsg(self, connection, event):
-        channel = irc.strings.lower(event.target)
+        channel = self._lower(event.target)
         message = event.arguments[0] if event.arguments else None
         tags = event.tags.raw if event.tags else None
 
-        self._chat_logger.log_clearmsg(channel, message, tags=tags)
+        self._chat_logger.log_clearmsg(channel, message, tags=tags,
+                                       source=self)
 
     def on_usernotice(self, connection, event):
-        channel = irc.strings.lower(event.target)
+        channel = self._lower(event.target)
         msg = event.arguments[0] if event.arguments else None
 
         self._chat_logger.log_usernotice(
             channel,
             msg,
-            event.tags.raw if event.tags else None
+            event.tags.raw if event.tags else None,
+            source=self
         )
 
-    def _join_new_channels(self):
-        new_channels = frozenset(self._channels) - self._joined_channels
-        join_channels = tuple(
-            channel for channel in self._channels if channel in new_channels
-        )
-        join_multi = tuple(
-            ','.join(channel for channel in group if channel) for group in grouper(join_channels, 25)
-        )
+    def _get_nickname(self):
+        return self._nickname
+
+    def _process_fast_line(self, line):
+        # Log chat traffic straight from the raw line. Anything else, such as
+        # our own JOIN/PART, goes through the usual event handlers.
+        if self._metrics is None:
+            return self._log_parsed_line(*parse_line(line))
+
+        start_time = time.perf_counter()
+        result = self._log_parsed_line(*parse_line(line))
+        self._metrics.observe('handler.fast_path',
+                              time.perf_counter() - start_time)
+
+        return result
+
+    def _join_channels(self, channels):
+        for channel in channels:
+            if channel not in self._logged_channels:
+                _logger.info('Channel to join: %s', channel)
+                self._chat_logger.add_channel(channel)
+                self._logged_channels.add(channel)
+                self._join_scheduler.join(channel)
+
+        if self._join_scheduler:
+            _logger.info('%s channels to join or part, about %.0f seconds.',
+                         len(self._join_scheduler),
+                         self._join_scheduler.eta())
+
+    def _part_channels(self, channels):
+        for channel in channels:
+            if channel in self._logged_channels:
+                self._chat_logger.remove_channel(channel)
+                self._logged_channels.remove(channel)
+                self._join_scheduler.part(channel)
+
+    def _send_joins(self):
+        self._join_scheduler.update_rates()
+
+        if not self.connection.is_connected() or not self._join_scheduler:
+            return
 
-        for channel in join_channels:
-            _logger.info('Channel to join: %s', channel)
-            self._chat_logger.add_channel(channel)
+        joins, parts = self._join_scheduler.take()
 
-        for index, channel in enumerate(join_multi):
-            _logger.info('Joining %s', channel)
+        for channel in parts:
+            _logger.info('Parting %s', channel)
+            self.connection.part(channel)
 
-            if hasattr(self.connection.send_raw, 'max_rate'):
-                # Give the Reactor loop a chance to process incoming
-                # messages especially on server connect
-                self.reactor.scheduler.execute_after(
-                    1 / self.connection.send_raw.max_rate * index,
-                    functools.partial(self.connection.join, channel)
-                )
-            else:
-                self.connection.join(channel)
+        for group in grouper(joins, JOIN_BATCH_SIZE):
+            channel = ','.join(channel for channel in group if channel)
+            _logger.info('Joining %s', channel)
+            self.connection.join(channel)
 
-    def _part_old_channels(self):
-        old_channels = self._joined_channels - frozenset(self._channels)
+    def set_channels(self, channels):
+        added, removed = diff_channels(self._channel_set, channels)
+        self._channels = channels
+        self._channel_set = frozenset(channels)
 
-        for channel in old_channels:
-            _logger.info('Parting %s', channel)
-            self.connection.part(channel)
-            self._chat_logger.remove_channel(channel)
+        if self.connection.is_connected():
+            self._join_channels(added)
+            self._part_channels(removed)
 
     def _load_channels(self, force_reload=False):
-        new_time = os.path.getmtime(self._channels_file)
-
-        if not force_reload and new_time == self._channels_file_timestamp:
+        if not self._channels_watcher.changed() and not force_reload:
             return
 
-        self._channels_file_timestamp = new_time
+        self.set_channels(read_channels_file(self._channels_file))
+
+    def _keep_alive(self):
+        if self.connection.is_connected():
+            self.connection.ping('keep-alive')
+
+
+ASYNC_LINE_LIMIT = 2 ** 20
+ASYNC_WRITER_QUEUE = 10000
+
+
+async def read_line(reader):
+    '''Read a line from a stream, skipping lines over the stream's limit.'''
+    skipping = False
 
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as error:
+            return b'' if skipping else error.partial
+        except asyncio.LimitOverrunError as error:
+            # Discard what was read so far and look for the end of the line
+            await reader.readexactly(error.consumed)
+            skipping = True
+            continue
+
+        if not skipping:
+            return line
+
+        _logger.warning('Dropped a line longer than %s bytes.',
+                        ASYNC_LINE_LIMIT)
+        skipping = False
+
+
+class AsyncClient(RawLineLogger):
+    '''Client that runs on an asyncio event loop instead of a reactor.
+
+    It follows the same join batching, rate limit, reconnect backoff and log
+    format as Client.
+    '''
+    def __init__(self, chat_logger: ChatLogger, channels_file,
+                 join_rate=JOIN_RATE, name_cache_size=NAME_CACHE_SIZE):
+        self._chat_logger = chat_logger
+        self._channels_file = channels_file
+        self._channels_watcher = ChannelsFileWatcher(channels_file)
         self._channels = []
+        self._channel_set = frozenset()
+        self._joined_channels = set()
+        self._logged_channels = set()
+        self._running = True
+        self._reconnect_time = RECONNECT_MIN_INTERVAL
+        self._last_connect = 0
+        self._nickname = None
+        self._writer = None
+        self._send_queue = None
+        self._rate_limit = float('+inf')
+        self._stop_event = None
+        self._join_scheduler = JoinScheduler(join_rate,
+                                             activity=chat_logger.activity)
+        self._metrics = chat_logger.metrics
+        self._periodic_calls = [
+            (self._channels_watcher.poll_interval, self._load_channels),
+            (KEEP_ALIVE, self._keep_alive),
+            (JOIN_TICK_INTERVAL, self._send_joins),
+        ]
+
+        if chat_logger.flush_interval:
+            self._periodic_calls.append(
+                (chat_logger.flush_interval, chat_logger.flush_due))
+
+        if chat_logger.sync_interval:
+            self._periodic_calls.append(
+                (chat_logger.sync_interval, chat_logger.sync))
+
+        self._setup_fast_handlers()
+        self._setup_name_cache(name_cache_size)
+
+        if self._metrics is not None:
+            self._metrics.add_gauge('join_queue',
+                                    lambda: len(self._join_scheduler))
+            self._metrics.add_gauge('join_eta', self._join_scheduler.eta)
+
+    def call_every(self, interval, func):
+        self._periodic_calls.append((interval, func))
+
+    def _get_nickname(self):
+        return self._nickname
+
+    async def run(self, host, port, nickname, password=None):
+        self._stop_event = asyncio.Event()
+        tasks = [
+            asyncio.ensure_future(self._call_periodically(interval, func))
+            for interval, func in self._periodic_calls
+        ]
+
+        try:
+            while self._running:
+                try:
+                    await self._run_session(host, port, nickname, password)
+                except OSError:
+                    _logger.exception('Connect failed.')
+
+                self._on_disconnect()
+
+                if not self._running:
+                    break
+
+                self._reconnect_time = next_reconnect_interval(
+                    self._reconnect_time, self._last_connect)
+                self._last_connect = 0
+
+                _logger.info('Reconnecting in %s seconds.',
+                             self._reconnect_time)
+
+                if self._metrics is not None:
+                    self._metrics.increment('reconnects')
+                    self._metrics.observe('reconnect_interval',
+                                          self._reconnect_time)
+
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(),
+                                           self._reconnect_time)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-        with open(self._channels_file, 'r') as file:
-            for channel in file:
-                channel = channel.strip()
+            # Stopping joins the background writer so keep it off the loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, self._chat_logger.stop)
 
-                if not channel:
+            self._channels_watcher.close()
+
+    def stop(self):
+        self._running = False
+
+        if self._stop_event:
+            self._stop_event.set()
+
+        if self._writer:
+            self._writer.close()
+
+    async def _call_periodically(self, interval, func):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                func()
+            except Exception:
+                _logger.exception('Periodic call failed.')
+
+    async def _run_session(self, host, port, nickname, password):
+        reader, writer = await asyncio.open_connection(
+            host, port, limit=ASYNC_LINE_LIMIT)
+        self._writer = writer
+        self._nickname = nickname
+        self._rate_limit = float('+inf')
+        self._send_queue = asyncio.Queue()
+        sender_task = asyncio.ensure_future(self._run_sender())
+
+        try:
+            if password:
+                self._send_raw('PASS ' + password)
+
+            self._send_raw('NICK ' + nickname)
+            self._send_raw('USER {0} 0 * :{0}'.format(nickname))
+
+            while self._running:
+                line = await read_line(reader)
+
+                if not line:
+                    break
+
+                line = line.decode('latin-1').rstrip('\r\n')
+
+                if not line:
                     continue
 
-                channel = irc.strings.lower(channel)
-                self._channels.append(channel)
+                if self._metrics is None:
+                    self._process_line(line)
+                else:
+                    start_time = time.perf_counter()
+                    self._process_line(line)
+                    self._metrics.observe('handler.line',
+                                          time.perf_counter() - start_time)
+        finally:
+            sender_task.cancel()
+            self._writer = None
+            self._send_queue = None
+            writer.close()
 
-        if self.connection.is_connected():
-            self._join_new_channels()
-            self._part_old_channels()
+    def _send_raw(self, text):
+        self._writer.write(text.encode('utf-8') + b'\r\n')
+
+    def _send(self, text):
+        self._send_queue.put_nowait(text)
+
+    async def _run_sender(self):
+        loop = asyncio.get_event_loop()
+        next_send_time = 0
+
+        while True:
+            text = await self._send_queue.get()
+            delay = next_send_time - loop.time()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self._send_raw(text)
+            next_send_time = loop.time() + 1 / self._rate_limit
+            await self._writer.drain()
+
+    def _process_line(self, line):
+        tags, source, command, arguments = parse_line(line)
+
+        if self._log_parsed_line(tags, source, command, arguments):
+            return
+
+        if command == '001':
+            self._on_welcome(arguments)
+        elif command == 'PING':
+            self._send_raw('PONG ' + (arguments[0] if arguments else ''))
+        elif command == 'JOIN' and source and arguments:
+            self._on_join(source, arguments[0])
+        elif command == 'PART' and source and arguments:
+            self._on_part(source, arguments[0])
+
+    def _on_welcome(self, arguments):
+        _logger.info('Logged in to server.')
+
+        if arguments:
+            self._nickname = self._lower(arguments[0])
+
+        self._send_raw('CAP REQ twitch.tv/membership')
+        self._send_raw('CAP REQ twitch.tv/commands')
+        self._send_raw('CAP REQ twitch.tv/tags')
+        self._rate_limit = IRC_RATE_LIMIT
+        self._load_channels(force_reload=True)
+        self._join_channels(self._channels)
+        self._last_connect = time.time()
+
+    def _on_disconnect(self):
+        _logger.info('Disconnected!')
+
+        for channel in self._logged_channels:
+            self._chat_logger.remove_channel(channel)
+
+        self._logged_channels.clear()
+        self._joined_channels.clear()
+        self._join_scheduler.clear()
+
+    def _on_join(self, source, channel):
+        nick = self._lower(source.partition('!')[0])
+        channel = self._lower(channel)
+
+        if nick == self._nickname:
+            _logger.info('Joined %s', channel)
+            self._joined_channels.add(channel)
+
+        self._chat_logger.log_join(channel, nick, source=self)
+
+    def _on_part(self, source, channel):
+        nick = self._lower(source.partition('!')[0])
+        channel = self._lower(channel)
+
+        if nick == self._nickname and channel in self._joined_channels:
+            _logger.info('Parted %s', channel)
+            self._joined_channels.remove(channel)
+
+        self._chat_logger.log_part(channel, nick, source=self)
+
+    def _join_channels(self, channels):
+        for channel in channels:
+            if channel not in self._logged_channels:
+                _logger.info('Channel to join: %s', channel)
+                self._chat_logger.add_channel(channel)
+                self._logged_channels.add(channel)
+                self._join_scheduler.join(channel)
+
+        if self._join_scheduler:
+            _logger.info('%s channels to join or part, about %.0f seconds.',
+                         len(self._join_scheduler),
+                         self._join_scheduler.eta())
+
+    def _part_channels(self, channels):
+        for channel in channels:
+            if channel in self._logged_channels:
+                self._chat_logger.remove_channel(channel)
+                self._logged_channels.remove(channel)
+                self._join_scheduler.part(channel)
+
+    def _send_joins(self):
+        self._join_scheduler.update_rates()
+
+        if not self._send_queue or not self._join_scheduler:
+            return
+
+        joins, parts = self._join_scheduler.take()
+
+        for channel in parts:
+            _logger.info('Parting %s', channel)
+            self._send('PART ' + channel)
+
+        for group in grouper(joins, JOIN_BATCH_SIZE):
+            channel = ','.join(channel for channel in group if channel)
+            _logger.info('Joining %s', channel)
+            self._send('JOIN ' + channel)
+
+    def _load_channels(self, force_reload=False):
+        if not self._channels_watcher.changed() and not force_reload:
+            return
+
+        channels = read_channels_file(self._channels_file)
+        added, removed = diff_channels(self._channel_set, channels)
+        self._channels = channels
+        self._channel_set = frozenset(channels)
+
+        if self._send_queue:
+            self._join_channels(added)
+            self._part_channels(removed)
 
     def _keep_alive(self):
-        if self.connection.is_connected():
-            self.connection.ping('keep-alive')
+        if self._send_queue:
+            self._send('PING keep-alive')
+
+
+class HashRing(object):
+    '''Consistent hash ring that maps keys to nodes.'''
+    def __init__(self, nodes, replicas=100):
+        ring = sorted(
+            (self._hash('{}-{}'.format(node, index)), node)
+            for node in nodes for index in range(replicas)
+        )
+        self._hashes = [item[0] for item in ring]
+        self._nodes = [item[1] for item in ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8],
+                              'big')
+
+    def get_node(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+    def get_nodes(self, key, count):
+        '''Return up to count distinct nodes, starting with get_node().'''
+        index = bisect.bisect(self._hashes, self._hash(key))
+        nodes = []
+
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(index + offset) % len(self._nodes)]
+
+            if node not in nodes:
+                nodes.append(node)
+
+                if len(nodes) == count:
+                    break
+
+        return nodes
+
+
+class ClientPool(object):
+    '''Splits the channels across several connections.
+
+    Channels are assigned to connections using consistent hashing. Every
+    connection runs in the same reactor and writes to the same chat logger.
+    With a redundancy above 1, each channel is joined by that many
+    connections so that one can keep logging while another reconnects; the
+    chat logger should then have a dedup window.
+    '''
+    def __init__(self, chat_logger: ChatLogger, channels_file,
+                 connection_count, fast_path=False, join_rate=JOIN_RATE,
+                 redundancy=1):
+        if not 1 <= redundancy <= connection_count:
+            raise ValueError('redundancy must be between 1 and the number of '
+                             'connections')
+
+        if fast_path:
+            self.reactor = FastReactor()
+        else:
+            self.reactor = irc.client.Reactor()
+
+        self._chat_logger = chat_logger
+        self._channels_file = channels_file
+        self._channels_watcher = ChannelsFileWatcher(channels_file)
+        self._ring = HashRing(range(connection_count))
+        self._redundancy = redundancy
+        # The join rate budget is per account, not per connection
+        self.clients = tuple(
+            Client(chat_logger, reactor=self.reactor, fast_path=fast_path,
+                   join_rate=join_rate / connection_count)
+            for dummy in range(connection_count)
+        )
+
+        self.reactor.scheduler.execute_every(
+            self._channels_watcher.poll_interval, self._load_channels)
+
+        if chat_logger.flush_interval:
+            self.reactor.scheduler.execute_every(chat_logger.flush_interval,
+                                                 chat_logger.flush_due)
+
+        if chat_logger.sync_interval:
+            self.reactor.scheduler.execute_every(chat_logger.sync_interval,
+                                                 chat_logger.sync)
+
+    def autoconnect(self, *args, **kwargs):
+        self._load_channels(force_reload=True)
+
+        for client in self.clients:
+            client.autoconnect(*args, **kwargs)
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+
+        self._channels_watcher.close()
+
+    def _load_channels(self, force_reload=False):
+        if not self._channels_watcher.changed() and not force_reload:
+            return
+
+        shards = tuple([] for dummy in self.clients)
+
+        for channel in read_channels_file(self._channels_file):
+            for node in self._ring.get_nodes(channel, self._redundancy):
+                shards[node].append(channel)
+
+        for client, channels in zip(self.clients, shards):
+            client.set_channels(channels)
+
+
+SUPERVISOR_POLL_INTERVAL = 1
+WORKER_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGUSR1)
+WORKER_STOP_TIMEOUT = 30
+
+
+class Supervisor(object):
+    '''Runs a Client in each of several worker processes.
+
+    Each worker is given its slice of the channels file as a separate file
+    that is rewritten whenever its slice changes.
+    '''
+    def __init__(self, args, worker_count):
+        self._args = args
+        self._ring = HashRing(range(worker_count))
+        self._channels_watcher = ChannelsFileWatcher(args.channels_file)
+        self._running = True
+        self._slice_dir = tempfile.mkdtemp(prefix='spaghettilogger-')
+        self._slice_paths = tuple(
+            os.path.join(self._slice_dir, 'channels-{}.txt'.format(index))
+            for index in range(worker_count)
+        )
+        self._slices = [None] * worker_count
+        self._workers = [None] * worker_count
+        self._start_times = [0] * worker_count
+        self._restart_times = [0] * worker_count
+        self._restart_intervals = [RECONNECT_MIN_INTERVAL] * worker_count
+
+    def run(self):
+        def stop(dummy1, dummy2):
+            self._running = False
+
+        def toggle_profilers(dummy1, dummy2):
+            for worker in self._workers:
+                if worker and worker.is_alive():
+                    os.kill(worker.pid, signal.SIGUSR1)
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGUSR1, toggle_profilers)
+
+        try:
+            while self._running:
+                self._load_channels()
+                self._check_workers()
+                time.sleep(SUPERVISOR_POLL_INTERVAL)
+        finally:
+            self._stop_workers()
+            self._channels_watcher.close()
+            shutil.rmtree(self._slice_dir)
+
+    def _load_channels(self):
+        if not self._channels_watcher.changed():
+            return
+
+        slices = tuple([] for dummy in self._slice_paths)
+
+        for channel in read_channels_file(self._args.channels_file):
+            slices[self._ring.get_node(channel)].append(channel)
+
+        for index, channels in enumerate(slices):
+            if channels == self._slices[index]:
+                continue
+
+            temp_path = self._slice_paths[index] + '.tmp'
+
+            with open(temp_path, 'w') as file:
+                for channel in channels:
+                    file.write(channel)
+                    file.write('\n')
+
+            os.replace(temp_path, self._slice_paths[index])
+            self._slices[index] = channels
+
+    def _check_workers(self):
+        time_now = time.time()
+
+        for index, worker in enumerate(self._workers):
+            if worker and worker.is_alive():
+                continue
+
+            if worker:
+                _logger.warning('Worker %s exited with code %s.',
+                                index, worker.exitcode)
+                self._workers[index] = None
+
+                self._restart_intervals[index] = next_reconnect_interval(
+                    self._restart_intervals[index], self._start_times[index])
+                self._restart_times[index] = \
+                    time_now + self._restart_intervals[index]
+
+                _logger.info('Restarting worker %s in %s seconds.',
+                             index, self._restart_intervals[index])
+
+            if time_now >= self._restart_times[index]:
+                self._start_worker(index)
+
+    def _start_worker(self, index):
+        _logger.info('Starting worker %s.', index)
+
+        args = argparse.Namespace(**vars(self._args))
+
+        # Workers can't share a stats file, port or spill file
+        if args.stats_file:
+            args.stats_file = '{}.{}'.format(args.stats_file, index)
+
+        if args.stats_port is not None:
+            args.stats_port += index
+
+        if args.profile:
+            args.profile = '{}.{}'.format(args.profile, index)
+
+        if args.spill_dir:
+            args.spill_dir = os.path.join(args.spill_dir,
+                                          'worker-{}'.format(index))
+            os.makedirs(args.spill_dir, exist_ok=True)
+
+        # Workers without a nickname get their own anonymous account
+        if args.nickname:
+            args.join_rate /= len(self._workers)
+
+        worker = multiprocessing.Process(
+            target=_run_worker,
+            args=(args, self._slice_paths[index]),
+            name='worker-{}'.format(index)
+        )
+        # Until the worker replaces the supervisor's handlers, a signal
+        # would run them in the worker. The worker unblocks them once its
+        # own handlers are installed, so a stop is not lost either.
+        signal.pthread_sigmask(signal.SIG_BLOCK, WORKER_SIGNALS)
+
+        try:
+            worker.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, WORKER_SIGNALS)
+
+        self._workers[index] = worker
+        self._start_times[index] = time.time()
+
+    def _stop_workers(self):
+        workers = tuple(worker for worker in self._workers if worker)
+
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+
+            if worker.is_alive():
+                _logger.warning('Killing worker %s.', worker.name)
+                worker.kill()
+                worker.join()
+
+
+def _run_worker(args, channels_file):
+    # Don't share the supervisor's nickname or its signal handlers. SIGINT
+    # and SIGTERM stay blocked until _run_client() installs its own.
+    random.seed()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # The default action would kill the worker before run_client() installs
+    # the profiler's handler
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, [signal.SIGUSR1])
+
+    run_client(args, channels_file)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -419,6 +3386,84 @@ def main():
     arg_parser.add_argument('--port', type=int, default=6667)
     arg_parser.add_argument('--nickname')
     arg_parser.add_argument('--oauth-file')
+    arg_parser.add_argument('--flush-size', type=int, metavar='BYTES',
+                            help='buffer log lines and flush after BYTES')
+    arg_parser.add_argument('--flush-interval', type=float, metavar='SECONDS',
+                            help='buffer log lines and flush after SECONDS')
+    arg_parser.add_argument('--writer-queue', type=int, metavar='SIZE',
+                            help='write to disk on a separate thread '
+                                 'through a queue of SIZE lines')
+    arg_parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES,
+                            default=BACKPRESSURE_BLOCK,
+                            help='what to do when the writer queue is full')
+    arg_parser.add_argument('--connections', type=int, default=1,
+                            help='split channels across this many connections')
+    arg_parser.add_argument('--redundancy', type=int, default=1,
+                            metavar='COUNT',
+                            help='join each channel from COUNT connections '
+                                 'and log each message once')
+    arg_parser.add_argument('--dedup-window', type=float,
+                            default=DEDUP_WINDOW, metavar='SECONDS',
+                            help='with redundancy, discard lines already '
+                                 'logged in the last SECONDS')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='split channels across this many processes')
+    arg_parser.add_argument('--fast-path', action='store_true',
+                            help='log chat messages from raw lines without '
+                                 'full IRC event parsing')
+    arg_parser.add_argument('--max-open-files', type=int, metavar='COUNT',
+                            help='keep at most COUNT log files open')
+    arg_parser.add_argument('--compression', choices=('gzip', 'zstd'),
+                            help='write compressed log files')
+    arg_parser.add_argument('--compact', choices=('gzip', 'zstd'),
+                            help='compress log files of previous days')
+    arg_parser.add_argument('--durability', choices=DURABILITY_POLICIES,
+                            default=DURABILITY_NONE,
+                            help='when to fsync log files')
+    arg_parser.add_argument('--sync-interval', type=float,
+                            default=SYNC_INTERVAL, metavar='SECONDS',
+                            help='fsync every SECONDS with the periodic and '
+                                 'group policies')
+    arg_parser.add_argument('--stall-buffer', type=int, metavar='SIZE',
+                            help='when writing log files fails, hold up to '
+                                 'SIZE characters of lines in memory and '
+                                 'write them once it works again')
+    arg_parser.add_argument('--spill-dir', metavar='DIR',
+                            help='with --stall-buffer, move held lines to a '
+                                 'file in DIR when the buffer is full')
+    arg_parser.add_argument('--segment-size', type=int, metavar='BYTES',
+                            help='start a new log file segment after BYTES '
+                                 '(uncompressed)')
+    arg_parser.add_argument('--segment-interval', type=float,
+                            metavar='SECONDS',
+                            help='start a new log file segment every SECONDS')
+    arg_parser.add_argument('--format', choices=sorted(LOG_FORMATS),
+                            default='text',
+                            help='write text or compact binary log files')
+    arg_parser.add_argument('--index-interval', type=float, metavar='SECONDS',
+                            help='write a time index of each log file with '
+                                 'an entry every SECONDS')
+    arg_parser.add_argument('--join-rate', type=float, default=JOIN_RATE,
+                            metavar='CHANNELS',
+                            help='join at most CHANNELS per second')
+    arg_parser.add_argument('--stats-file', metavar='PATH',
+                            help='periodically write metrics as JSON to PATH')
+    arg_parser.add_argument('--stats-port', type=int, metavar='PORT',
+                            help='serve metrics as JSON over HTTP on '
+                                 'localhost PORT')
+    arg_parser.add_argument('--stats-interval', type=float,
+                            default=METRICS_INTERVAL, metavar='SECONDS',
+                            help='update metrics every SECONDS')
+    arg_parser.add_argument('--profile', metavar='PATH',
+                            help='sample stacks from the start and write '
+                                 'them to PATH for flame graphs on exit; '
+                                 'SIGUSR1 toggles sampling')
+    arg_parser.add_argument('--profile-interval', type=float,
+                            default=PROFILE_INTERVAL, metavar='SECONDS',
+                            help='sample stacks every SECONDS')
+    arg_parser.add_argument('--engine', choices=('reactor', 'asyncio'),
+                            default='reactor',
+                            help='IRC client implementation to use')
 
     args = arg_parser.parse_args()
 
@@ -430,6 +3475,74 @@ def main():
     if not os.path.isdir(args.log_dir):
         sys.exit('log dir provided is not a directory.')
 
+    if args.redundancy < 1:
+        sys.exit('redundancy must be at least 1.')
+
+    if args.redundancy > args.connections:
+        args.connections = args.redundancy
+
+    if args.engine == 'asyncio' and args.connections > 1:
+        sys.exit('the asyncio engine supports only one connection.')
+
+    # Disk writes would otherwise block the event loop, reads included
+    if args.engine == 'asyncio' and not args.writer_queue:
+        args.writer_queue = ASYNC_WRITER_QUEUE
+
+    if 'zstd' in (args.compression, args.compact) and not zstandard:
+        sys.exit('zstd requires the zstandard library.')
+
+    if args.compression and args.compact:
+        sys.exit('--compression and --compact cannot be combined.')
+
+    if args.compression and args.index_interval:
+        sys.exit('compressed log files cannot be indexed.')
+
+    if args.format == 'binary' and args.index_interval:
+        sys.exit('binary log files cannot be indexed.')
+
+    if args.spill_dir and not args.stall_buffer:
+        sys.exit('--spill-dir requires --stall-buffer.')
+
+    if args.spill_dir and not os.path.isdir(args.spill_dir):
+        sys.exit('spill dir provided is not a directory.')
+
+    if args.workers > 1:
+        _logger.info('Starting %s workers.', args.workers)
+        Supervisor(args, args.workers).run()
+        _logger.info('Stopped workers.')
+    else:
+        run_client(args, args.channels_file)
+
+
+def run_client(args, channels_file):
+    profiler = SamplingProfiler(
+        args.profile or PROFILE_FILENAME.format(os.getpid()),
+        args.profile_interval)
+    signal.signal(signal.SIGUSR1, lambda dummy1, dummy2: profiler.toggle())
+
+    if args.profile:
+        profiler.start()
+
+    try:
+        _run_client(args, channels_file)
+    finally:
+        profiler.stop()
+
+
+def _run_client(args, channels_file):
+    running = True
+
+    def stop(dummy1, dummy2):
+        nonlocal running
+        running = False
+
+    # Installed before connecting, which can block, so that a stop during
+    # the connect still flushes the log files and writes logend lines
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK,
+                           [signal.SIGINT, signal.SIGTERM])
+
     if args.oauth_file:
         with open(args.oauth_file, 'r') as file:
             password = 'oauth:' + file.read().strip()
@@ -438,25 +3551,93 @@ def main():
 
     _logger.info('Starting IRC client.')
 
-    chat_logger = ChatLogger(args.log_dir)
-    client = Client(chat_logger, args.channels_file)
-    running = True
+    if args.stats_file or args.stats_port is not None:
+        metrics = Metrics()
+        reporter = MetricsReporter(metrics, args.stats_file, args.stats_port)
+    else:
+        metrics = reporter = None
+
+    chat_logger = ChatLogger(args.log_dir, flush_size=args.flush_size,
+                             flush_interval=args.flush_interval,
+                             queue_size=args.writer_queue,
+                             backpressure=args.backpressure,
+                             max_open_files=args.max_open_files,
+                             compression=args.compression,
+                             compact=args.compact,
+                             index_interval=args.index_interval,
+                             metrics=metrics,
+                             log_format=args.format,
+                             durability=args.durability,
+                             sync_interval=args.sync_interval,
+                             dedup_window=args.dedup_window
+                             if args.redundancy > 1 else None,
+                             segment_size=args.segment_size,
+                             segment_interval=args.segment_interval,
+                             stall_buffer_size=args.stall_buffer,
+                             spill_dir=args.spill_dir)
+
     nickname = args.nickname or 'justinfan{}'.format(random.randint(0, 9000000))
 
-    def stop(dummy1, dummy2):
-        nonlocal running
-        running = False
+    if args.engine == 'asyncio':
+        run_async_client(chat_logger, channels_file, args.host, args.port,
+                         nickname, password, reporter, args.stats_interval,
+                         args.join_rate, stopped=lambda: not running)
+        return
+
+    if args.connections > 1:
+        client = ClientPool(chat_logger, channels_file, args.connections,
+                            fast_path=args.fast_path,
+                            join_rate=args.join_rate,
+                            redundancy=args.redundancy)
+    else:
+        client = Client(chat_logger, channels_file, fast_path=args.fast_path,
+                        join_rate=args.join_rate)
 
-    client.autoconnect(args.host, args.port, nickname, password=password)
+    client.reactor.scheduler.execute_every(STATS_LOG_INTERVAL,
+                                           chat_logger.log_stats)
 
-    signal.signal(signal.SIGINT, stop)
-    signal.signal(signal.SIGTERM, stop)
+    if reporter:
+        client.reactor.scheduler.execute_every(args.stats_interval,
+                                               reporter.update)
+
+    client.autoconnect(args.host, args.port, nickname, password=password)
 
     while running:
         client.reactor.process_once(0.2)
 
     client.stop()
 
+    if reporter:
+        reporter.stop()
+
+    _logger.info('Stopped IRC client.')
+
+
+def run_async_client(chat_logger, channels_file, host, port, nickname,
+                     password, reporter=None, stats_interval=METRICS_INTERVAL,
+                     join_rate=JOIN_RATE, stopped=None):
+    client = AsyncClient(chat_logger, channels_file, join_rate=join_rate)
+    client.call_every(STATS_LOG_INTERVAL, chat_logger.log_stats)
+
+    if reporter:
+        client.call_every(stats_interval, reporter.update)
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGINT, client.stop)
+        loop.add_signal_handler(signal.SIGTERM, client.stop)
+
+        # Stopped by a signal received before the event loop started
+        if stopped and stopped():
+            client.stop()
+
+        await client.run(host, port, nickname, password=password)
+
+    asyncio.run(run())
+
+    if reporter:
+        reporter.stop()
+
     _logger.info('Stopped IRC client.')
 
 if __name__ == '__main__':
@@ -1,13 +1,30 @@
+import argparse
+import asyncio
 import datetime
 import glob
 import io
+import json
+import logging
 import os
+import resource
+import shutil
+import signal
 import socketserver
 import tempfile
 import threading
+import time
 import unittest
+import urllib.request
 
-from spaghettilogger import ChatLogger, Client
+import irc.client
+
+from spaghettilogger import ChatLogger, Client, LineWriter, BackgroundWriter, \
+    BACKPRESSURE_DROP, ClientPool, HashRing, Supervisor, read_channels_file, \
+    Clock, AsyncClient, Metrics, MetricsReporter, ChannelsFileWatcher, \
+    diff_channels, JoinScheduler, ACTIVITY_INTERVAL, sync_writers, \
+    DURABILITY_GROUP, DURABILITY_PERIODIC, Deduplicator, message_key, \
+    NameCache, SPILL_FILENAME, SamplingProfiler, read_line
+from spaghettilogreader import read_manifest, day_paths
 
 
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
@@ -16,6 +33,55 @@ class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
 class TestLogger(unittest.TestCase):
     def test_logger(self):
+        self._run_logger()
+
+    def test_logger_fast_path(self):
+        self._run_logger(fast_path=True)
+
+    def test_logger_asyncio(self):
+        self._run_logger(engine='asyncio')
+
+    def test_read_line_too_long(self):
+        async def read_lines(data, limit):
+            reader = asyncio.StreamReader(limit=limit)
+            reader.feed_data(data)
+            reader.feed_eof()
+            lines = []
+
+            while True:
+                line = await read_line(reader)
+
+                if not line:
+                    return lines
+
+                lines.append(line)
+
+        data = b'short\n' + b'x' * 50 + b'\n' + b'y' * 10 + b'\nlast'
+
+        self.assertEqual([b'short\n', b'y' * 10 + b'\n', b'last'],
+                         asyncio.run(read_lines(data, 16)))
+        self.assertEqual([b'short\n'],
+                         asyncio.run(read_lines(b'short\n' + b'x' * 50, 16)))
+
+    def test_fast_path_output_matches(self):
+        def strip_dates(data):
+            return [line.split(' ', 1)[1] if not line.startswith('#')
+                    else line.split(' ', 2)[2]
+                    for line in data.splitlines()]
+
+        self.assertEqual(strip_dates(self._run_logger()),
+                         strip_dates(self._run_logger(fast_path=True)))
+
+    def test_logger_metrics(self):
+        metrics = Metrics()
+        self._run_logger(metrics=metrics)
+        snapshot = metrics.snapshot()
+
+        self.assertIn('handler.pubmsg', snapshot['histograms'])
+        self.assertIn('handler.welcome', snapshot['histograms'])
+        self.assertGreater(snapshot['channel_lines']['#test_channel'], 10)
+
+    def _run_logger(self, fast_path=False, engine='reactor', metrics=None):
         thread_event = threading.Event()
 
         class Handler(socketserver.StreamRequestHandler):
@@ -71,16 +137,24 @@ class TestLogger(unittest.TestCase):
             with open(channels_file_path, 'w') as file:
                 file.write('#test_channel\n')
 
-            chat_logger = ChatLogger(log_dir)
-            client = Client(chat_logger, channels_file_path)
-
-            client.autoconnect('localhost', port, 'justinfan28394')
-
+            chat_logger = ChatLogger(log_dir, metrics=metrics)
             server_thread = threading.Thread(target=server.serve_forever)
             server_thread.daemon = True
             server_thread.start()
 
-            client_thread = threading.Thread(target=client.reactor.process_forever)
+            if engine == 'asyncio':
+                client = AsyncClient(chat_logger, channels_file_path)
+                loop = asyncio.new_event_loop()
+                client_thread = threading.Thread(
+                    target=loop.run_until_complete,
+                    args=(client.run('localhost', port, 'justinfan28394'),)
+                )
+            else:
+                client = Client(chat_logger, channels_file_path,
+                                fast_path=fast_path)
+                client.autoconnect('localhost', port, 'justinfan28394')
+                client_thread = threading.Thread(target=client.reactor.process_forever)
+
             client_thread.daemon = True
             client_thread.start()
 
@@ -89,7 +163,17 @@ class TestLogger(unittest.TestCase):
             server.shutdown()
             server.server_close()
 
-            client.stop()
+            if engine == 'asyncio':
+                deadline = time.time() + 10
+
+                while client._logged_channels and time.time() < deadline:
+                    time.sleep(0.1)
+
+                loop.call_soon_threadsafe(client.stop)
+                client_thread.join(10)
+                loop.close()
+            else:
+                client.stop()
 
             data = io.StringIO()
             paths = sorted(glob.glob(temp_dir + '/logs/#test_channel/*.log'))
@@ -116,3 +200,915 @@ class TestLogger(unittest.TestCase):
             self.assertIn('Kappa Keepo', log_file_data)
             self.assertRegex(log_file_data, r'usernotice .*msg-param-months.* :Great stream')
             self.assertIn('clearmsg login=ronni;target-msg-id=abc-123-def :HeyGuys', log_file_data)
+
+            return log_file_data
+
+
+class TestLineWriter(unittest.TestCase):
+    def _read_day_file(self, log_dir, channel):
+        paths = glob.glob(os.path.join(log_dir, channel, '*.log'))
+
+        self.assertEqual(1, len(paths))
+
+        with open(paths[0]) as file:
+            return file.read()
+
+    def test_flush_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#test_channel', flush_size=10)
+
+            writer.write_line('abc')
+            self.assertEqual('', self._read_day_file(temp_dir, '#test_channel'))
+
+            writer.write_line('defghi')
+            self.assertEqual('abc\ndefghi\n',
+                             self._read_day_file(temp_dir, '#test_channel'))
+
+            writer.write_line('jkl')
+            writer.flush()
+            self.assertEqual('abc\ndefghi\njkl\n',
+                             self._read_day_file(temp_dir, '#test_channel'))
+
+            writer.close()
+
+    def test_flush_interval(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#test_channel', flush_interval=0.05)
+
+            writer.write_line('abc')
+            writer.flush_due()
+            self.assertEqual('', self._read_day_file(temp_dir, '#test_channel'))
+
+            time.sleep(0.1)
+            writer.flush_due()
+            self.assertEqual('abc\n',
+                             self._read_day_file(temp_dir, '#test_channel'))
+
+            writer.close()
+
+    def test_durability(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writers = [
+                LineWriter(temp_dir, '#channel1', flush_size=1000000,
+                           durability=DURABILITY_GROUP),
+                LineWriter(temp_dir, '#channel2', flush_size=1000000,
+                           durability=DURABILITY_GROUP),
+            ]
+
+            for writer in writers:
+                writer.write_line('abc')
+                self.assertTrue(writer.unsynced)
+
+            sync_writers(writers, DURABILITY_GROUP)
+
+            for writer in writers:
+                self.assertFalse(writer.unsynced)
+
+            self.assertEqual('abc\n',
+                             self._read_day_file(temp_dir, '#channel1'))
+
+            periodic_writer = LineWriter(
+                temp_dir, '#channel3', flush_size=1000000,
+                durability=DURABILITY_PERIODIC, sync_interval=0.05)
+            writers.append(periodic_writer)
+            periodic_writer.write_line('abc')
+            sync_writers([periodic_writer], DURABILITY_PERIODIC)
+            self.assertTrue(periodic_writer.unsynced)
+
+            time.sleep(0.1)
+            periodic_writer.write_line('def')
+            self.assertFalse(periodic_writer.unsynced)
+            self.assertEqual('abc\ndef\n',
+                             self._read_day_file(temp_dir, '#channel3'))
+
+            for writer in writers:
+                writer.close()
+
+    def test_segment_size(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#channel', segment_size=8)
+            writer.write_line('abcd')
+            writer.write_line('efgh')
+            writer.write_line('ijkl')
+            writer.close()
+
+            writer = LineWriter(temp_dir, '#channel', segment_size=8)
+            writer.write_line('mnop')
+            writer.close()
+
+            channel_dir = os.path.join(temp_dir, '#channel')
+            date_string = os.listdir(channel_dir)[0].split('.')[0]
+            segments = read_manifest(
+                os.path.join(channel_dir, date_string + '.manifest'))
+
+            self.assertEqual(
+                [date_string + '.0001.log', date_string + '.0002.log'],
+                [filename for filename, start in segments])
+
+            contents = []
+
+            for path in day_paths(channel_dir, date_string):
+                with open(path) as file:
+                    contents.append(file.read())
+
+            self.assertEqual(['abcd\nefgh\n', 'ijkl\nmnop\n'], contents)
+
+    def test_chat_logger_logend_barrier(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, flush_size=1000000)
+
+            chat_logger.add_channel('#test_channel')
+            chat_logger.log_join('#test_channel', 'some_user')
+            self.assertEqual('', self._read_day_file(temp_dir, '#test_channel'))
+
+            chat_logger.stop()
+            data = self._read_day_file(temp_dir, '#test_channel')
+
+            self.assertIn('logstart #test_channel', data)
+            self.assertIn('join some_user', data)
+            self.assertIn('logend #test_channel', data)
+
+
+class TestStallBuffer(unittest.TestCase):
+    def test_stall(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            spill_dir = os.path.join(temp_dir, 'spill')
+            os.mkdir(log_dir)
+            os.mkdir(spill_dir)
+
+            # Each write reopens a file, so it fails while the log
+            # directory is missing
+            chat_logger = ChatLogger(log_dir, max_open_files=1,
+                                     stall_buffer_size=100,
+                                     spill_dir=spill_dir)
+            stall_buffer = chat_logger.stall_buffer
+            chat_logger.add_channel('#a')
+            chat_logger.add_channel('#b')
+
+            os.rename(log_dir, log_dir + '.away')
+
+            for index in range(10):
+                chat_logger.log_message('nick', ('#a', '#b')[index % 2],
+                                        'message {}'.format(index))
+
+            chat_logger.remove_channel('#b')
+            chat_logger.flush_due()
+
+            self.assertTrue(stall_buffer.stalled)
+            self.assertGreater(stall_buffer.spilled, 0)
+            self.assertEqual(0, stall_buffer.dropped)
+            self.assertTrue(
+                os.path.exists(os.path.join(spill_dir, SPILL_FILENAME)))
+
+            os.rename(log_dir + '.away', log_dir)
+            chat_logger.flush_due()
+
+            self.assertFalse(stall_buffer.stalled)
+            self.assertEqual(0, len(stall_buffer))
+            self.assertFalse(
+                os.path.exists(os.path.join(spill_dir, SPILL_FILENAME)))
+
+            chat_logger.stop()
+
+            for channel, expected in (
+                    ('#a', ['logstart', 'message 0', 'message 2',
+                            'message 4', 'message 6', 'message 8', 'stall',
+                            'logend']),
+                    ('#b', ['logstart', 'message 1', 'message 3',
+                            'message 5', 'message 7', 'message 9', 'stall',
+                            'logend'])):
+                paths = glob.glob(os.path.join(log_dir, channel, '*.log'))
+
+                with open(paths[0]) as file:
+                    lines = file.read().splitlines()
+
+                self.assertEqual(expected, [
+                    line.rpartition(':')[2] if ' privmsg ' in line
+                    else line.split()[2] for line in lines])
+
+
+    def test_stall_evicted(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+            os.mkdir(log_dir)
+
+            chat_logger = ChatLogger(log_dir, max_open_files=1,
+                                     flush_size=100000,
+                                     stall_buffer_size=100000)
+            chat_logger.add_channel('#a')
+            chat_logger.add_channel('#b')
+
+            # Opening #b closes #a, which writes out its buffered lines
+            chat_logger.log_message('nick', '#a', 'message 0')
+            chat_logger.log_message('nick', '#b', 'message 1')
+
+            os.rename(log_dir, log_dir + '.away')
+            chat_logger.log_message('nick', '#a', 'message 2')
+            self.assertTrue(chat_logger.stall_buffer.stalled)
+            os.rename(log_dir + '.away', log_dir)
+
+            chat_logger.flush_due()
+            chat_logger.stop()
+
+            path, = glob.glob(os.path.join(log_dir, '#a', '*.log'))
+
+            with open(path) as file:
+                lines = file.read().splitlines()
+
+            self.assertEqual(
+                ['logstart', 'message 0', 'message 2', 'stall', 'logend'],
+                [line.rpartition(':')[2] if ' privmsg ' in line
+                 else line.split()[2] for line in lines])
+
+    def test_stall_buffered_flush(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, flush_size=1000,
+                                     stall_buffer_size=1000000)
+            chat_logger.add_channel('#a')
+            pid = os.fork()
+
+            if not pid:
+                # Flushes fail once the file reaches 4096 bytes
+                logging.disable(logging.CRITICAL)
+                signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+                limits = resource.getrlimit(resource.RLIMIT_FSIZE)
+                resource.setrlimit(resource.RLIMIT_FSIZE, (4096, limits[1]))
+
+                for index in range(200):
+                    chat_logger.log_message('nick', '#a',
+                                            'message {}'.format(index))
+
+                stalled = chat_logger.stall_buffer.stalled
+                resource.setrlimit(resource.RLIMIT_FSIZE, limits)
+                chat_logger.flush_due()
+                recovered = not chat_logger.stall_buffer.stalled
+                chat_logger.stop()
+                os._exit(0 if stalled and recovered else 1)
+
+            dummy, status = os.waitpid(pid, 0)
+            self.assertEqual(0, status)
+
+            path, = glob.glob(os.path.join(temp_dir, '#a', '*.log'))
+
+            with open(path) as file:
+                lines = file.read().splitlines()
+
+            self.assertEqual(
+                ['message {}'.format(index) for index in range(200)],
+                [line.rpartition(':')[2] for line in lines
+                 if ' privmsg ' in line])
+            self.assertIn(' stall ', lines[-2])
+
+
+class TestSamplingProfiler(unittest.TestCase):
+    def test_profiler(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'profile.folded')
+            profiler = SamplingProfiler(path, interval=0.001)
+            chat_logger = ChatLogger(temp_dir)
+            chat_logger.add_channel('#channel')
+
+            profiler.toggle()
+            self.assertTrue(profiler.running)
+            end_time = time.monotonic() + 0.5
+
+            while time.monotonic() < end_time:
+                chat_logger.log_message('nick', '#channel', 'hello')
+
+            profiler.toggle()
+            chat_logger.stop()
+
+            self.assertFalse(profiler.running)
+            self.assertGreater(profiler.samples, 0)
+
+            with open(path) as file:
+                lines = file.read().splitlines()
+
+            self.assertEqual(profiler.samples,
+                             sum(int(line.rpartition(' ')[2])
+                                 for line in lines
+                                 if line.startswith('MainThread;')))
+            self.assertTrue(any(
+                'spaghettilogger:ChatLogger._write_line;'
+                'spaghettilogger:ChatLogger._dispatch;'
+                'spaghettilogger:LineWriter.write_line' in line
+                for line in lines))
+
+            # A second run does not overwrite the first
+            profiler.toggle()
+            profiler.toggle()
+
+            self.assertEqual(os.path.join(temp_dir, 'profile.2.folded'),
+                             profiler.path)
+            self.assertTrue(os.path.exists(profiler.path))
+
+            with open(path) as file:
+                self.assertEqual(lines, file.read().splitlines())
+
+
+class TestDeduplicator(unittest.TestCase):
+    def test_message_key(self):
+        self.assertEqual('abc', message_key(
+            '#channel', 'privmsg id=abc;tmi-sent-ts=1 :nick :hello'))
+        self.assertEqual('abc', message_key(
+            '#channel', 'privmsg color=;id=abc :nick :id=def'))
+        self.assertEqual(('#channel', 'join nick'),
+                         message_key('#channel', 'join nick'))
+
+    def test_window(self):
+        deduplicator = Deduplicator(window=0.05, max_size=100)
+
+        self.assertTrue(deduplicator.add('a'))
+        self.assertTrue(deduplicator.add('b'))
+        self.assertFalse(deduplicator.add('a'))
+        self.assertFalse(deduplicator.add('a'))
+        self.assertEqual(
+            {'seen_once': 1, 'seen_multiple': 1, 'duplicates': 2},
+            deduplicator.stats())
+
+        time.sleep(0.06)
+        deduplicator.add('c')
+        time.sleep(0.06)
+        deduplicator.add('d')
+
+        self.assertTrue(deduplicator.add('a'))
+        self.assertEqual(3, len(deduplicator))
+
+        for index in range(1000):
+            deduplicator.add(index)
+
+        self.assertLessEqual(len(deduplicator), 100)
+
+    def test_redundant_channel(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, dedup_window=60)
+
+            chat_logger.add_channel('#test_channel')
+            chat_logger.add_channel('#test_channel')
+
+            for dummy in range(2):
+                chat_logger.log_message('nick', '#test_channel', 'hello',
+                                        'id=abc;tmi-sent-ts=1')
+
+            chat_logger.remove_channel('#test_channel')
+            chat_logger.log_message('nick', '#test_channel', 'bye',
+                                    'id=def;tmi-sent-ts=2')
+            chat_logger.remove_channel('#test_channel')
+
+            path, = glob.glob(os.path.join(temp_dir, '#test_channel', '*.log'))
+
+            with open(path) as file:
+                lines = [line.split(' ', 1)[1] if not line.startswith('#')
+                         else line.split(' ', 2)[2]
+                         for line in file.read().splitlines()]
+
+            self.assertEqual([
+                'logstart #test_channel',
+                'privmsg id=abc;tmi-sent-ts=1 :nick :hello',
+                'privmsg id=def;tmi-sent-ts=2 :nick :bye',
+                'logend #test_channel',
+            ], lines)
+            self.assertEqual(1, chat_logger.deduplicator.seen_multiple)
+
+    def test_add_from(self):
+        deduplicator = Deduplicator(window=60, max_size=100)
+
+        self.assertTrue(deduplicator.add_from('a', 'join'))
+        self.assertTrue(deduplicator.add_from('a', 'join'))
+        self.assertFalse(deduplicator.add_from('b', 'join'))
+        self.assertFalse(deduplicator.add_from('b', 'join'))
+        self.assertTrue(deduplicator.add_from('b', 'join'))
+        self.assertFalse(deduplicator.add_from('a', 'join'))
+        self.assertEqual(
+            {'seen_once': 0, 'seen_multiple': 1, 'duplicates': 3},
+            deduplicator.stats())
+
+    def test_repeated_join(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, dedup_window=60)
+
+            chat_logger.add_channel('#test_channel')
+            chat_logger.add_channel('#test_channel')
+
+            # Both connections see the same lines, and one connection can
+            # repeat a line
+            for source in ('connection1', 'connection2'):
+                for dummy in range(2):
+                    chat_logger.log_join('#test_channel', 'nick',
+                                         source=source)
+                    chat_logger.log_notice('#test_channel', 'hello',
+                                           source=source)
+
+            chat_logger.remove_channel('#test_channel')
+            chat_logger.remove_channel('#test_channel')
+
+            path, = glob.glob(os.path.join(temp_dir, '#test_channel', '*.log'))
+
+            with open(path) as file:
+                lines = [line.split(' ', 1)[1]
+                         for line in file.read().splitlines()
+                         if not line.startswith('#')]
+
+            self.assertEqual(['join nick', 'notice  :hello'] * 2, lines)
+            self.assertEqual(4, chat_logger.deduplicator.duplicates)
+
+
+class TestNameCache(unittest.TestCase):
+    def test_name_cache(self):
+        cache = NameCache(max_size=4)
+        name = cache.lower('#Channel[1]')
+
+        self.assertEqual('#channel{1}', name)
+        self.assertIs(name, cache.lower(''.join(['#Channel', '[1]'])))
+
+        for index in range(10):
+            cache.lower('User{}'.format(index))
+            self.assertIs(name, cache.lower('#Channel[1]'))
+
+        self.assertLessEqual(len(cache), 4)
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    def test_ordering(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, queue_size=10)
+
+            chat_logger.add_channel('#test_channel')
+
+            for index in range(100):
+                chat_logger.log_join('#test_channel', 'user{}'.format(index))
+
+            chat_logger.stop()
+
+            path, = glob.glob(os.path.join(temp_dir, '#test_channel', '*.log'))
+
+            with open(path) as file:
+                lines = file.read().splitlines()
+
+            self.assertIn('logstart', lines[0])
+            self.assertIn('logend', lines[-1])
+            self.assertEqual(
+                ['join user{}'.format(index) for index in range(100)],
+                [line.split(' ', 1)[1] for line in lines[1:-1]]
+            )
+
+    def test_drop(self):
+        started_event = threading.Event()
+        event = threading.Event()
+        results = []
+        writer = BackgroundWriter(2, BACKPRESSURE_DROP)
+
+        def block():
+            started_event.set()
+            event.wait()
+
+        writer.submit(block)
+        started_event.wait()
+
+        for index in range(10):
+            writer.submit(results.append, index, droppable=True)
+
+        writer.submit(results.append, 'internal')
+        event.set()
+        writer.stop()
+
+        self.assertEqual([0, 1, 'internal'], results)
+        self.assertEqual(8, writer.dropped)
+
+    def test_off_thread(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, queue_size=10)
+            thread_names = []
+
+            chat_logger.add_channel('#test_channel')
+            writer = chat_logger._writers['#test_channel']
+            write_line = writer.write_line
+
+            def record_write_line(*args):
+                thread_names.append(threading.current_thread().name)
+                write_line(*args)
+
+            writer.write_line = record_write_line
+
+            for index in range(10):
+                chat_logger.log_join('#test_channel', 'user{}'.format(index))
+
+            chat_logger.stop()
+
+            self.assertEqual(['BackgroundWriter'] * 11, thread_names)
+
+
+class TestClientPool(unittest.TestCase):
+    def test_hash_ring(self):
+        channels = ['#channel{}'.format(index) for index in range(1000)]
+        ring = HashRing(range(4))
+        assignment = {channel: ring.get_node(channel) for channel in channels}
+
+        self.assertEqual({0, 1, 2, 3}, set(assignment.values()))
+        self.assertEqual(assignment,
+                         {channel: HashRing(range(4)).get_node(channel)
+                          for channel in channels})
+
+        grown_ring = HashRing(range(5))
+        moved = [channel for channel in channels
+                 if grown_ring.get_node(channel) != assignment[channel]]
+
+        self.assertTrue(all(grown_ring.get_node(channel) == 4
+                            for channel in moved))
+        self.assertLess(len(moved), 400)
+
+        for channel in channels[:100]:
+            nodes = ring.get_nodes(channel, 2)
+            self.assertEqual(assignment[channel], nodes[0])
+            self.assertEqual(2, len(set(nodes)))
+
+        self.assertEqual([0], HashRing([0]).get_nodes('#channel', 2))
+
+    def test_pool(self):
+        channels = ['#channel{}'.format(index) for index in range(10)]
+        joined_channels = []
+        lock = threading.Lock()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                nick = self.rfile.readline()
+                assert nick.startswith(b'NICK'), nick
+                nick = nick.split()[1].decode()
+
+                user = self.rfile.readline()
+                assert user.startswith(b'USER'), user
+
+                self.wfile.write(
+                    ':tmi.twitch.tv 001 {} :Welcome, GLHF!\n'.format(nick)
+                    .encode())
+
+                for dummy in range(3):
+                    caps = self.rfile.readline()
+                    assert caps.startswith(b'CAP'), caps
+
+                join = self.rfile.readline()
+                assert join.startswith(b'JOIN'), join
+
+                for channel in join.decode().split()[1].split(','):
+                    with lock:
+                        joined_channels.append(channel)
+
+                    self.wfile.write(
+                        ':{0}!{0}@{0}.tmi.twitch.tv JOIN {1}\n'
+                        ':someone!someone@someone.tmi.twitch.tv PRIVMSG {1} '
+                        ':hello {1}\n'
+                        .format(nick, channel).encode())
+
+                self.rfile.readline()
+
+        server = ThreadedTCPServer(('localhost', 0), Handler)
+        port = server.server_address[1]
+
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_dir = os.path.join(temp_dir, 'logs')
+
+            os.mkdir(log_dir)
+
+            channels_file_path = os.path.join(temp_dir, 'channels.txt')
+
+            with open(channels_file_path, 'w') as file:
+                file.write('\n'.join(channels))
+
+            chat_logger = ChatLogger(log_dir)
+            pool = ClientPool(chat_logger, channels_file_path, 3)
+
+            pool.autoconnect('localhost', port, 'justinfan28394')
+
+            deadline = time.time() + 10
+
+            while len(joined_channels) < len(channels) and \
+                    time.time() < deadline:
+                pool.reactor.process_once(0.1)
+
+            for dummy in range(10):
+                pool.reactor.process_once(0.1)
+
+            pool.stop()
+            server.shutdown()
+            server.server_close()
+
+            self.assertEqual(sorted(channels), sorted(joined_channels))
+
+            for channel in channels:
+                path, = glob.glob(os.path.join(log_dir, channel, '*.log'))
+
+                with open(path) as file:
+                    data = file.read()
+
+                self.assertIn('privmsg  :someone :hello {}'.format(channel),
+                              data)
+                self.assertIn('logend', data)
+
+
+    def test_shared_reactor(self):
+        reactors = []
+
+        class CountingReactor(irc.client.Reactor):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                reactors.append(self)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channels_file_path = os.path.join(temp_dir, 'channels.txt')
+
+            with open(channels_file_path, 'w') as file:
+                file.write('#channel\n')
+
+            Client.reactor_class = CountingReactor
+
+            try:
+                pool = ClientPool(ChatLogger(temp_dir), channels_file_path, 3)
+            finally:
+                del Client.reactor_class
+
+            self.assertEqual([], reactors)
+            self.assertEqual([pool.reactor] * 3,
+                             [client.reactor for client in pool.clients])
+            self.assertEqual(3, len(pool.reactor.connections))
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_slices(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channels_file_path = os.path.join(temp_dir, 'channels.txt')
+            channels = ['#channel{}'.format(index) for index in range(100)]
+
+            with open(channels_file_path, 'w') as file:
+                file.write('\n'.join(channels))
+
+            args = argparse.Namespace(channels_file=channels_file_path)
+            supervisor = Supervisor(args, 3)
+
+            try:
+                supervisor._load_channels()
+
+                slices = []
+
+                for path in supervisor._slice_paths:
+                    slices.append(read_channels_file(path))
+
+                self.assertEqual(sorted(channels), sorted(sum(slices, [])))
+                self.assertTrue(all(slices))
+
+                old_slice_times = [os.stat(path).st_mtime_ns
+                                   for path in supervisor._slice_paths]
+
+                with open(channels_file_path, 'a') as file:
+                    file.write('\n#new_channel\n')
+
+                os.utime(channels_file_path, (0, 0))
+                supervisor._load_channels()
+
+                changed_slices = [
+                    path for path, old_time
+                    in zip(supervisor._slice_paths, old_slice_times)
+                    if os.stat(path).st_mtime_ns != old_time
+                ]
+
+                self.assertIn('#new_channel',
+                              read_channels_file(changed_slices[0]))
+                self.assertEqual(1, len(changed_slices))
+            finally:
+                shutil.rmtree(supervisor._slice_dir)
+
+
+class TestChannelsFileWatcher(unittest.TestCase):
+    def test_watcher(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'channels.txt')
+
+            with open(path, 'w') as file:
+                file.write('#a\n')
+
+            watcher = ChannelsFileWatcher(path)
+
+            try:
+                self.assertTrue(watcher.changed())
+                self.assertFalse(watcher.changed())
+
+                with open(os.path.join(temp_dir, 'other.txt'), 'w') as file:
+                    file.write('#b\n')
+
+                self.assertFalse(watcher.changed())
+
+                # Replaced like an editor or the supervisor does
+                with open(path + '.tmp', 'w') as file:
+                    file.write('#a\n#b\n')
+
+                os.replace(path + '.tmp', path)
+
+                self.assertTrue(watcher.changed())
+                self.assertFalse(watcher.changed())
+            finally:
+                watcher.close()
+
+    def test_diff_channels(self):
+        added, removed = diff_channels(frozenset(['#a', '#b', '#c']),
+                                       ['#d', '#a', '#c', '#e'])
+
+        self.assertEqual(['#d', '#e'], added)
+        self.assertEqual({'#b'}, removed)
+
+
+class TestJoinScheduler(unittest.TestCase):
+    def test_coalesce(self):
+        scheduler = JoinScheduler(rate=1, burst=10)
+
+        scheduler.join('#a')
+        scheduler.join('#b')
+        scheduler.part('#a')
+        scheduler.part('#c')
+        scheduler.join('#c')
+        scheduler.part('#d')
+
+        self.assertEqual(2, len(scheduler))
+        self.assertEqual((['#b'], ['#d']), scheduler.take())
+        self.assertFalse(scheduler)
+
+    def test_rate_and_priority(self):
+        activity = {}
+        scheduler = JoinScheduler(rate=0.001, burst=2, activity=activity)
+        channels = ['#channel{}'.format(index) for index in range(5)]
+
+        scheduler.take()
+        activity.update({'#channel3': 600, '#channel1': 60})
+        scheduler._last_activity_update -= ACTIVITY_INTERVAL
+
+        for channel in channels:
+            scheduler.join(channel)
+
+        # Two now, two after one window of 2000 seconds, one after two
+        self.assertAlmostEqual(4000, scheduler.eta(), delta=1)
+        self.assertEqual((['#channel3', '#channel1'], []), scheduler.take())
+        self.assertEqual(([], []), scheduler.take())
+        self.assertEqual(3, len(scheduler))
+
+
+    def test_window_budget(self):
+        # At most 5 JOINs in any 0.05 seconds
+        scheduler = JoinScheduler(rate=100, burst=5)
+        join_times = []
+
+        for index in range(1000):
+            scheduler.join('#channel{}'.format(index))
+
+        end_time = time.monotonic() + 0.5
+
+        while time.monotonic() < end_time:
+            joins, parts = scheduler.take()
+            join_times.extend([time.monotonic()] * len(joins))
+            time.sleep(0.001)
+
+        self.assertGreaterEqual(len(join_times), 20)
+
+        for index, join_time in enumerate(join_times):
+            in_window = [other for other in join_times[index:]
+                         if other < join_time + 0.045]
+            self.assertLessEqual(len(in_window), 5)
+
+
+class TestClock(unittest.TestCase):
+    def test_format(self):
+        clock = Clock()
+
+        for timestamp in (0, 1.5, 1500000000.25, 1500000000.000001,
+                          1500000059.999999, 1500000060):
+            self.assertEqual(
+                datetime.datetime.fromtimestamp(
+                    timestamp, datetime.timezone.utc
+                ).replace(tzinfo=None).isoformat(),
+                clock.format(timestamp)
+            )
+
+        # Rounds to the next second rather than back to .999999
+        self.assertEqual('2017-07-14T02:41:00',
+                         clock.format(1500000059.9999996))
+        self.assertEqual('2017-07-14T02:41:00',
+                         Clock().format(1500000059.9999996))
+
+    def test_rollover(self):
+        class FakeClock(Clock):
+            timestamp = 1500000000
+
+            def now(self):
+                return self.timestamp
+
+        clock = FakeClock()
+        midnight = Clock.next_midnight(clock.timestamp)
+
+        self.assertEqual('2017-07-15', Clock.date_string(midnight))
+        self.assertEqual('2017-07-14', Clock.date_string(midnight - 1))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#test_channel', clock=clock)
+
+            writer.write_line('a')
+            writer.write_line('b', midnight - 0.5)
+            clock.timestamp = midnight
+            writer.write_line('c')
+            writer.close()
+
+            with open(os.path.join(temp_dir, '#test_channel',
+                                   '2017-07-14.log')) as file:
+                self.assertEqual('a\nb\n', file.read())
+
+            with open(os.path.join(temp_dir, '#test_channel',
+                                   '2017-07-15.log')) as file:
+                self.assertEqual('c\n', file.read())
+
+
+class TestFilePool(unittest.TestCase):
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, max_open_files=2,
+                                     flush_size=1000000)
+            channels = ['#channel{}'.format(index) for index in range(5)]
+
+            for channel in channels:
+                chat_logger.add_channel(channel)
+
+            file_pool = chat_logger._file_pool
+
+            self.assertEqual(2, len(file_pool))
+            self.assertEqual(0, file_pool.hits)
+            self.assertEqual(5, file_pool.misses)
+            self.assertEqual(3, file_pool.evictions)
+
+            for channel in reversed(channels):
+                chat_logger.log_join(channel, 'some_user')
+
+            self.assertEqual(2, file_pool.hits)
+            self.assertEqual(8, file_pool.misses)
+            self.assertEqual(6, file_pool.evictions)
+
+            chat_logger.stop()
+
+            self.assertEqual(0, len(file_pool))
+
+            for channel in channels:
+                path, = glob.glob(os.path.join(temp_dir, channel, '*.log'))
+
+                with open(path) as file:
+                    lines = file.read().splitlines()
+
+                self.assertEqual(3, len(lines))
+                self.assertIn('join some_user', lines[1])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        metrics = Metrics()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            chat_logger = ChatLogger(temp_dir, queue_size=100, metrics=metrics)
+            chat_logger.add_channel('#test_channel')
+
+            for index in range(10):
+                chat_logger.log_message('nick', '#test_channel', 'hello')
+
+            chat_logger.stop()
+
+            stats_path = os.path.join(temp_dir, 'stats.json')
+            reporter = MetricsReporter(metrics, stats_path, port=0)
+
+            try:
+                reporter.update()
+
+                with open(stats_path) as file:
+                    snapshot = json.load(file)
+
+                url = 'http://127.0.0.1:{}/'.format(reporter.port)
+
+                with urllib.request.urlopen(url) as response:
+                    self.assertEqual(snapshot, json.load(response))
+            finally:
+                reporter.stop()
+
+        self.assertEqual(12, snapshot['channel_lines']['#test_channel'])
+        self.assertGreater(snapshot['channel_rates']['#test_channel'], 0)
+        self.assertEqual(12, snapshot['histograms']['write_line']['count'])
+        self.assertEqual(0, snapshot['gauges']['writer_queue'])
+
+    def test_histogram_percentile(self):
+        metrics = Metrics()
+
+        for index in range(100):
+            metrics.observe('test', 0.001 if index < 90 else 0.1)
+
+        summary = metrics.snapshot()['histograms']['test']
+
+        self.assertEqual(100, summary['count'])
+        self.assertLessEqual(0.001, summary['p50'])
+        self.assertGreater(0.002, summary['p50'])
+        self.assertLessEqual(0.1, summary['p99'])
+        self.assertEqual(0.1, summary['max'])
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+'''Read plain and compressed Spaghetti Logger log files'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import argparse
+import bisect
+import calendar
+import mmap
+import os.path
+import sys
+import time
+import zlib
+
+from spaghettirecord import RecordDecoder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+READ_SIZE = 1048576
+INDEX_SUFFIX = '.idx'
+MANIFEST_SUFFIX = '.manifest'
+COMPRESSION_SUFFIXES = ('.gz', '.zst')
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+GZIP_WBITS = zlib.MAX_WBITS | 16
+GZIP_MAGIC = b'\x1f\x8b\x08'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Empty stored block ending each zlib sync flush
+SYNC_FLUSH_MARKER = b'\x00\x00\xff\xff'
+
+
+def _iter_plain_chunks(file):
+    while True:
+        data = file.read(READ_SIZE)
+
+        if not data:
+            return
+
+        yield data
+
+
+def _map_file(file):
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty file
+        return None
+
+
+def _is_gzip_member(data, position):
+    # Reject the gzip magic bytes occurring by chance inside a member
+    flags = data[position + 3:position + 4]
+
+    if flags and flags[0] & 0xe0:
+        return False
+
+    try:
+        zlib.decompressobj(GZIP_WBITS).decompress(
+            data[position:position + 1024])
+    except zlib.error:
+        return False
+
+    return True
+
+
+def _find_streams(data, magic, is_start=None):
+    # Return (start, end) of each gzip member or zstd frame. An unfinished
+    # stream is followed directly by the next one when a crashed logger
+    # was restarted.
+    offsets = [0]
+    position = data.find(magic, 1)
+
+    while position != -1:
+        if is_start is None or is_start(data, position):
+            offsets.append(position)
+
+        position = data.find(magic, position + 1)
+
+    offsets.append(len(data))
+
+    return list(zip(offsets, offsets[1:]))
+
+
+def _iter_gzip_member(data, start, end):
+    # Output after the last flush of an unfinished member may be a partial
+    # line or record, so it is only returned once the member is finished.
+    # Members of compacted files are never flushed and are read as is.
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    flushed = data.rfind(SYNC_FLUSH_MARKER, start, end)
+
+    if flushed == -1 or end - flushed > READ_SIZE:
+        flushed = end
+    else:
+        flushed += len(SYNC_FLUSH_MARKER)
+
+    try:
+        for position in range(start, flushed, READ_SIZE):
+            yield decompressor.decompress(
+                data[position:min(position + READ_SIZE, flushed)])
+
+        tail = decompressor.decompress(data[flushed:end])
+    except zlib.error:
+        return
+
+    if decompressor.eof:
+        yield tail
+
+
+def _iter_gzip_chunks(file):
+    # Read every gzip member, skipping what a crash left unfinished,
+    # instead of raising like the gzip module does.
+    data = _map_file(file)
+
+    if data is None:
+        return
+
+    with data:
+        for start, end in _find_streams(data, GZIP_MAGIC, _is_gzip_member):
+            yield from _iter_gzip_member(data, start, end)
+
+
+def _iter_zstd_chunks(file):
+    if not zstandard:
+        raise ValueError('zstandard library is not installed')
+
+    data = _map_file(file)
+
+    if data is None:
+        return
+
+    with data:
+        for start, end in _find_streams(data, ZSTD_MAGIC):
+            # Blocks are only decompressed once complete, so an unfinished
+            # frame ends at its last flush
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+            try:
+                for position in range(start, end, READ_SIZE):
+                    yield decompressor.decompress(
+                        data[position:min(position + READ_SIZE, end)])
+            except zstandard.ZstdError:
+                continue
+
+
+def is_finished(path):
+    '''Return whether the last compressed stream of a log file is finished.
+
+    Streams are left unfinished when the logger crashes.
+    '''
+    with open(path, 'rb') as file:
+        data = _map_file(file)
+
+        if data is None:
+            return True
+
+        with data:
+            if path.endswith('.gz'):
+                start, end = _find_streams(
+                    data, GZIP_MAGIC, _is_gzip_member)[-1]
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                error = zlib.error
+            else:
+                start, end = _find_streams(data, ZSTD_MAGIC)[-1]
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+                error = zstandard.ZstdError
+
+            try:
+                for position in range(start, end, READ_SIZE):
+                    decompressor.decompress(
+                        data[position:min(position + READ_SIZE, end)])
+            except error:
+                return False
+
+            return decompressor.eof
+
+
+def iter_chunks(path):
+    '''Yield the uncompressed contents of a log file in chunks.'''
+    if path.endswith('.gz'):
+        chunk_func = _iter_gzip_chunks
+    elif path.endswith('.zst'):
+        chunk_func = _iter_zstd_chunks
+    else:
+        chunk_func = _iter_plain_chunks
+
+    with open(path, 'rb') as file:
+        yield from chunk_func(file)
+
+
+def is_binary(path):
+    return path.endswith(('.bin', '.bin.gz', '.bin.zst'))
+
+
+def iter_lines(path, encoding='latin-1', errors='strict'):
+    '''Yield the lines of a plain, compressed or binary log file.
+
+    Lines are returned without the newline. A partial line at the end of a
+    compressed or binary file that was not closed cleanly is discarded.
+    Binary records are converted to the same lines as the text format.
+    '''
+    if is_binary(path):
+        decoder = RecordDecoder()
+
+        for chunk in iter_chunks(path):
+            for line in decoder.feed(chunk):
+                yield line.decode(encoding, errors)
+
+        return
+
+    remainder = b''
+    compressed = path.endswith(('.gz', '.zst'))
+
+    for chunk in iter_chunks(path):
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+
+        for line in lines:
+            yield line.decode(encoding, errors)
+
+    if remainder and not compressed:
+        yield remainder.decode(encoding, errors)
+
+
+def read_manifest(path):
+    '''Return the (filename, start timestamp) of each segment of a day.
+
+    Filenames are without any compression suffix. Returns an empty list if
+    the day has no manifest.
+    '''
+    segments = []
+
+    try:
+        file = open(path)
+    except FileNotFoundError:
+        return segments
+
+    with file:
+        for line in file:
+            fields = line.split()
+
+            if len(fields) != 2 or not line.endswith('\n'):
+                # Partially written entry
+                continue
+
+            segments.append((fields[0], float(fields[1])))
+
+    return segments
+
+
+def segment_time_ranges(channel_dir, date_string):
+    '''Return a dict of segment filename to (start, end) timestamps.
+
+    The end of the last segment is None.
+    '''
+    segments = read_manifest(
+        os.path.join(channel_dir, date_string + MANIFEST_SUFFIX))
+    ranges = {}
+
+    for index, (filename, start) in enumerate(segments):
+        end = segments[index + 1][1] if index + 1 < len(segments) else None
+        ranges[filename] = (start, end)
+
+    return ranges
+
+
+def strip_compression_suffix(filename):
+    for suffix in COMPRESSION_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+
+    return filename
+
+
+def day_paths(channel_dir, date_string):
+    '''Return the paths of the log files of a channel's day in order.
+
+    Segments listed in the day's manifest come first in manifest order,
+    whether or not they have been compressed since.
+    '''
+    filenames = {}
+
+    for filename in os.listdir(channel_dir):
+        if filename.startswith(date_string + '.') and \
+                filename.endswith(('.log', '.bin') + COMPRESSION_SUFFIXES):
+            filenames[strip_compression_suffix(filename)] = filename
+
+    order = [filename for filename, start in read_manifest(
+        os.path.join(channel_dir, date_string + MANIFEST_SUFFIX))]
+    order.extend(sorted(set(filenames) - set(order)))
+
+    return [os.path.join(channel_dir, filenames[name]) for name in order
+            if name in filenames]
+
+
+class LogIndex(object):
+    '''Sidecar index of a log file written by the logger.
+
+    Each entry is the timestamp and byte offset of a line, and the number of
+    lines of each event type logged between the previous entry and it.
+    '''
+    def __init__(self, entries=()):
+        self.entries = sorted(entries, key=lambda entry: entry[0])
+        self._times = [entry[0] for entry in self.entries]
+
+    @classmethod
+    def load(cls, path):
+        '''Load the index of a log file or return None if it has none.'''
+        index_path = path + INDEX_SUFFIX
+
+        if not os.path.exists(index_path):
+            return None
+
+        entries = []
+
+        with open(index_path) as file:
+            for line in file:
+                fields = line.rstrip('\n').split(' ', 2)
+
+                if len(fields) != 3:
+                    # Partially written entry
+                    continue
+
+                counts = {}
+
+                for item in filter(None, fields[2].split(',')):
+                    kind, count = item.rsplit(':', 1)
+                    counts[kind] = int(count)
+
+                entries.append((float(fields[0]), int(fields[1]), counts))
+
+        return cls(entries)
+
+    def find_offset(self, start):
+        '''Return an offset at or before the first line logged at start.'''
+        position = bisect.bisect_left(self._times, start)
+
+        if position:
+            return self.entries[position - 1][1]
+        else:
+            return 0
+
+    def counts(self, start=None, end=None):
+        '''Return the event type counts between two times.
+
+        The counts are only as precise as the index interval.
+        '''
+        totals = {}
+
+        for timestamp, offset, counts in self.entries:
+            if start is not None and timestamp <= start or \
+                    end is not None and timestamp > end:
+                continue
+
+            for kind, count in counts.items():
+                totals[kind] = totals.get(kind, 0) + count
+
+        return totals
+
+
+def format_timestamp(timestamp):
+    '''Format a Unix timestamp like the timestamps of log lines.'''
+    second = int(timestamp)
+    microsecond = int(round((timestamp - second) * 1000000))
+
+    # A fraction that rounds up to a whole second carries into it
+    if microsecond >= 1000000:
+        second += 1
+        microsecond = 0
+
+    text = time.strftime(TIMESTAMP_FORMAT, time.gmtime(second))
+
+    if microsecond:
+        text += '.{:06d}'.format(microsecond)
+
+    return text
+
+
+def parse_timestamp(text):
+    '''Parse a log line timestamp into a Unix timestamp.'''
+    text, dummy, fraction = text.partition('.')
+    timestamp = calendar.timegm(time.strptime(text, TIMESTAMP_FORMAT))
+
+    if fraction:
+        timestamp += float('0.' + fraction)
+
+    return timestamp
+
+
+def _line_timestamp(line):
+    start = 2 if line.startswith(b'# ') else 0
+    end = line.find(b' ', start)
+
+    return line[start:end] if end >= 0 else line[start:]
+
+
+def read_range(path, start=None, end=None, encoding='latin-1',
+               errors='strict'):
+    '''Yield the lines of a plain log file logged in a time range.
+
+    The start is inclusive and the end is exclusive. When the log file has
+    an index, reading begins near the start instead of the beginning of the
+    file.
+    '''
+    if path.endswith(('.gz', '.zst')) or is_binary(path):
+        raise ValueError('time ranges of compressed or binary log files are '
+                         'not supported')
+
+    index = LogIndex.load(path) if start is not None else None
+    offset = index.find_offset(start) if index else 0
+    start_text = format_timestamp(start).encode('ascii') \
+        if start is not None else None
+    end_text = format_timestamp(end).encode('ascii') \
+        if end is not None else None
+
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+
+            while offset < size:
+                line_end = data.find(b'\n', offset)
+
+                if line_end < 0:
+                    line_end = size
+
+                line = data[offset:line_end]
+                offset = line_end + 1
+                timestamp = _line_timestamp(line)
+
+                if start_text and timestamp < start_text:
+                    continue
+
+                if end_text and timestamp >= end_text:
+                    return
+
+                yield line.decode(encoding, errors)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Print log files, decompressing them and converting '
+                    'binary files to text as needed.')
+    arg_parser.add_argument('paths', nargs='+', metavar='path')
+    arg_parser.add_argument('--encoding', default='latin-1')
+    arg_parser.add_argument('--start', type=parse_timestamp,
+                            metavar='YYYY-MM-DDTHH:MM:SS',
+                            help='print only lines logged from this UTC time')
+    arg_parser.add_argument('--end', type=parse_timestamp,
+                            metavar='YYYY-MM-DDTHH:MM:SS',
+                            help='print only lines logged before this UTC '
+                                 'time')
+
+    args = arg_parser.parse_args()
+
+    stdout = sys.stdout.buffer
+
+    for path in args.paths:
+        if args.start is not None or args.end is not None:
+            lines = read_range(path, args.start, args.end,
+                               encoding=args.encoding,
+                               errors='surrogateescape')
+        else:
+            lines = iter_lines(path, encoding=args.encoding,
+                               errors='surrogateescape')
+
+        for line in lines:
+            stdout.write(line.encode(args.encoding, 'surrogateescape'))
+            stdout.write(b'\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import spaghettilogger
+from spaghettilogger import ChatLogger, LineWriter, BinaryLineWriter, \
+    Compactor, Clock, zstandard, open_compressed, COMPRESSION_SUFFIXES
+from spaghettilogreader import iter_lines, read_range, LogIndex, \
+    is_finished, format_timestamp
+from spaghettirecord import RecordEncoder
+
+
+class TestReader(unittest.TestCase):
+    def _write_lines(self, temp_dir, compression=None, close=True):
+        writer = LineWriter(temp_dir, '#test_channel', compression=compression,
+                            flush_size=100)
+
+        for index in range(1000):
+            writer.write_line('line {} ☺'.format(index).encode('utf8')
+                              .decode('latin-1'))
+
+        writer.flush()
+        path = writer._path
+
+        if close:
+            writer.close()
+
+        return path
+
+    def _check_lines(self, path, count=1000):
+        lines = list(iter_lines(path, encoding='utf8'))
+
+        self.assertEqual(count, len(lines))
+        self.assertEqual('line 0 ☺', lines[0])
+        self.assertEqual('line {} ☺'.format(count - 1), lines[-1])
+
+    def test_plain(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._write_lines(temp_dir)
+
+            self.assertTrue(path.endswith('.log'))
+            self._check_lines(path)
+
+    def test_gzip(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._write_lines(temp_dir, 'gzip')
+
+            self.assertTrue(path.endswith('.log.gz'))
+            self._check_lines(path)
+
+    def test_gzip_truncated(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._write_lines(temp_dir, 'gzip', close=False)
+
+            self._check_lines(path)
+
+            with open(path, 'r+b') as file:
+                file.truncate(os.path.getsize(path) - 1)
+
+            self._check_lines(path)
+
+    @unittest.skipIf(not zstandard, 'requires zstandard')
+    def test_zstd(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._write_lines(temp_dir, 'zstd', close=False)
+
+            self.assertTrue(path.endswith('.log.zst'))
+            self._check_lines(path)
+
+    def _check_crash(self, compression):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#test_channel',
+                                compression=compression, flush_size=100)
+            pid = os.fork()
+
+            if not pid:
+                for index in range(1000):
+                    writer.write_line('line {}'.format(index))
+
+                writer.flush()
+                writer.write_line('not flushed')
+                os._exit(0)
+
+            os.waitpid(pid, 0)
+            path, = [os.path.join(temp_dir, '#test_channel', filename)
+                     for filename in os.listdir(
+                         os.path.join(temp_dir, '#test_channel'))]
+
+            self.assertFalse(is_finished(path))
+
+            # Appended without repairing first
+            damaged_path = path + '.damaged' + os.path.splitext(path)[1]
+            shutil.copy(path, damaged_path)
+
+            with open_compressed(damaged_path, compression) as file:
+                file.write(b'appended\n')
+
+            lines = list(iter_lines(damaged_path))
+            self.assertEqual(1001, len(lines))
+            self.assertEqual(['line 999', 'appended'], lines[-2:])
+
+            writer = LineWriter(temp_dir, '#test_channel',
+                                compression=compression)
+            writer.write_line('restarted')
+            writer.close()
+
+            self.assertTrue(is_finished(path))
+
+            if compression == 'gzip':
+                with gzip.open(path) as file:
+                    lines = file.read().decode().splitlines()
+            else:
+                lines = list(iter_lines(path))
+
+            self.assertEqual(1001, len(lines))
+            self.assertEqual(['line 999', 'restarted'], lines[-2:])
+
+    def test_gzip_crash(self):
+        self._check_crash('gzip')
+
+    @unittest.skipIf(not zstandard, 'requires zstandard')
+    def test_zstd_crash(self):
+        self._check_crash('zstd')
+
+    def test_repair_once(self):
+        repaired_paths = []
+        repair_compressed = spaghettilogger.repair_compressed
+
+        def record_repair(path, compression):
+            repaired_paths.append(path)
+            return repair_compressed(path, compression)
+
+        spaghettilogger.repair_compressed = record_repair
+
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                writer = LineWriter(temp_dir, '#test_channel',
+                                    compression='gzip')
+                writer.write_line('a')
+                path = writer._path
+                writer.close()
+                writer.write_line('b')
+                writer.close()
+
+                # Reopening is routine, only the first open is checked
+                self.assertEqual([path], repaired_paths)
+
+                # Unless a failed write left the file unfinished
+                writer.write_line('flushed')
+                writer.abort()
+                self.assertFalse(is_finished(path))
+
+                writer = LineWriter(temp_dir, '#test_channel',
+                                    compression='gzip')
+                writer.write_line('c')
+                writer.close()
+
+                self.assertEqual([path, path], repaired_paths)
+                self.assertTrue(is_finished(path))
+                self.assertEqual(['a', 'b', 'flushed', 'c'],
+                                 list(iter_lines(path)))
+        finally:
+            spaghettilogger.repair_compressed = repair_compressed
+
+    def test_compact_previous_days(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channel_dir = os.path.join(temp_dir, '#test_channel')
+            os.mkdir(channel_dir)
+
+            path = os.path.join(channel_dir, '2017-07-13.log')
+
+            with open(path, 'w') as file:
+                file.write('line 0\n')
+
+            compactor = Compactor('gzip')
+            writer = LineWriter(temp_dir, '#test_channel', compactor=compactor)
+            writer.write_line('line 1', 1500000000)
+            writer.close()
+            compactor.stop()
+
+            self.assertEqual(['2017-07-13.log.gz', '2017-07-14.log'],
+                             sorted(os.listdir(channel_dir)))
+
+    def test_compactor(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = self._write_lines(temp_dir)
+            compactor = Compactor('gzip')
+
+            compactor.submit(path)
+            compactor.stop()
+
+            self.assertFalse(os.path.exists(path))
+            self._check_lines(path + '.gz')
+
+
+class TestIndex(unittest.TestCase):
+    def test_format_timestamp(self):
+        clock = Clock()
+
+        for timestamp in (0, 1.5, 1500000000.25, 1500000000.000001,
+                          1500000059.999999, 1500000060,
+                          1500000059.9999996):
+            self.assertEqual(clock.format(timestamp),
+                             format_timestamp(timestamp))
+
+    def test_read_range(self):
+        start_time = 1500000000
+        clock = Clock()
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            writer = LineWriter(temp_dir, '#test_channel', encoding='utf8',
+                                index_interval=60)
+
+            for index in range(3600):
+                timestamp = start_time + index
+                kind = 'clearchat' if index % 10 == 0 else 'privmsg'
+                writer.write_line(
+                    '{} {} user :message {} ☺'.format(
+                        clock.format(timestamp), kind, index),
+                    timestamp
+                )
+
+            path = writer._path
+            writer.close()
+
+            index = LogIndex.load(path)
+
+            self.assertEqual(61, len(index.entries))
+            self.assertEqual(0, index.entries[0][1])
+            self.assertEqual(os.path.getsize(path), index.entries[-1][1])
+            self.assertEqual({'clearchat': 360, 'privmsg': 3240},
+                             index.counts())
+            self.assertEqual({'clearchat': 6, 'privmsg': 54},
+                             index.counts(start_time + 600,
+                                          start_time + 660))
+
+            lines = list(read_range(path, start_time + 600.5,
+                                    start_time + 610, encoding='utf8'))
+
+            self.assertEqual(9, len(lines))
+            self.assertIn('message 601 ', lines[0])
+            self.assertIn('message 609 ', lines[-1])
+            self.assertLess(index.find_offset(start_time + 600.5), 2000 * 40)
+            self.assertGreater(index.find_offset(start_time + 600.5), 0)
+
+
+class TestBinary(unittest.TestCase):
+    def test_binary_log(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            clock = Clock()
+            clock.now = lambda: next(timestamps) + 0.5
+            text_logger = ChatLogger(os.path.join(temp_dir, 'text'),
+                                     clock=clock)
+            binary_logger = ChatLogger(os.path.join(temp_dir, 'binary'),
+                                       log_format='binary', flush_size=100,
+                                       clock=clock)
+
+            for name in ('text', 'binary'):
+                os.mkdir(os.path.join(temp_dir, name))
+
+            for chat_logger in (text_logger, binary_logger):
+                timestamps = iter(range(1500000000, 1500010000, 13))
+
+                for session in range(2):
+                    chat_logger.add_channel('#test_channel')
+
+                    for index in range(300):
+                        chat_logger.log_message(
+                            'nick{}'.format(index % 3), '#test_channel',
+                            'message {}'.format(index),
+                            'color=#008000;display-name=Nick{};id={}'.format(
+                                index % 3, index))
+
+                    chat_logger.stop()
+
+            text_path, binary_path = (
+                os.path.join(temp_dir, name, '#test_channel',
+                             '2017-07-14' + suffix)
+                for name, suffix in (('text', '.log'), ('binary', '.bin'))
+            )
+
+            with open(text_path, 'rb') as file:
+                text_lines = file.read().decode('latin-1').splitlines()
+
+            self.assertEqual(604, len(text_lines))
+            self.assertEqual(text_lines, list(iter_lines(binary_path)))
+            self.assertLess(os.path.getsize(binary_path),
+                            os.path.getsize(text_path) / 2)
+
+    def _check_binary_crash(self, compression):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            channel_dir = os.path.join(temp_dir, '#test_channel')
+            path = os.path.join(
+                channel_dir, Clock.date_string(time.time()) + '.bin' +
+                COMPRESSION_SUFFIXES.get(compression, ''))
+            encoder = RecordEncoder()
+            data = b''.join(encoder.encode('line {}'.format(index),
+                                           time.time())
+                            for index in range(10))
+            os.mkdir(channel_dir)
+
+            # A process crashed in the middle of writing the last record
+            if compression:
+                file = open_compressed(path, compression)
+            else:
+                file = open(path, 'wb')
+
+            with file:
+                file.write(data[:-3])
+
+            repaired_paths = []
+            repair_records = spaghettilogger.repair_records
+
+            def record_repair(path, compression):
+                repaired_paths.append(path)
+                return repair_records(path, compression)
+
+            spaghettilogger.repair_records = record_repair
+
+            try:
+                writer = BinaryLineWriter(temp_dir, '#test_channel',
+                                          compression=compression)
+                writer.write_line('restarted')
+                writer.close()
+                writer.write_line('reopened')
+                writer.close()
+            finally:
+                spaghettilogger.repair_records = repair_records
+
+            # Only the first open scans the records
+            self.assertEqual([path], repaired_paths)
+            self.assertEqual(
+                ['line {}'.format(index) for index in range(9)] +
+                ['restarted', 'reopened'],
+                list(iter_lines(path)))
+
+    def test_binary_crash(self):
+        self._check_binary_crash(None)
+
+    def test_binary_gzip_crash(self):
+        self._check_binary_crash('gzip')
@@ -0,0 +1,419 @@
+'''Binary record format for log files
+
+A binary log file starts with MAGIC followed by length prefixed records.
+Each record starts with its type:
+
+* RESET: varint base time in microseconds. It starts every writing
+  session and clears the dictionary.
+* DEFINE: bytes that are given the next dictionary ID.
+* LINE: flags, zigzag varint microseconds since the previous line (or the
+  base time), then either the whole line (FLAG_RAW) or the event type, the
+  tags (FLAG_TAGS) and the rest of the line.
+
+Tag keys and repeated tag values are replaced by dictionary IDs. Decoding
+returns the exact bytes of the text log line.
+'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import time
+
+
+MAGIC = b'SPGR\x01'
+RECORD_RESET = 0
+RECORD_DEFINE = 1
+RECORD_LINE = 2
+FLAG_INTERNAL = 1
+FLAG_RAW = 2
+FLAG_TAGS = 4
+TAGGED_EVENT_TYPES = frozenset([
+    'privmsg', 'notice', 'usernotice', 'clearchat', 'clearmsg'])
+# Values of these tags never repeat so they are not worth a dictionary ID
+UNIQUE_TAG_KEYS = frozenset(['id', 'tmi-sent-ts', 'target-msg-id'])
+MAX_DICTIONARY_SIZE = 65536
+MAX_DICTIONARY_VALUE_LENGTH = 64
+MAX_CANDIDATES = 100000
+MAX_CACHED_ITEMS = 100000
+
+
+class RecordError(ValueError):
+    pass
+
+
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    out.append(value)
+
+
+def decode_varint(data, offset):
+    '''Return the value and the offset after it, or None if incomplete.'''
+    value = 0
+    shift = 0
+
+    while True:
+        if offset >= len(data):
+            return None
+
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return value, offset
+
+
+def scan_records(chunks):
+    '''Return the length of the data up to the end of its last complete
+    record and the length of all the data.
+
+    A crash while writing can leave a partial record at the end of a file,
+    which would join the first record of the next session when decoded.
+    '''
+    complete_length = 0
+    buffer = b''
+    header_checked = False
+
+    for chunk in chunks:
+        buffer += chunk
+        offset = 0
+
+        if not header_checked:
+            if len(buffer) < len(MAGIC):
+                continue
+
+            offset = len(MAGIC)
+            header_checked = True
+
+        while True:
+            result = decode_varint(buffer, offset)
+
+            if result is None:
+                break
+
+            length, body_offset = result
+
+            if body_offset + length > len(buffer):
+                break
+
+            offset = body_offset + length
+
+        complete_length += offset
+        buffer = buffer[offset:]
+
+    return complete_length, complete_length + len(buffer)
+
+
+def to_microseconds(timestamp):
+    # A fraction that rounds up to a whole second carries into it, like
+    # Clock.format()
+    second = int(timestamp)
+
+    return second * 1000000 + int((timestamp - second) * 1000000 + 0.5)
+
+
+def format_microseconds(microseconds):
+    '''Format like the timestamps of text log lines.'''
+    second, microsecond = divmod(microseconds, 1000000)
+    text = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+
+    if microsecond:
+        text += '.{:06d}'.format(microsecond)
+
+    return text
+
+
+class RecordEncoder(object):
+    '''Encodes text log lines of a writing session into records.'''
+    def __init__(self, encoding='latin-1', errors=None, header=True):
+        self._encoding = encoding
+        self._errors = errors or 'strict'
+        self._header = header
+        self._dictionary = {}
+        self._candidates = {}
+        self._item_cache = {}
+        self._previous_time = None
+        self._format_cache = (None, None)
+
+    def encode(self, line, timestamp):
+        out = bytearray()
+        microseconds = to_microseconds(timestamp)
+
+        if self._previous_time is None:
+            if self._header:
+                out += MAGIC
+
+            body = bytearray((RECORD_RESET,))
+            encode_varint(microseconds, body)
+            self._append_record(out, body)
+            self._previous_time = microseconds
+
+        body = bytearray((RECORD_LINE, 0))
+        delta = microseconds - self._previous_time
+        encode_varint(delta * 2 if delta >= 0 else -delta * 2 - 1, body)
+        self._previous_time = microseconds
+
+        flags = self._encode_line(out, body, line, microseconds)
+        body[1] = flags
+        self._append_record(out, body)
+
+        return bytes(out)
+
+    def _encode_line(self, out, body, line, microseconds):
+        flags = 0
+        text = line
+
+        if text.startswith('# '):
+            flags |= FLAG_INTERNAL
+            text = text[2:]
+
+        second = microseconds // 1000000
+        cached_second, prefix = self._format_cache
+
+        if second != cached_second:
+            prefix = format_microseconds(second * 1000000)
+            self._format_cache = (second, prefix)
+
+        if microseconds % 1000000:
+            prefix += '.{:06d}'.format(microseconds % 1000000)
+
+        event_type, sep, rest = text[len(prefix) + 1:].partition(' ')
+
+        if not text.startswith(prefix + ' ') or not sep:
+            self._encode_literal(body, line)
+            return FLAG_RAW
+
+        self._encode_ref(out, body, event_type)
+
+        if event_type in TAGGED_EVENT_TYPES:
+            tags, sep, message = rest.partition(' :')
+
+            if sep and ' ' not in tags:
+                flags |= FLAG_TAGS
+                rest = message
+                items = tags.split(';')
+                encode_varint(len(items), body)
+                item_cache = self._item_cache
+
+                for item in items:
+                    data = item_cache.get(item)
+
+                    if data is None:
+                        data = self._encode_item(out, item)
+
+                    body += data
+
+        self._encode_literal(body, rest)
+
+        return flags
+
+    def _encode_item(self, out, item):
+        data = bytearray()
+        key, sep, value = item.partition('=')
+        cacheable = self._encode_ref(out, data, key)
+
+        if not sep:
+            data.append(0)
+        elif key in UNIQUE_TAG_KEYS:
+            value = value.encode(self._encoding, self._errors)
+            encode_varint((len(value) + 1) * 2, data)
+            data += value
+            cacheable = False
+        else:
+            cacheable = self._encode_value(out, data, value) and cacheable
+
+        # Items that are entirely dictionary IDs encode the same every time
+        if cacheable:
+            if len(self._item_cache) >= MAX_CACHED_ITEMS:
+                self._item_cache.clear()
+
+            self._item_cache[item] = bytes(data)
+
+        return data
+
+    def _append_record(self, out, body):
+        encode_varint(len(body), out)
+        out += body
+
+    def _encode_literal(self, body, text):
+        data = text.encode(self._encoding, self._errors)
+        encode_varint(len(data), body)
+        body += data
+
+    def _define(self, out, text):
+        if len(self._dictionary) >= MAX_DICTIONARY_SIZE:
+            return None
+
+        index = len(self._dictionary)
+        self._dictionary[text] = index
+        record = bytearray((RECORD_DEFINE,))
+        record += text.encode(self._encoding, self._errors)
+        self._append_record(out, record)
+
+        return index
+
+    def _encode_ref(self, out, body, text):
+        # Odd codes are dictionary IDs, even codes are literal lengths
+        index = self._dictionary.get(text)
+
+        if index is None:
+            index = self._define(out, text)
+
+        if index is not None:
+            encode_varint(index * 2 + 1, body)
+            return True
+        else:
+            data = text.encode(self._encoding, self._errors)
+            encode_varint(len(data) * 2, body)
+            body += data
+            return False
+
+    def _encode_value(self, out, body, text):
+        # Like _encode_ref but 0 means no value and values are only added to
+        # the dictionary once they repeat
+        index = self._dictionary.get(text)
+
+        if index is None and len(text) <= MAX_DICTIONARY_VALUE_LENGTH:
+            if text in self._candidates:
+                del self._candidates[text]
+                index = self._define(out, text)
+            else:
+                if len(self._candidates) >= MAX_CANDIDATES:
+                    self._candidates.clear()
+
+                self._candidates[text] = True
+
+        if index is not None:
+            encode_varint(index * 2 + 1, body)
+            return True
+        else:
+            data = text.encode(self._encoding, self._errors)
+            encode_varint((len(data) + 1) * 2, body)
+            body += data
+            return False
+
+
+class RecordDecoder(object):
+    '''Decodes records fed in chunks into text log lines as bytes.
+
+    Lines are returned without the newline. An incomplete record at the end
+    of the data is kept until more data is fed.
+    '''
+    def __init__(self):
+        self._buffer = b''
+        self._header_checked = False
+        self._dictionary = []
+        self._previous_time = None
+
+    def feed(self, data):
+        buffer = self._buffer + data
+        offset = 0
+        lines = []
+
+        if not self._header_checked:
+            if len(buffer) < len(MAGIC):
+                self._buffer = buffer
+                return lines
+
+            if not buffer.startswith(MAGIC):
+                raise RecordError('not a binary log file')
+
+            offset = len(MAGIC)
+            self._header_checked = True
+
+        while True:
+            result = decode_varint(buffer, offset)
+
+            if result is None:
+                break
+
+            length, body_offset = result
+            end = body_offset + length
+
+            if end > len(buffer):
+                break
+
+            line = self._decode_record(buffer[body_offset:end])
+
+            if line is not None:
+                lines.append(line)
+
+            offset = end
+
+        self._buffer = buffer[offset:]
+
+        return lines
+
+    def _decode_record(self, body):
+        record_type = body[0]
+
+        if record_type == RECORD_DEFINE:
+            self._dictionary.append(bytes(body[1:]))
+        elif record_type == RECORD_RESET:
+            self._dictionary = []
+            self._previous_time = decode_varint(body, 1)[0]
+        elif record_type == RECORD_LINE:
+            return self._decode_line(body)
+        else:
+            raise RecordError('unknown record type {}'.format(record_type))
+
+    def _decode_line(self, body):
+        flags = body[1]
+        delta, offset = decode_varint(body, 2)
+        delta = delta // 2 if not delta % 2 else -(delta + 1) // 2
+        self._previous_time += delta
+
+        if flags & FLAG_RAW:
+            return self._decode_literal(body, offset)[0]
+
+        parts = []
+
+        if flags & FLAG_INTERNAL:
+            parts.append(b'# ')
+
+        parts.append(format_microseconds(self._previous_time).encode('ascii'))
+        parts.append(b' ')
+        event_type, offset = self._decode_ref(body, offset)
+        parts.append(event_type)
+        parts.append(b' ')
+
+        if flags & FLAG_TAGS:
+            count, offset = decode_varint(body, offset)
+            items = []
+
+            for dummy in range(count):
+                key, offset = self._decode_ref(body, offset)
+                code, offset = decode_varint(body, offset)
+
+                if not code:
+                    items.append(key)
+                elif code % 2:
+                    items.append(key + b'=' + self._dictionary[code >> 1])
+                else:
+                    length = (code >> 1) - 1
+                    items.append(key + b'=' + body[offset:offset + length])
+                    offset += length
+
+            parts.append(b';'.join(items))
+            parts.append(b' :')
+
+        parts.append(self._decode_literal(body, offset)[0])
+
+        return b''.join(parts)
+
+    def _decode_literal(self, body, offset):
+        length, offset = decode_varint(body, offset)
+
+        return bytes(body[offset:offset + length]), offset + length
+
+    def _decode_ref(self, body, offset):
+        code, offset = decode_varint(body, offset)
+
+        if code % 2:
+            return self._dictionary[code >> 1], offset
+
+        length = code >> 1
+
+        return bytes(body[offset:offset + length]), offset + length
@@ -0,0 +1,88 @@
+import unittest
+
+from spaghettilogger import Clock
+from spaghettirecord import RecordEncoder, RecordDecoder, RecordError, \
+    encode_varint, decode_varint, to_microseconds
+
+
+START_TIME = 1500000000.25
+
+
+def make_lines():
+    clock = Clock()
+    lines = []
+
+    for index in range(200):
+        timestamp = START_TIME + index * 0.7
+        lines.append((
+            '{} privmsg badges=subscriber/12;color=#008000;'
+            'display-name=User{};id=4a6e-{};mod=0;tmi-sent-ts={};'
+            'user-type= :user{} :message ☺ {}'.format(
+                clock.format(timestamp), index % 7, index,
+                int(timestamp * 1000), index % 7, index),
+            timestamp
+        ))
+
+    timestamp = START_TIME + 1000
+    formatted = clock.format(timestamp)
+    lines.extend([
+        ('# {} logstart #channel'.format(formatted), timestamp),
+        ('{} clearchat  :'.format(formatted), timestamp),
+        ('{} clearchat a;b=;;c=d :nick'.format(formatted), timestamp),
+        ('{} join nick'.format(formatted), timestamp),
+        ('{} mode jtv +o nick'.format(formatted), timestamp),
+        # Timestamp that does not match is stored as is
+        ('2000-01-01T00:00:00 privmsg  :nick :hi', timestamp),
+        # Fraction rounding up to the next second
+        ('{} part nick'.format(clock.format(timestamp + 0.9999996)),
+         timestamp + 0.9999996),
+        # Clock going backwards
+        ('{} part nick'.format(clock.format(START_TIME)), START_TIME),
+    ])
+
+    return lines
+
+
+class TestRecord(unittest.TestCase):
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 40):
+            data = bytearray()
+            encode_varint(value, data)
+
+            self.assertEqual((value, len(data)), decode_varint(data, 0))
+
+        self.assertIsNone(decode_varint(b'\x80', 0))
+
+    def test_microseconds(self):
+        self.assertEqual(1500000000250000, to_microseconds(1500000000.25))
+        self.assertEqual(1500000060000000,
+                         to_microseconds(1500000059.9999996))
+
+    def test_round_trip(self):
+        lines = make_lines()
+        encoder = RecordEncoder(encoding='utf8')
+        data = b''.join(encoder.encode(line, timestamp)
+                        for line, timestamp in lines)
+        text_size = sum(len(line.encode('utf8')) + 1 for line, dummy in lines)
+
+        self.assertLess(len(data), text_size * 0.6)
+
+        # A second session appended to the same file
+        encoder = RecordEncoder(encoding='utf8', header=False)
+        data += encoder.encode(*lines[0])
+
+        decoder = RecordDecoder()
+        decoded = []
+
+        # Feed in small chunks to split records
+        for offset in range(0, len(data), 7):
+            decoded.extend(decoder.feed(data[offset:offset + 7]))
+
+        expected = [line for line, dummy in lines] + [lines[0][0]]
+
+        self.assertEqual(expected,
+                         [line.decode('utf8') for line in decoded])
+
+    def test_bad_header(self):
+        with self.assertRaises(RecordError):
+            RecordDecoder().feed(b'2018-01-01T00:00:00 join nick\n')
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+'''Search Spaghetti Logger log directories'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import argparse
+import collections
+import fnmatch
+import heapq
+import itertools
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+
+from spaghettilogreader import iter_lines, read_range, parse_timestamp, \
+    segment_time_ranges, strip_compression_suffix
+
+
+LOG_FILENAME_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2})(\.\d{4})?\.(?:log|bin)(?:\.gz|\.zst)?$')
+TAGGED_EVENT_TYPES = frozenset([
+    'privmsg', 'notice', 'usernotice', 'clearchat', 'clearmsg'])
+NICK_EVENT_TYPES = frozenset(['join', 'part', 'mode'])
+# Days searched at once; the next day is started as each day is merged
+DAYS_IN_FLIGHT = 2
+# Result files merged at once, which bounds the number of open files
+MAX_MERGE_FILES = 100
+TAG_ESCAPES = {
+    ':': ';',
+    's': ' ',
+    '\\': '\\',
+    'r': '\r',
+    'n': '\n',
+}
+
+
+def unescape_tag_value(value):
+    if '\\' not in value:
+        return value
+
+    chars = []
+    escaped = False
+
+    for char in value:
+        if escaped:
+            chars.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            chars.append(char)
+
+    return ''.join(chars)
+
+
+def parse_tags(text):
+    '''Parse the raw IRC tags of a log line into a dict.'''
+    tags = {}
+
+    for item in filter(None, text.split(';')):
+        key, dummy, value = item.partition('=')
+        tags[key] = unescape_tag_value(value)
+
+    return tags
+
+
+def parse_log_line(line):
+    '''Split a log line into its fields.
+
+    Returns a tuple (timestamp, event type, raw tags, nick, message). Fields
+    that the event type does not have are None.
+    '''
+    if line.startswith('# '):
+        line = line[2:]
+
+    timestamp, dummy, line = line.partition(' ')
+    event_type, dummy, text = line.partition(' ')
+    tags = nick = message = None
+
+    if event_type in TAGGED_EVENT_TYPES:
+        tags, dummy, text = text.partition(' :')
+
+        if event_type == 'privmsg':
+            nick, dummy, message = text.partition(' :')
+        elif event_type == 'clearchat':
+            nick = text or None
+        else:
+            message = text
+    elif event_type in NICK_EVENT_TYPES:
+        nick, dummy, message = text.partition(' ')
+    else:
+        message = text
+
+    return timestamp, event_type, tags, nick, message
+
+
+class Query(object):
+    '''Filters for log lines.
+
+    Lines match when they match every given filter. Each filter that is a
+    collection matches when any of its items match.
+    '''
+    def __init__(self, channels=None, start=None, end=None, event_types=None,
+                 nicks=None, tags=None):
+        self.channels = channels
+        self.start = start
+        self.end = end
+        self.event_types = frozenset(event_types) if event_types else None
+        self.nicks = frozenset(nick.lower() for nick in nicks) \
+            if nicks else None
+        self.tags = tags
+
+    def match_channel(self, channel):
+        return not self.channels or any(
+            fnmatch.fnmatchcase(channel, pattern) for pattern in self.channels)
+
+    def match_range(self, start, end):
+        '''Return whether a time range, with an optional end, overlaps.'''
+        if self.end is not None and start >= self.end:
+            return False
+
+        if self.start is not None and end is not None and end <= self.start:
+            return False
+
+        return True
+
+    def match_date(self, date_string):
+        timestamp = parse_timestamp(date_string + 'T00:00:00')
+
+        if self.end is not None and timestamp >= self.end:
+            return False
+
+        if self.start is not None and timestamp + 86400 <= self.start:
+            return False
+
+        return True
+
+    def match_line(self, line):
+        timestamp, event_type, tags, nick, message = parse_log_line(line)
+
+        if self.event_types and event_type not in self.event_types:
+            return False
+
+        if self.nicks or self.tags:
+            tags = parse_tags(tags) if tags else {}
+
+            if self.nicks:
+                if not nick and event_type in ('usernotice', 'clearmsg'):
+                    nick = tags.get('login')
+
+                if not nick or nick.lower() not in self.nicks:
+                    return False
+
+            if self.tags:
+                for key, value in self.tags.items():
+                    if tags.get(key) != value:
+                        return False
+
+        return True
+
+
+def find_log_files(log_dir, query):
+    '''Return (date, channel, path) tuples of log files matching a query.
+
+    Each segment of a day is a separate file. Segments outside the query's
+    time range are skipped using the day's manifest.
+    '''
+    results = []
+
+    for channel in os.listdir(log_dir):
+        channel_dir = os.path.join(log_dir, channel)
+
+        if not os.path.isdir(channel_dir) or not query.match_channel(channel):
+            continue
+
+        time_ranges = {}
+
+        for filename in os.listdir(channel_dir):
+            match = LOG_FILENAME_PATTERN.match(filename)
+
+            if not match or not query.match_date(match.group(1)):
+                continue
+
+            date_string = match.group(1)
+
+            if match.group(2) and (query.start is not None or
+                                   query.end is not None):
+                if date_string not in time_ranges:
+                    time_ranges[date_string] = segment_time_ranges(
+                        channel_dir, date_string)
+
+                time_range = time_ranges[date_string].get(
+                    strip_compression_suffix(filename))
+
+                if time_range and not query.match_range(*time_range):
+                    continue
+
+            results.append(
+                (date_string, channel, os.path.join(channel_dir, filename)))
+
+    results.sort()
+
+    return results
+
+
+def iter_matches(path, channel, query, encoding='latin-1'):
+    '''Yield (timestamp, channel, line) tuples of the matching lines.'''
+    if path.endswith('.log'):
+        lines = read_range(path, query.start, query.end, encoding,
+                           'surrogateescape')
+        time_filtered = True
+    else:
+        lines = iter_lines(path, encoding, 'surrogateescape')
+        time_filtered = False
+
+    for line in lines:
+        if not time_filtered and not _match_time(line, query):
+            continue
+
+        if query.match_line(line):
+            timestamp = line[2:] if line.startswith('# ') else line
+            timestamp = timestamp.partition(' ')[0]
+            yield timestamp, channel, line
+
+
+def search_file(path, channel, query, encoding, results_path):
+    '''Write the matching lines of a log file to a results file.'''
+    _write_results(results_path, iter_matches(path, channel, query, encoding),
+                   encoding)
+
+
+def _write_results(path, results, encoding):
+    # One result per line, which is safe as timestamps and channel names
+    # have no spaces and log lines have no newlines
+    with open(path, 'w', encoding=encoding, errors='surrogateescape',
+              newline='\n') as file:
+        for result in results:
+            file.write(' '.join(result))
+            file.write('\n')
+
+
+def _read_results(path, encoding):
+    with open(path, encoding=encoding, errors='surrogateescape',
+              newline='\n') as file:
+        for text in file:
+            yield tuple(text[:-1].split(' ', 2))
+
+
+def _merge_results(paths, encoding):
+    return heapq.merge(*(_read_results(path, encoding) for path in paths))
+
+
+def _match_time(line, query):
+    timestamp = parse_log_line(line)[0]
+
+    try:
+        timestamp = parse_timestamp(timestamp)
+    except ValueError:
+        return False
+
+    return (query.start is None or timestamp >= query.start) and \
+        (query.end is None or timestamp < query.end)
+
+
+def search(log_dir, query, processes=None, encoding='latin-1'):
+    '''Yield (channel, line) tuples of matching lines in timestamp order.
+
+    Files are searched in parallel by a process pool, which writes the
+    matches of each file to a temporary file. The files of each day are
+    merged together once they have all been searched, while the next days
+    are searched, so memory use does not depend on the number of matches.
+    '''
+    files = find_log_files(log_dir, query)
+    days = iter([list(day_files) for date_string, day_files
+                 in itertools.groupby(files, key=lambda item: item[0])])
+    file_numbers = itertools.count()
+    in_flight = collections.deque()
+
+    with tempfile.TemporaryDirectory() as temp_dir, \
+            multiprocessing.Pool(processes) as pool:
+        def new_path():
+            return os.path.join(temp_dir, str(next(file_numbers)))
+
+        def start_day():
+            day_files = next(days, None)
+
+            if day_files:
+                tasks = []
+
+                for date_string, channel, path in day_files:
+                    results_path = new_path()
+                    tasks.append((results_path, pool.apply_async(
+                        search_file,
+                        (path, channel, query, encoding, results_path))))
+
+                in_flight.append(tasks)
+
+        for dummy in range(DAYS_IN_FLIGHT):
+            start_day()
+
+        while in_flight:
+            paths = []
+
+            for results_path, result in in_flight.popleft():
+                result.get()
+                paths.append(results_path)
+
+            start_day()
+
+            while len(paths) > MAX_MERGE_FILES:
+                merged_path = new_path()
+                _write_results(
+                    merged_path,
+                    _merge_results(paths[:MAX_MERGE_FILES], encoding),
+                    encoding)
+
+                for path in paths[:MAX_MERGE_FILES]:
+                    os.remove(path)
+
+                paths = paths[MAX_MERGE_FILES:] + [merged_path]
+
+            for timestamp, channel, line in _merge_results(paths, encoding):
+                yield channel, line
+
+            for path in paths:
+                os.remove(path)
+
+
+def _parse_time_arg(text):
+    if 'T' not in text:
+        text += 'T00:00:00'
+
+    return parse_timestamp(text)
+
+
+def _parse_tag_arg(text):
+    key, sep, value = text.partition('=')
+
+    if not sep:
+        raise argparse.ArgumentTypeError('expected KEY=VALUE')
+
+    return key, value
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Search log files, printing matching lines in timestamp '
+                    'order.')
+    arg_parser.add_argument('log_dir')
+    arg_parser.add_argument('--channel', action='append', metavar='GLOB',
+                            help='search only channels matching GLOB')
+    arg_parser.add_argument('--start', type=_parse_time_arg,
+                            metavar='YYYY-MM-DD[THH:MM:SS]',
+                            help='search lines logged from this UTC time')
+    arg_parser.add_argument('--end', type=_parse_time_arg,
+                            metavar='YYYY-MM-DD[THH:MM:SS]',
+                            help='search lines logged before this UTC time')
+    arg_parser.add_argument('--type', action='append', metavar='TYPE',
+                            help='search only events such as privmsg')
+    arg_parser.add_argument('--nick', action='append',
+                            help='search only events by or about NICK')
+    arg_parser.add_argument('--tag', action='append', type=_parse_tag_arg,
+                            metavar='KEY=VALUE',
+                            help='search only events with this tag value')
+    arg_parser.add_argument('--processes', type=int,
+                            help='number of search processes')
+    arg_parser.add_argument('--encoding', default='latin-1')
+
+    args = arg_parser.parse_args()
+
+    query = Query(
+        channels=args.channel, start=args.start, end=args.end,
+        event_types=args.type, nicks=args.nick,
+        tags=dict(args.tag) if args.tag else None
+    )
+    stdout = sys.stdout.buffer
+
+    for channel, line in search(args.log_dir, query, args.processes,
+                                args.encoding):
+        stdout.write(channel.encode(args.encoding, 'surrogateescape'))
+        stdout.write(b' ')
+        stdout.write(line.encode(args.encoding, 'surrogateescape'))
+        stdout.write(b'\n')
+
+if __name__ == '__main__':
+    main()
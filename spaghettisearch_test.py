@@ -0,0 +1,149 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+import spaghettisearch
+from spaghettilogger import Clock, LineWriter
+from spaghettisearch import Query, search, parse_log_line, parse_tags, \
+    find_log_files
+
+
+START_TIME = 1500000000
+
+
+class TestSearch(unittest.TestCase):
+    def _write_logs(self, log_dir):
+        clock = Clock()
+
+        for channel_index, channel in enumerate(('#alpha', '#beta', '#gamma')):
+            writer = LineWriter(log_dir, channel)
+
+            for index in range(200):
+                timestamp = START_TIME + index * 1000 + channel_index
+                nick = 'user{}'.format(index % 5)
+                writer.write_line(
+                    '{} privmsg color=#008000;display-name=User\\s{} :{} '
+                    ':message {}'.format(
+                        clock.format(timestamp), index % 5, nick, index),
+                    timestamp
+                )
+
+                if index % 50 == 0:
+                    writer.write_line(
+                        '{} clearchat room-id=1 :{}'.format(
+                            clock.format(timestamp), nick),
+                        timestamp
+                    )
+
+            writer.close()
+
+        # Compressed files are searched too
+        path = os.path.join(log_dir, '#gamma', '2017-07-14.log')
+
+        with open(path, 'rb') as file:
+            data = file.read()
+
+        with gzip.open(path + '.gz', 'wb') as file:
+            file.write(data)
+
+        os.remove(path)
+
+    def test_search(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self._write_logs(temp_dir)
+
+            results = list(search(temp_dir, Query(), processes=2))
+            timestamps = [parse_log_line(line)[0] for channel, line in results]
+
+            self.assertEqual(3 * 204, len(results))
+            self.assertEqual(sorted(timestamps), timestamps)
+            self.assertEqual(['#alpha', '#alpha', '#beta', '#beta', '#gamma'],
+                             [channel for channel, line in results[:5]])
+
+            results = list(search(
+                temp_dir,
+                Query(channels=['#[ab]*'], event_types=['clearchat']),
+                processes=2))
+
+            self.assertEqual(8, len(results))
+
+            results = list(search(
+                temp_dir,
+                Query(start=START_TIME + 10000, end=START_TIME + 20000,
+                      nicks=['USER0'], tags={'display-name': 'User 0'}),
+                processes=2))
+
+            self.assertEqual(6, len(results))
+            self.assertTrue(all(' :user0 :' in line
+                                for channel, line in results))
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            clock = Clock()
+            writer = LineWriter(temp_dir, '#alpha', segment_interval=50000)
+
+            for index in range(200):
+                timestamp = START_TIME + index * 1000
+                writer.write_line(
+                    '{} privmsg :user :message {}'.format(
+                        clock.format(timestamp), index),
+                    timestamp
+                )
+
+            writer.close()
+
+            self.assertEqual(5, len(find_log_files(temp_dir, Query())))
+
+            query = Query(start=START_TIME + 60000, end=START_TIME + 70000)
+
+            self.assertEqual(1, len(find_log_files(temp_dir, query)))
+            self.assertEqual(10, len(list(search(temp_dir, query))))
+            self.assertEqual(
+                200, len(list(search(temp_dir, Query(), processes=2))))
+
+    def test_days_order(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            clock = Clock()
+            expected = []
+
+            for channel_index in range(5):
+                channel = '#channel{}'.format(channel_index)
+                writer = LineWriter(temp_dir, channel)
+
+                # Three days with lines of every channel interleaved
+                for index in range(30):
+                    timestamp = START_TIME + index * 8000 + channel_index * 7
+                    line = '{} privmsg :user :message {} {}'.format(
+                        clock.format(timestamp), channel_index, index)
+                    writer.write_line(line, timestamp)
+                    expected.append((timestamp, channel, line))
+
+                writer.close()
+
+            self.assertEqual(15, len(find_log_files(temp_dir, Query())))
+
+            max_merge_files = spaghettisearch.MAX_MERGE_FILES
+            spaghettisearch.MAX_MERGE_FILES = 2
+
+            try:
+                results = list(search(temp_dir, Query(), processes=2))
+            finally:
+                spaghettisearch.MAX_MERGE_FILES = max_merge_files
+
+            self.assertEqual(
+                [(channel, line) for timestamp, channel, line
+                 in sorted(expected)],
+                results)
+
+    def test_parse_log_line(self):
+        self.assertEqual(
+            ('2018-01-01T00:00:00', 'privmsg', 'a=b', 'nick', 'hi :there'),
+            parse_log_line('2018-01-01T00:00:00 privmsg a=b :nick :hi :there'))
+        self.assertEqual(
+            ('2018-01-01T00:00:00', 'logstart', None, None, '#channel'),
+            parse_log_line('# 2018-01-01T00:00:00 logstart #channel'))
+        self.assertEqual(
+            ('2018-01-01T00:00:00', 'join', None, 'nick', ''),
+            parse_log_line('2018-01-01T00:00:00 join nick'))
+        self.assertEqual({'a': 'b c;', 'd': ''}, parse_tags('a=b\\sc\\:;d='))
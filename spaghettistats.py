@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+'''Compute per-channel chat statistics of Spaghetti Logger log directories'''
+# Copyright 2015-2018 Christopher Foo. License: GPLv3
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy
+
+from spaghettilogreader import iter_chunks, is_binary, parse_timestamp, \
+    READ_SIZE
+from spaghettirecord import RecordDecoder
+from spaghettisearch import Query, find_log_files
+
+
+CACHE_DIRNAME = '.statscache'
+CACHE_VERSION = 1
+MINUTES_PER_DAY = 1440
+# Bytes of a line read past its start. Lines are padded so reading past
+# the end of a short last line is safe.
+LINE_PEEK = 40
+SUB_MSG_IDS = ('sub', 'resub', 'subgift', 'submysterygift')
+# Patterns matched at the start of the event type of a line
+PRIVMSG_PATTERN = re.compile(br'privmsg [^ \n]* :([^ \n]*) :')
+USERNOTICE_PATTERN = re.compile(br'usernotice (?:[^ \n]*;)?msg-id=([^; \n]*)')
+CLEARCHAT_PATTERN = re.compile(br'clearchat ([^ \n]*) :([^\n]*)')
+
+
+def hash_nicks(nicks):
+    '''Return the sorted unique 64-bit hashes of nicks.'''
+    return numpy.unique(numpy.array(
+        [int.from_bytes(hashlib.blake2b(nick.lower(), digest_size=8).digest(),
+                        'big') for nick in set(nicks)],
+        dtype=numpy.uint64
+    ))
+
+
+class FileStats(object):
+    '''Statistics of a log file, and how much of the file they cover.'''
+    def __init__(self):
+        self.messages_per_minute = numpy.zeros(MINUTES_PER_DAY, numpy.int64)
+        self.chatters = numpy.zeros(0, numpy.uint64)
+        self.msg_ids = {}
+        self.timeouts = 0
+        self.bans = 0
+        self.clears = 0
+        self.offset = 0
+        self.size = 0
+        self.mtime_ns = 0
+
+    def add_block(self, data):
+        '''Add the statistics of a block of complete lines.'''
+        buffer = numpy.frombuffer(data + b'\0' * LINE_PEEK, numpy.uint8)
+        ends = numpy.flatnonzero(buffer[:len(data)] == ord('\n'))
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+        # Internal lines start with '# ' and chat lines with the timestamp
+        starts = starts[(buffer[starts] != ord('#')) & (ends - starts > 20)]
+
+        def digits(offset):
+            return buffer[starts + offset].astype(numpy.int64) - ord('0')
+
+        minutes = (digits(11) * 10 + digits(12)) * 60 + \
+            digits(14) * 10 + digits(15)
+        # The event type follows the timestamp, which may have microseconds
+        type_starts = starts + numpy.where(
+            buffer[starts + 19] == ord('.'), 27, 20)
+        first_chars = buffer[type_starts]
+        is_privmsg = (first_chars == ord('p')) & \
+            (buffer[type_starts + 1] == ord('r'))
+        is_usernotice = first_chars == ord('u')
+        is_clearchat = (first_chars == ord('c')) & \
+            (buffer[type_starts + 5] == ord('c'))
+        valid = (minutes >= 0) & (minutes < MINUTES_PER_DAY)
+
+        self.messages_per_minute += numpy.bincount(
+            minutes[is_privmsg & valid], minlength=MINUTES_PER_DAY)
+
+        # Only the few fields needed are parsed, with a regex match at the
+        # event type of the lines that have them
+        nicks = _match_groups(PRIVMSG_PATTERN, data, type_starts[is_privmsg])
+
+        if nicks:
+            self.chatters = numpy.union1d(self.chatters, hash_nicks(nicks))
+
+        msg_ids = _match_groups(USERNOTICE_PATTERN, data,
+                                type_starts[is_usernotice])
+
+        if msg_ids:
+            names, counts = numpy.unique(
+                numpy.array(msg_ids, dtype=numpy.bytes_), return_counts=True)
+
+            for name, count in zip(names, counts):
+                name = name.decode('ascii', 'replace')
+                self.msg_ids[name] = self.msg_ids.get(name, 0) + int(count)
+
+        for match in map(CLEARCHAT_PATTERN.match,
+                         _repeat(data, is_clearchat.sum()),
+                         type_starts[is_clearchat].tolist()):
+            if not match:
+                continue
+
+            tags, nick = match.groups()
+
+            if not nick:
+                self.clears += 1
+            elif tags.startswith(b'ban-duration=') or \
+                    b';ban-duration=' in tags:
+                self.timeouts += 1
+            else:
+                self.bans += 1
+
+    def save(self, path):
+        temp_path = path + '.tmp.npz'
+
+        numpy.savez(
+            temp_path,
+            version=CACHE_VERSION,
+            messages_per_minute=self.messages_per_minute,
+            chatters=self.chatters,
+            counts=numpy.array([self.timeouts, self.bans, self.clears,
+                                self.offset, self.size, self.mtime_ns],
+                               numpy.int64),
+            msg_ids=json.dumps(self.msg_ids),
+        )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''Load cached statistics or return None if there are none.'''
+        if not os.path.exists(path):
+            return None
+
+        stats = cls()
+
+        with numpy.load(path) as data:
+            if int(data['version']) != CACHE_VERSION:
+                return None
+
+            stats.messages_per_minute = data['messages_per_minute']
+            stats.chatters = data['chatters']
+            stats.timeouts, stats.bans, stats.clears, stats.offset, \
+                stats.size, stats.mtime_ns = (int(value)
+                                              for value in data['counts'])
+            stats.msg_ids = json.loads(str(data['msg_ids']))
+
+        return stats
+
+
+def _repeat(value, count):
+    return itertools.repeat(value, int(count))
+
+
+def _match_groups(pattern, data, positions):
+    '''Return the first group of the pattern matched at each position.'''
+    return [
+        match.group(1) for match in map(
+            pattern.match, _repeat(data, len(positions)), positions.tolist())
+        if match
+    ]
+
+
+def _iter_blocks(path, offset=0):
+    '''Yield blocks of complete lines of a log file, and their end offset.
+
+    Binary records are converted to text lines. Offsets are only
+    meaningful for plain text files.
+    '''
+    if is_binary(path):
+        decoder = RecordDecoder()
+
+        for chunk in iter_chunks(path):
+            lines = decoder.feed(chunk)
+
+            if lines:
+                yield b'\n'.join(lines) + b'\n', None
+
+        return
+
+    if path.endswith(('.gz', '.zst')):
+        chunks = iter_chunks(path)
+    else:
+        chunks = _iter_plain_chunks(path, offset)
+
+    remainder = b''
+
+    for chunk in chunks:
+        data = remainder + chunk
+        end = data.rfind(b'\n') + 1
+        remainder = data[end:]
+        offset += end
+
+        if end:
+            yield data[:end], offset
+
+
+def _iter_plain_chunks(path, offset):
+    with open(path, 'rb') as file:
+        file.seek(offset)
+
+        while True:
+            data = file.read(READ_SIZE * 4)
+
+            if not data:
+                return
+
+            yield data
+
+
+def cache_path(cache_dir, channel, path):
+    return os.path.join(cache_dir, channel, os.path.basename(path) + '.npz')
+
+
+def file_stats(path, cache_file=None):
+    '''Return the statistics of a log file, using the cache if it is fresh.
+
+    A plain log file that grew since it was cached is assumed to have been
+    appended to, so only the new lines are read.
+    '''
+    stat_result = os.stat(path)
+    stats = FileStats.load(cache_file) if cache_file else None
+
+    if stats and stats.mtime_ns == stat_result.st_mtime_ns and \
+            stats.size == stat_result.st_size:
+        return stats
+
+    appendable = not path.endswith(('.gz', '.zst')) and not is_binary(path)
+
+    if not stats or not appendable or stats.size > stat_result.st_size:
+        stats = FileStats()
+
+    for data, offset in _iter_blocks(path, stats.offset):
+        stats.add_block(data)
+
+        if offset is not None:
+            stats.offset = offset
+
+    stats.size = stat_result.st_size
+    stats.mtime_ns = stat_result.st_mtime_ns
+
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        stats.save(cache_file)
+
+    return stats
+
+
+def summarize(channel, dated_stats):
+    '''Combine the (date, statistics) of a channel's files into a summary
+    dict.'''
+    stats_list = [stats for date_string, stats in dated_stats]
+    days = {}
+
+    # The segments of a day can share a minute, so they are added together
+    for date_string, stats in dated_stats:
+        if date_string in days:
+            days[date_string] = days[date_string] + stats.messages_per_minute
+        else:
+            days[date_string] = stats.messages_per_minute
+
+    per_minute = numpy.concatenate(list(days.values()))
+    active = per_minute[per_minute > 0]
+    messages = int(per_minute.sum())
+    msg_ids = {}
+
+    for stats in stats_list:
+        for name, count in stats.msg_ids.items():
+            msg_ids[name] = msg_ids.get(name, 0) + count
+
+    timeouts = sum(stats.timeouts for stats in stats_list)
+    bans = sum(stats.bans for stats in stats_list)
+    chatters = numpy.unique(numpy.concatenate(
+        [stats.chatters for stats in stats_list]))
+
+    return {
+        'channel': channel,
+        'files': len(stats_list),
+        'messages': messages,
+        'active_minutes': len(active),
+        'mean_messages_per_minute': float(active.mean()) if len(active)
+        else 0.0,
+        'peak_messages_per_minute': int(active.max()) if len(active) else 0,
+        'unique_chatters': len(chatters),
+        'usernotices': msg_ids,
+        'subs': sum(msg_ids.get(name, 0) for name in SUB_MSG_IDS),
+        'timeouts': timeouts,
+        'bans': bans,
+        'clears': sum(stats.clears for stats in stats_list),
+        'timeouts_per_1000_messages': timeouts * 1000 / messages
+        if messages else 0.0,
+        'bans_per_1000_messages': bans * 1000 / messages if messages else 0.0,
+    }
+
+
+def compute_stats(log_dir, query=None, cache_dir=None, processes=None):
+    '''Return a summary dict of each channel, sorted by channel.
+
+    Files are read in parallel by a process pool. If a cache_dir is given,
+    the statistics of each file are cached in it and reused while the
+    file's mtime and size do not change.
+    '''
+    channels = {}
+
+    with multiprocessing.Pool(processes) as pool:
+        for date_string, channel, path in find_log_files(
+                log_dir, query or Query()):
+            if cache_dir:
+                cache_file = cache_path(cache_dir, channel, path)
+            else:
+                cache_file = None
+
+            channels.setdefault(channel, []).append((
+                date_string, pool.apply_async(file_stats, (path, cache_file))
+            ))
+
+        return [
+            summarize(channel, [(date_string, result.get())
+                                for date_string, result in results])
+            for channel, results in sorted(channels.items())
+        ]
+
+
+TABLE_COLUMNS = (
+    ('channel', '{}'),
+    ('messages', '{}'),
+    ('mean_messages_per_minute', '{:.1f}'),
+    ('peak_messages_per_minute', '{}'),
+    ('unique_chatters', '{}'),
+    ('subs', '{}'),
+    ('timeouts', '{}'),
+    ('bans', '{}'),
+    ('timeouts_per_1000_messages', '{:.2f}'),
+    ('bans_per_1000_messages', '{:.2f}'),
+)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Print chat statistics of each channel: messages per '
+                    'minute, unique chatters, subs and timeouts/bans.')
+    arg_parser.add_argument('log_dir')
+    arg_parser.add_argument('--channel', action='append', metavar='GLOB',
+                            help='only channels matching GLOB')
+    arg_parser.add_argument('--start', metavar='YYYY-MM-DD',
+                            help='only days from this date')
+    arg_parser.add_argument('--end', metavar='YYYY-MM-DD',
+                            help='only days before this date')
+    arg_parser.add_argument('--cache-dir', metavar='PATH',
+                            help='cache file statistics in PATH (default '
+                                 'LOG_DIR/{})'.format(CACHE_DIRNAME))
+    arg_parser.add_argument('--no-cache', action='store_true')
+    arg_parser.add_argument('--processes', type=int,
+                            help='number of processes reading files')
+    arg_parser.add_argument('--json', action='store_true',
+                            help='print every statistic as JSON')
+
+    args = arg_parser.parse_args()
+
+    if not os.path.isdir(args.log_dir):
+        sys.exit('log dir provided is not a directory.')
+
+    if args.no_cache:
+        cache_dir = None
+    else:
+        cache_dir = args.cache_dir or os.path.join(args.log_dir,
+                                                   CACHE_DIRNAME)
+
+    query = Query(
+        channels=args.channel,
+        start=parse_timestamp(args.start + 'T00:00:00')
+        if args.start else None,
+        end=parse_timestamp(args.end + 'T00:00:00') if args.end else None
+    )
+    summaries = compute_stats(args.log_dir, query, cache_dir, args.processes)
+
+    if args.json:
+        json.dump(summaries, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    print('\t'.join(name for name, format_string in TABLE_COLUMNS))
+
+    for summary in summaries:
+        print('\t'.join(format_string.format(summary[name])
+                        for name, format_string in TABLE_COLUMNS))
+
+if __name__ == '__main__':
+    main()
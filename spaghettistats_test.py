@@ -0,0 +1,109 @@
+import os
+import tempfile
+import unittest
+
+from spaghettilogger import Clock, LineWriter
+from spaghettistats import compute_stats, file_stats, FileStats
+
+
+START_TIME = 1500000000
+
+
+class TestStats(unittest.TestCase):
+    def _write_lines(self, log_dir, channel, start, count):
+        clock = Clock()
+        writer = LineWriter(log_dir, channel)
+        writer.write_line('# {} logstart {}'.format(clock.format(start),
+                                                     channel), start)
+
+        for index in range(count):
+            timestamp = start + index * 15 + 0.25 * (index % 2)
+            date = clock.format(timestamp)
+            writer.write_line(
+                '{} privmsg id={};user-id={} :user{} :hello'.format(
+                    date, index, index % 7, index % 7),
+                timestamp
+            )
+
+            if index % 10 == 0:
+                writer.write_line(
+                    '{} usernotice login=user1;msg-id={} :Hype'.format(
+                        date, 'resub' if index % 20 else 'sub'),
+                    timestamp
+                )
+                writer.write_line(
+                    '{} clearchat ban-duration=600;room-id=1 :user2'.format(
+                        date),
+                    timestamp
+                )
+
+        writer.write_line('{} clearchat room-id=1 :user3'.format(date),
+                          timestamp)
+        writer.write_line('{} join user9'.format(date), timestamp)
+        writer.close()
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as log_dir, \
+                tempfile.TemporaryDirectory() as cache_dir:
+            self._write_lines(log_dir, '#alpha', START_TIME, 40)
+            self._write_lines(log_dir, '#alpha', START_TIME + 86400, 40)
+            self._write_lines(log_dir, '#beta', START_TIME, 4)
+
+            alpha, beta = compute_stats(log_dir, cache_dir=cache_dir,
+                                        processes=2)
+
+            self.assertEqual('#alpha', alpha['channel'])
+            self.assertEqual(80, alpha['messages'])
+            self.assertEqual(20, alpha['active_minutes'])
+            self.assertEqual(4, alpha['peak_messages_per_minute'])
+            self.assertEqual(7, alpha['unique_chatters'])
+            self.assertEqual({'sub': 4, 'resub': 4}, alpha['usernotices'])
+            self.assertEqual(8, alpha['subs'])
+            self.assertEqual(8, alpha['timeouts'])
+            self.assertEqual(2, alpha['bans'])
+            self.assertEqual(100, alpha['timeouts_per_1000_messages'])
+            self.assertEqual(4, beta['messages'])
+            self.assertEqual(4, beta['unique_chatters'])
+
+            # Cached results are reused and appended lines are added
+            self.assertEqual([alpha, beta],
+                             compute_stats(log_dir, cache_dir=cache_dir))
+
+            path = os.path.join(log_dir, '#beta', '2017-07-14.log')
+            cache_file = os.path.join(cache_dir, '#beta',
+                                      '2017-07-14.log.npz')
+            offset = FileStats.load(cache_file).offset
+
+            self.assertEqual(os.path.getsize(path), offset)
+
+            self._write_lines(log_dir, '#beta', START_TIME + 3600, 4)
+            stats = file_stats(path, cache_file)
+            self.assertEqual(8, stats.messages_per_minute.sum())
+            self.assertEqual(2, stats.bans)
+            self.assertGreater(stats.offset, offset)
+            self.assertEqual(
+                8, compute_stats(log_dir, cache_dir=cache_dir)[1]['messages'])
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            clock = Clock()
+            writer = LineWriter(log_dir, '#alpha', segment_size=1)
+
+            # Every line starts a segment, and each minute has two lines
+            for index in range(6):
+                timestamp = START_TIME + index * 30
+                writer.write_line(
+                    '{} privmsg  :user{} :hello'.format(
+                        clock.format(timestamp), index),
+                    timestamp
+                )
+
+            writer.close()
+
+            alpha, = compute_stats(log_dir)
+
+            self.assertEqual(6, alpha['files'])
+            self.assertEqual(6, alpha['messages'])
+            self.assertEqual(3, alpha['active_minutes'])
+            self.assertEqual(2, alpha['peak_messages_per_minute'])
+            self.assertEqual(2.0, alpha['mean_messages_per_minute'])